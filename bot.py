@@ -1,1630 +1,4126 @@
-import asyncio
-import html as html_mod
-import json
-import os
-import random
-import sqlite3
-from datetime import datetime
-
-import aiohttp
-from aiohttp import web
-from aiohttp.web import middleware
-from aiogram import Bot, Dispatcher, F, types
-from aiogram.filters import Command, CommandStart
-from aiogram.types import (
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    KeyboardButton,
-    ReplyKeyboardMarkup,
-    WebAppInfo,
-)
-from dotenv import load_dotenv
-
-load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
-WEBAPP_URL = os.getenv("WEBAPP_URL", "")
-API_BASE_URL = os.getenv("API_BASE_URL", "")
-API_PORT = int(os.getenv("API_PORT", "8069"))
-
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("LLM_API_KEY", "")
-LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-DATA_DIR = os.getenv("DATA_DIR", "/data")
-os.makedirs(DATA_DIR, exist_ok=True)
-
-REPLY_MAP_FILE = os.path.join(DATA_DIR, "reply_map.json")
-
-reply_map: dict[int, int] = {}
-write_mode: set[int] = set()
-
-# Oracle creation/edit state
-oracle_create_mode: dict[int, str] = {}   # user_id → "awaiting_name" | "awaiting_description" | "awaiting_edit_description"
-oracle_draft: dict[int, dict] = {}         # user_id → {"name": ..., "oracle_id": ...}
-
-ORACLE_LEVELS = {
-    1: {"max_uses": 3,    "name": "Новичок"},
-    2: {"max_uses": 10,   "name": "Мастер"},
-    3: {"max_uses": None, "name": "Великий"},   # безлимит
-}
-
-LLM_BASE_PROMPT = """Ты — Оракул Шкатулки Желаний. Твоя задача — зашифровать желание так, чтобы его нужно было РАЗГАДАТЬ.
-
-ЗАДАЧА: Замаскируй желание — замени ключевые слова на неожиданные образы. Получатель должен подумать, прежде чем поймёт о чём речь.
-
-ПРИМЕР:
-Желание: "хочу посмотреть тебе в глаза"
-ПЛОХО: "Хочу погрузиться в твои глаза, как искатель сокровищ" — это НЕ загадка, тут прямо написано "глаза"
-ХОРОШО: "Мечтаю нырнуть в две кроличьи норы, где вместо часов тикают секреты" — тут надо догадаться что "две кроличьи норы" = глаза
-
-ПРАВИЛА:
-- 1-2 предложения, не больше
-- НИКОГДА не используй слова из оригинального желания — заменяй их метафорами
-- Сохраняй направление: для себя / для другого
-- Образы из сказок, мифов, природы, космоса — но неожиданные
-- Суть должна угадываться, но не сразу — это загадка, а не пересказ
-- ТОЛЬКО фраза, без пояснений, кавычек и вступлений
-- Язык: русский"""
-
-LLM_STYLE_PROMPTS = [
-    ("""Ты — Оракул Шкатулки Желаний. Дерзкий, горячий, без стеснения.
-
-ЗАДАЧА: Перефразируй желание в пошловато-сексуальную метафору с двусмысленностью и жаром.
-
-ПРАВИЛА:
-- 1-2 предложения, не больше
-- Сохраняй направление: если автор хочет что-то ДЛЯ СЕБЯ — фраза про автора. Если хочет СДЕЛАТЬ ДРУГОМУ — фраза про получателя.
-- Пиши горячо, с откровенным подтекстом — но через метафору, не в лоб
-- Образы: плавящийся шоколад, раскалённый песок, мокрые губы, шёлк на коже, запотевшие окна
-- Двусмысленность на максимум — пусть щёки горят при чтении
-- Суть желания должна считываться сквозь жар
-- ТОЛЬКО фраза, без пояснений, кавычек и вступлений
-- Язык: русский""", 20),
-]
-
-def get_llm_prompt() -> str:
-    """Pick a prompt: base (80%) or random rare style (20%)."""
-    roll = random.randint(1, 100)
-    threshold = 0
-    for prompt, weight in LLM_STYLE_PROMPTS:
-        threshold += weight
-        if roll <= threshold:
-            return prompt
-    return LLM_BASE_PROMPT
-
-
-def load_reply_map():
-    global reply_map
-    try:
-        with open(REPLY_MAP_FILE, "r") as f:
-            raw = json.load(f)
-        reply_map = {int(k): v for k, v in raw.items()}
-    except (FileNotFoundError, json.JSONDecodeError):
-        reply_map = {}
-
-
-def save_reply_map():
-    with open(REPLY_MAP_FILE, "w") as f:
-        json.dump(reply_map, f)
-
-
-# ==================== DATABASE ====================
-
-DB_FILE = os.path.join(DATA_DIR, "wishes.db")
-
-
-def init_db():
-    """Create tables if they don't exist."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS wishes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            user_name TEXT,
-            original_text TEXT NOT NULL,
-            metaphor TEXT,
-            source TEXT DEFAULT 'api',
-            created_at TEXT DEFAULT (datetime('now'))
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            user_name TEXT,
-            first_seen TEXT DEFAULT (datetime('now'))
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS custom_oracles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            prompt TEXT NOT NULL,
-            created_at TEXT DEFAULT (datetime('now'))
-        )
-    """)
-    # Migrations: add columns if missing
-    cursor = conn.execute("PRAGMA table_info(users)")
-    user_cols = {row[1] for row in cursor.fetchall()}
-    if "can_create_oracle" not in user_cols:
-        conn.execute("ALTER TABLE users ADD COLUMN can_create_oracle INTEGER DEFAULT 0")
-    if "active_oracle_id" not in user_cols:
-        conn.execute("ALTER TABLE users ADD COLUMN active_oracle_id INTEGER DEFAULT NULL")
-    if "tasks_completed" not in user_cols:
-        conn.execute("ALTER TABLE users ADD COLUMN tasks_completed INTEGER DEFAULT 0")
-
-    cursor = conn.execute("PRAGMA table_info(custom_oracles)")
-    oracle_cols = {row[1] for row in cursor.fetchall()}
-    if "level" not in oracle_cols:
-        conn.execute("ALTER TABLE custom_oracles ADD COLUMN level INTEGER DEFAULT 1")
-    if "uses" not in oracle_cols:
-        conn.execute("ALTER TABLE custom_oracles ADD COLUMN uses INTEGER DEFAULT 0")
-
-    conn.commit()
-    conn.close()
-
-
-def register_user(user_id: int, user_name: str):
-    """Register user for daily prompts."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        "INSERT OR IGNORE INTO users (user_id, user_name) VALUES (?, ?)",
-        (user_id, user_name),
-    )
-    conn.commit()
-    conn.close()
-
-
-def get_all_users() -> list[int]:
-    """Get all registered user IDs."""
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute("SELECT user_id FROM users").fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-
-def save_wish(user_id: int | None, user_name: str, original_text: str,
-              metaphor: str | None, source: str = "api"):
-    """Save a wish to the database."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        "INSERT INTO wishes (user_id, user_name, original_text, metaphor, source) "
-        "VALUES (?, ?, ?, ?, ?)",
-        (user_id, user_name, original_text, metaphor, source),
-    )
-    conn.commit()
-    conn.close()
-
-
-# ==================== LLM API ====================
-
-async def check_oracle_unlock(user_id: int | None):
-    """Check if user reached 3 wishes and unlock oracle creation."""
-    if not user_id:
-        return
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT can_create_oracle FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    if not row or row[0]:
-        conn.close()
-        return
-    count = conn.execute(
-        "SELECT COUNT(*) FROM wishes WHERE user_id = ?", (user_id,)
-    ).fetchone()[0]
-    if count >= 3:
-        conn.execute(
-            "UPDATE users SET can_create_oracle = 1 WHERE user_id = ?", (user_id,)
-        )
-        conn.commit()
-        conn.close()
-        try:
-            await bot.send_message(
-                user_id,
-                "🎉 <b>Ты отправил(а) 3 шифра!</b>\n"
-                "Теперь можешь создать своего Оракула — напиши /oracle",
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
-    else:
-        conn.close()
-
-
-def check_oracle_limit(user_id: int | None) -> tuple[bool, str | None]:
-    """Check if user's active custom oracle has remaining uses.
-    Returns (allowed, error_message). Standard oracle is always allowed.
-    """
-    if not user_id:
-        return True, None
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT active_oracle_id FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    if not row or not row[0]:
-        conn.close()
-        return True, None
-    oracle = conn.execute(
-        "SELECT name, level, uses FROM custom_oracles WHERE id = ?", (row[0],)
-    ).fetchone()
-    conn.close()
-    if not oracle:
-        return True, None
-    name, level, uses = oracle
-    level_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
-    max_uses = level_info["max_uses"]
-    if max_uses is not None and uses >= max_uses:
-        safe_name = html_mod.escape(name)
-        return False, (
-            f"🔒 Оракул «{safe_name}» достиг лимита ({uses}/{max_uses}) на уровне {level}.\n"
-            f"Шифр будет отправлен через стандартного Оракула."
-        )
-    return True, None
-
-
-async def increment_oracle_use(user_id: int | None):
-    """Increment use counter for user's active oracle and check level-up."""
-    if not user_id:
-        return
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT active_oracle_id FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    if not row or not row[0]:
-        conn.close()
-        return
-    oracle_id = row[0]
-    conn.execute(
-        "UPDATE custom_oracles SET uses = uses + 1 WHERE id = ?", (oracle_id,)
-    )
-    oracle = conn.execute(
-        "SELECT name, level, uses FROM custom_oracles WHERE id = ?", (oracle_id,)
-    ).fetchone()
-    conn.commit()
-    if not oracle:
-        conn.close()
-        return
-    name, level, uses = oracle
-    safe_name = html_mod.escape(name)
-    if level == 1 and uses >= 3:
-        # Check if user already has enough tasks for level 3
-        user_row = conn.execute(
-            "SELECT tasks_completed FROM users WHERE user_id = ?", (user_id,)
-        ).fetchone()
-        tasks = user_row[0] if user_row else 0
-        new_level = 3 if tasks >= 2 else 2
-        conn.execute(
-            "UPDATE custom_oracles SET level = ? WHERE id = ?",
-            (new_level, oracle_id),
-        )
-        conn.commit()
-        conn.close()
-        try:
-            if new_level == 3:
-                await bot.send_message(
-                    user_id,
-                    f"⬆️ <b>Оракул «{safe_name}» сразу достиг уровня 3 — Великий!</b>\n"
-                    f"Безлимитные запросы!",
-                    parse_mode="HTML",
-                )
-            else:
-                await bot.send_message(
-                    user_id,
-                    f"⬆️ <b>Оракул «{safe_name}» достиг уровня 2 — Мастер!</b>\n"
-                    f"Теперь доступно до 10 запросов.",
-                    parse_mode="HTML",
-                )
-        except Exception:
-            pass
-    else:
-        conn.close()
-
-
-def get_limit_hit_keyboard() -> InlineKeyboardMarkup:
-    """Keyboard shown when oracle limit is reached."""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="↩️ Переключить на стандартного",
-            callback_data="oracle_reset_standard",
-        )],
-        [InlineKeyboardButton(
-            text="📋 Мои оракулы",
-            callback_data="oracle_list",
-        )],
-    ])
-
-
-def get_user_oracle_prompt(user_id: int | None) -> str | None:
-    """Get the active custom oracle prompt for a user, or None for default."""
-    if not user_id:
-        return None
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT active_oracle_id FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    if not row or not row[0]:
-        conn.close()
-        return None
-    oracle_row = conn.execute(
-        "SELECT prompt FROM custom_oracles WHERE id = ?", (row[0],)
-    ).fetchone()
-    conn.close()
-    return oracle_row[0] if oracle_row else None
-
-
-async def call_llm(text: str, user_id: int | None = None) -> str | None:
-    """Call Gemini API to metaphorically rephrase a wish."""
-    if not GEMINI_API_KEY:
-        return None
-
-    try:
-        from google import genai
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        custom_prompt = get_user_oracle_prompt(user_id)
-        prompt = custom_prompt if custom_prompt else get_llm_prompt()
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=LLM_MODEL,
-            contents=f"{prompt}\n\nЖелание: {text}",
-        )
-        result = response.text
-        return result.strip() if result else None
-    except Exception as e:
-        print(f"LLM call failed: {e}")
-        return None
-
-
-
-async def generate_oracle_prompt(description: str) -> str | None:
-    """Use LLM to generate a system prompt from a user description."""
-    if not GEMINI_API_KEY:
-        return None
-    try:
-        from google import genai
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        meta_prompt = (
-            "Ты — генератор системных промптов для Оракула Шкатулки Желаний.\n"
-            "Оракул получает желание и должен зашифровать его в метафору-загадку.\n\n"
-            "Пользователь хочет Оракула с таким характером:\n"
-            f"{description}\n\n"
-            "Напиши системный промпт для этого Оракула. Промпт должен:\n"
-            "- Описать характер и стиль речи Оракула\n"
-            "- Содержать правила: 1-2 предложения, метафоры вместо прямых слов, "
-            "сохранять направление (для себя/для другого), только фраза без пояснений, русский язык\n"
-            "- Быть готовым к использованию как system prompt\n\n"
-            "Ответь ТОЛЬКО текстом промпта, без пояснений."
-        )
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=LLM_MODEL,
-            contents=meta_prompt,
-        )
-        result = response.text
-        return result.strip() if result else None
-    except Exception as e:
-        print(f"Generate oracle prompt failed: {e}")
-        return None
-
-
-# ==================== AIOHTTP WEB SERVER ====================
-
-@middleware
-async def cors_middleware(request, handler):
-    if request.method == "OPTIONS":
-        response = web.Response(status=200)
-    else:
-        try:
-            response = await handler(request)
-        except web.HTTPException as e:
-            response = e
-
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    response.headers["Access-Control-Max-Age"] = "3600"
-    return response
-
-
-async def handle_wish(request):
-    """API endpoint: receive wish, call LLM, return metaphor, notify admin."""
-    try:
-        data = await request.json()
-    except Exception:
-        return web.json_response({"error": "Invalid JSON"}, status=400)
-
-    text = data.get("text", "").strip()
-    uid = data.get("uid")
-
-    if not text:
-        return web.json_response({"error": "Empty wish"}, status=400)
-
-    if len(text) > 500:
-        return web.json_response({"error": "Too long"}, status=400)
-
-    # Extract user info
-    user_name = "Аноним"
-    try:
-        user_id = int(uid) if uid else None
-    except (ValueError, TypeError):
-        user_id = None
-
-    # Get user name via Bot API
-    if user_id:
-        try:
-            chat = await bot.get_chat(user_id)
-            user_name = chat.full_name or chat.username or "Аноним"
-        except Exception:
-            pass
-
-    # Check oracle limit — fallback to standard if exceeded
-    allowed, limit_msg = check_oracle_limit(user_id)
-    if not allowed:
-        if user_id:
-            try:
-                limit_kb = get_limit_hit_keyboard()
-                await bot.send_message(
-                    user_id, limit_msg,
-                    parse_mode="HTML", reply_markup=limit_kb,
-                )
-            except Exception:
-                pass
-
-    # Call LLM (if limit hit, pass user_id=None to force standard oracle)
-    metaphor = await call_llm(text, user_id=user_id if allowed else None)
-    if metaphor is None:
-        return web.json_response({"error": "Oracle unavailable"}, status=503)
-
-    # Save to database
-    save_wish(user_id, user_name, text, metaphor, source="api")
-
-    # Increment oracle use counter + check level-up
-    if allowed:
-        await increment_oracle_use(user_id)
-
-    # Check oracle unlock
-    await check_oracle_unlock(user_id)
-
-    # Send metaphor to user in bot chat
-    if user_id:
-        try:
-            safe_metaphor = html_mod.escape(metaphor)
-            await bot.send_message(
-                user_id,
-                f"🔮 <b>Оракул передал шифр Люту:</b>\n\n"
-                f"<i>{safe_metaphor}</i>",
-                parse_mode="HTML",
-            )
-        except Exception as e:
-            print(f"Failed to notify user: {e}")
-
-    # Send to admin
-    if ADMIN_ID:
-        try:
-            safe_name = html_mod.escape(user_name)
-            safe_metaphor = html_mod.escape(metaphor)
-            safe_text = html_mod.escape(text)
-            await bot.send_message(
-                ADMIN_ID,
-                f"🔮 <b>Новое желание из Шкатулки!</b>\n\n"
-                f"👤 От: <b>{safe_name}</b>\n\n"
-                f"✨ <b>Метафора:</b>\n<i>{safe_metaphor}</i>",
-                parse_mode="HTML",
-            )
-        except Exception as e:
-            print(f"Failed to notify admin: {e}")
-
-    return web.json_response({"metaphor": metaphor})
-
-
-async def handle_oracles(request):
-    """API endpoint: return user's oracles and active oracle."""
-    uid = request.query.get("uid")
-    if not uid:
-        return web.json_response({"error": "Missing uid"}, status=400)
-    try:
-        user_id = int(uid)
-    except (ValueError, TypeError):
-        return web.json_response({"error": "Invalid uid"}, status=400)
-
-    conn = sqlite3.connect(DB_FILE)
-    oracles = conn.execute(
-        "SELECT id, name, level, uses FROM custom_oracles WHERE user_id = ? ORDER BY id",
-        (user_id,),
-    ).fetchall()
-    user_row = conn.execute(
-        "SELECT active_oracle_id, can_create_oracle FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    wishes_count = conn.execute(
-        "SELECT COUNT(*) FROM wishes WHERE user_id = ?", (user_id,)
-    ).fetchone()[0]
-    conn.close()
-
-    active_id = user_row[0] if user_row and user_row[0] else None
-    can_create = bool(user_row[1]) if user_row else False
-    oracle_list = []
-    for oid, name, level, uses in oracles:
-        lvl_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
-        oracle_list.append({
-            "id": oid,
-            "name": name,
-            "level": level,
-            "uses": uses,
-            "max_uses": lvl_info["max_uses"],
-            "level_name": lvl_info["name"],
-        })
-
-    return web.json_response({
-        "oracles": oracle_list,
-        "active_id": active_id,
-        "can_create": can_create,
-        "wishes_count": wishes_count,
-    })
-
-
-async def handle_oracle_select(request):
-    """API endpoint: switch user's active oracle."""
-    try:
-        data = await request.json()
-    except Exception:
-        return web.json_response({"error": "Invalid JSON"}, status=400)
-
-    uid = data.get("uid")
-    oracle_id = data.get("oracle_id")
-    if uid is None:
-        return web.json_response({"error": "Missing uid"}, status=400)
-    try:
-        user_id = int(uid)
-    except (ValueError, TypeError):
-        return web.json_response({"error": "Invalid uid"}, status=400)
-
-    conn = sqlite3.connect(DB_FILE)
-    if oracle_id is None or oracle_id == 0:
-        conn.execute(
-            "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
-            (user_id,),
-        )
-        conn.commit()
-        conn.close()
-        return web.json_response({"ok": True, "active_id": None})
-
-    try:
-        oracle_id = int(oracle_id)
-    except (ValueError, TypeError):
-        conn.close()
-        return web.json_response({"error": "Invalid oracle_id"}, status=400)
-
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    if not row:
-        conn.close()
-        return web.json_response({"error": "Oracle not found"}, status=404)
-
-    conn.execute(
-        "UPDATE users SET active_oracle_id = ? WHERE user_id = ?",
-        (oracle_id, user_id),
-    )
-    conn.commit()
-    conn.close()
-    return web.json_response({"ok": True, "active_id": oracle_id})
-
-
-def create_app():
-    app = web.Application(middlewares=[cors_middleware])
-    app.router.add_post("/api/wish", handle_wish)
-    app.router.add_get("/api/oracles", handle_oracles)
-    app.router.add_post("/api/oracle/select", handle_oracle_select)
-    return app
-
-
-# ==================== BOT HANDLERS ====================
-
-def get_webapp_url(user_id: int = None):
-    """Build webapp URL with API base and user_id parameters."""
-    url = WEBAPP_URL
-    if API_BASE_URL:
-        sep = "&" if "?" in url else "?"
-        url += f"{sep}api={API_BASE_URL}"
-    if user_id:
-        sep = "&" if "?" in url else "?"
-        url += f"{sep}uid={user_id}"
-    return url
-
-
-def get_certificate_url():
-    """Derive certificate URL from webapp URL."""
-    if "index.html" in WEBAPP_URL:
-        return WEBAPP_URL.replace("index.html", "certificate.html")
-    url = WEBAPP_URL.rstrip("/")
-    return url + "/certificate.html"
-
-
-@dp.message(CommandStart())
-async def cmd_start(message: types.Message):
-    user = message.from_user
-    register_user(user.id, user.full_name or user.username or "Аноним")
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(
-                    text="🔮 Шкатулка Желаний",
-                    web_app=WebAppInfo(url=get_webapp_url(message.from_user.id)),
-                )
-            ],
-            [
-                KeyboardButton(
-                    text="🎁 Мой сертификат",
-                    web_app=WebAppInfo(url=get_certificate_url()),
-                )
-            ],
-        ],
-        resize_keyboard=True,
-    )
-    await message.answer(
-        "✨ <b>Привет!</b>\n\n"
-        "Добро пожаловать в <b>Клуб Подпольных Авантюристов</b>.\n\n"
-        "🔮 <b>Шкатулка Желаний</b> — нашепчи своё желание,\n"
-        "оракул превратит его в загадку и отправит Люту.\n\n"
-        "🎁 <b>Сертификат</b> — твой подарок на массаж.\n\n"
-        "📋 <b>Команды:</b>\n"
-        "/help — справка\n"
-        "/oracle — управление Оракулами\n\n"
-        "Выбирай 👇",
-        reply_markup=kb,
-        parse_mode="HTML",
-    )
-
-    if ADMIN_ID:
-        user = message.from_user
-        name = html_mod.escape(user.full_name or user.username or "Неизвестный")
-        username = f" (@{user.username})" if user.username else ""
-        await bot.send_message(
-            ADMIN_ID,
-            f"👀 <b>{name}</b>{username} запустил(а) бота\n"
-            f"ID: <code>{user.id}</code>",
-            parse_mode="HTML",
-        )
-
-
-@dp.message(F.web_app_data)
-async def on_web_app_data(message: types.Message):
-    try:
-        data = json.loads(message.web_app_data.data)
-    except (json.JSONDecodeError, AttributeError):
-        return
-
-    action = data.get("action")
-
-    if action == "activate":
-        # Certificate activation (legacy)
-        await message.answer(
-            "🎉 <b>Сертификат успешно активирован!</b>\n\n"
-            "Теперь выбери удобную дату для массажа 👇",
-            reply_markup=build_dates_keyboard(),
-            parse_mode="HTML",
-        )
-        if ADMIN_ID:
-            user = message.from_user
-            name = html_mod.escape(user.full_name or user.username or "Неизвестный")
-            await bot.send_message(
-                ADMIN_ID,
-                f"🔔 <b>{name}</b> активировала сертификат на массаж!",
-                parse_mode="HTML",
-            )
-
-    elif action == "wish":
-        # Fallback: wish sent via sendData (no API server available)
-        text = data.get("text", "").strip()
-        if not text:
-            return
-
-        await message.answer(
-            "🔮 <b>Оракул получил твоё желание!</b>\n"
-            "Зашифровываю...",
-            parse_mode="HTML",
-        )
-
-        # Check oracle limit
-        uid = message.from_user.id
-        allowed, limit_msg = check_oracle_limit(uid)
-        if not allowed:
-            limit_kb = get_limit_hit_keyboard()
-            await message.answer(limit_msg, parse_mode="HTML", reply_markup=limit_kb)
-
-        metaphor = await call_llm(text, user_id=uid if allowed else None)
-
-        # Save to database
-        user = message.from_user
-        save_wish(
-            user.id,
-            user.full_name or user.username or "Аноним",
-            text, metaphor, source="sendData",
-        )
-
-        # Increment oracle use counter + check level-up
-        if allowed:
-            await increment_oracle_use(user.id)
-
-        # Check oracle unlock
-        await check_oracle_unlock(user.id)
-
-        if metaphor:
-            safe_metaphor = html_mod.escape(metaphor)
-            await message.answer(
-                f"✨ <b>Оракул говорит:</b>\n\n"
-                f"<i>{safe_metaphor}</i>\n\n"
-                f"Отправлено Люту!",
-                parse_mode="HTML",
-            )
-            if ADMIN_ID:
-                user = message.from_user
-                name = html_mod.escape(user.full_name or user.username or "Неизвестная")
-                safe_text = html_mod.escape(text)
-                sent = await bot.send_message(
-                    ADMIN_ID,
-                    f"🔮 <b>Новое желание из Шкатулки!</b>\n\n"
-                    f"👤 От: <b>{name}</b>\n\n"
-                    f"✨ <b>Метафора:</b>\n<i>{safe_metaphor}</i>",
-                    parse_mode="HTML",
-                )
-                reply_map[sent.message_id] = message.from_user.id
-                save_reply_map()
-        else:
-            await message.answer(
-                "😔 Оракул сейчас медитирует. Попробуй позже!",
-                parse_mode="HTML",
-            )
-
-
-def build_dates_keyboard() -> InlineKeyboardMarkup:
-    dates = [
-        ("28 марта", "2026-03-28"),
-        ("7 марта", "2026-03-07"),
-        ("26 марта (особенно:))", "2026-03-26"),
-    ]
-    buttons = [
-        [InlineKeyboardButton(text=f"📅 {label}", callback_data=f"date:{value}")]
-        for label, value in dates
-    ]
-    buttons.append(
-        [InlineKeyboardButton(text="✍️ Написать Люту (он ждёт)", callback_data="date:custom")]
-    )
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-
-@dp.callback_query(F.data.startswith("date:"))
-async def on_date_selected(callback: types.CallbackQuery):
-    raw = callback.data.split(":", 1)[1]
-
-    if raw == "custom":
-        write_mode.add(callback.from_user.id)
-        await callback.message.answer(
-            "✍️ <b>Напиши что угодно</b> — Лют получит твоё сообщение!\n\n"
-            "(секретная связь)\n\n"
-            "<i>Кнопки с датами всё ещё доступны выше ☝️</i>",
-            parse_mode="HTML",
-        )
-        await callback.answer()
-        return
-
-    try:
-        d = datetime.strptime(raw, "%Y-%m-%d")
-        pretty = d.strftime("%d.%m.%Y (%A)")
-    except ValueError:
-        pretty = raw
-
-    await callback.message.edit_text(
-        f"✅ <b>Отлично!</b>\n\n"
-        f"Ты записана на <b>{pretty}</b>.\n\n"
-        f"Они сошлись. Волна и камень. Стихи и проза, лед и пламень.",
-        parse_mode="HTML",
-    )
-
-    if ADMIN_ID:
-        user = callback.from_user
-        name = html_mod.escape(user.full_name or user.username or "Неизвестный")
-        sent = await bot.send_message(
-            ADMIN_ID,
-            f"📋 <b>{name}</b> выбрала дату массажа: <b>{pretty}</b>",
-            parse_mode="HTML",
-        )
-        reply_map[sent.message_id] = callback.from_user.id
-        save_reply_map()
-
-    await callback.answer("Записано!")
-
-
-@dp.message(Command("send"), F.from_user.id == ADMIN_ID)
-async def cmd_send(message: types.Message):
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2:
-        await message.reply("Формат: /send <chat_id> [текст]\nИли: /send <chat_id> + реплай на контент")
-        return
-
-    try:
-        target_chat_id = int(parts[1].split()[0])
-    except ValueError:
-        await message.reply("Неверный chat_id")
-        return
-
-    text_after_id = parts[1].split(maxsplit=1)[1] if len(parts[1].split()) > 1 else None
-
-    if text_after_id:
-        sent = await bot.send_message(target_chat_id, text_after_id)
-        reply_map[message.message_id] = target_chat_id
-        save_reply_map()
-        await message.reply(f"✅ Отправлено в чат {target_chat_id}")
-    elif message.reply_to_message:
-        await message.reply_to_message.copy_to(target_chat_id)
-        reply_map[message.message_id] = target_chat_id
-        save_reply_map()
-        await message.reply(f"✅ Контент отправлен в чат {target_chat_id}")
-    else:
-        await message.reply("Добавь текст после chat_id или реплайни на сообщение с контентом")
-
-
-@dp.message(F.reply_to_message, F.from_user.id == ADMIN_ID)
-async def on_admin_reply(message: types.Message):
-    replied_id = message.reply_to_message.message_id
-    user_chat_id = reply_map.get(replied_id)
-    if not user_chat_id:
-        return
-
-    await message.copy_to(user_chat_id)
-    await message.reply("✅ Отправлено!")
-
-
-@dp.message(Command("prompt"), F.from_user.id == ADMIN_ID)
-async def cmd_prompt(message: types.Message):
-    """Admin sends a prompt to all users right now."""
-    text = message.text.split(maxsplit=1)
-    if len(text) < 2:
-        await message.reply("Формат: /prompt текст подсказки")
-        return
-
-    prompt_text = text[1].strip()
-    users = [uid for uid in get_all_users() if uid != ADMIN_ID]
-    if not users:
-        await message.reply("Нет зарегистрированных юзеров.")
-        return
-
-    sent = 0
-    for uid in users:
-        try:
-            await bot.send_message(uid, prompt_text, parse_mode="HTML")
-            sent += 1
-        except Exception:
-            pass
-    await message.reply(f"✅ Отправлено {sent} юзерам")
-
-
-@dp.message(Command("wish"), F.from_user.id == ADMIN_ID)
-async def cmd_admin_wish(message: types.Message):
-    """Admin sends a wish to a specific user — Oracle encrypts it."""
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 3:
-        await message.reply("Формат: /wish &lt;user_id&gt; текст желания")
-        return
-
-    try:
-        target_id = int(parts[1])
-    except ValueError:
-        await message.reply("Неверный user_id")
-        return
-
-    wish_text = parts[2].strip()
-    admin_id = message.from_user.id
-
-    # Check admin's oracle limit
-    allowed, limit_msg = check_oracle_limit(admin_id)
-    if not allowed:
-        await message.reply(f"{limit_msg}\nИспользую стандартного.", parse_mode="HTML")
-
-    await message.reply("🔮 Зашифровываю...")
-
-    metaphor = await call_llm(wish_text, user_id=admin_id if allowed else None)
-    if not metaphor:
-        await message.reply("😔 Оракул сейчас медитирует.")
-        return
-
-    # Increment admin's oracle use
-    if allowed:
-        await increment_oracle_use(admin_id)
-
-    safe_metaphor = html_mod.escape(metaphor)
-
-    # Get oracle name if admin uses a custom oracle
-    oracle_label = "Оракул"
-    if allowed:
-        conn = sqlite3.connect(DB_FILE)
-        arow = conn.execute(
-            "SELECT active_oracle_id FROM users WHERE user_id = ?", (admin_id,)
-        ).fetchone()
-        if arow and arow[0]:
-            orow = conn.execute(
-                "SELECT name FROM custom_oracles WHERE id = ?", (arow[0],)
-            ).fetchone()
-            if orow:
-                oracle_label = f"Оракул «{html_mod.escape(orow[0])}»"
-        conn.close()
-
-    try:
-        await bot.send_message(
-            target_id,
-            f"🔮 <b>{oracle_label} передаёт шифр от Люта:</b>\n\n"
-            f"<i>{safe_metaphor}</i>",
-            parse_mode="HTML",
-        )
-        await message.reply(
-            f"✅ Отправлено!\n\n"
-            f"<b>Метафора:</b>\n<i>{safe_metaphor}</i>",
-            parse_mode="HTML",
-        )
-    except Exception as e:
-        await message.reply(f"Не удалось отправить: {e}")
-
-
-@dp.message(Command("help"))
-async def cmd_help(message: types.Message):
-    """Show help — different output for admin vs regular user."""
-    text = (
-        "🔮 <b>Шкатулка Желаний — помощь</b>\n\n"
-        "/help — эта справка\n"
-        "/oracle — управление своими Оракулами\n"
-    )
-    if message.from_user.id == ADMIN_ID:
-        text += (
-            "\n👑 <b>Команды админа:</b>\n"
-            "/wish &lt;user_id&gt; текст — отправить шифр юзеру\n"
-            "/prompt текст — отправить подсказку всем\n"
-            "/send &lt;chat_id&gt; текст — отправить сообщение\n"
-            "/grant &lt;user_id&gt; — дать доступ к созданию Оракула\n"
-            "/taskdone &lt;user_id&gt; — засчитать задание юзеру\n"
-        )
-    await message.answer(text, parse_mode="HTML")
-
-
-@dp.message(Command("grant"), F.from_user.id == ADMIN_ID)
-async def cmd_grant(message: types.Message):
-    """Admin grants oracle creation access to a user."""
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2:
-        await message.reply("Формат: /grant &lt;user_id&gt;", parse_mode="HTML")
-        return
-    try:
-        target_id = int(parts[1].strip())
-    except ValueError:
-        await message.reply("Неверный user_id")
-        return
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.execute(
-        "UPDATE users SET can_create_oracle = 1 WHERE user_id = ?", (target_id,)
-    )
-    conn.commit()
-    if cursor.rowcount == 0:
-        conn.close()
-        await message.reply("❌ Юзер не найден в базе (не запускал бота)")
-        return
-    conn.close()
-    await message.reply(f"✅ Доступ к созданию Оракула выдан для {target_id}")
-    try:
-        await bot.send_message(
-            target_id,
-            "🎉 <b>Тебе открыт доступ к созданию своего Оракула!</b>\n"
-            "Напиши /oracle чтобы начать.",
-            parse_mode="HTML",
-        )
-    except Exception:
-        pass
-
-
-@dp.message(Command("taskdone"), F.from_user.id == ADMIN_ID)
-async def cmd_taskdone(message: types.Message):
-    """Admin confirms a user completed a task. 2 tasks → level 3 for all oracles."""
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2:
-        await message.reply("Формат: /taskdone &lt;user_id&gt;", parse_mode="HTML")
-        return
-    try:
-        target_id = int(parts[1].strip())
-    except ValueError:
-        await message.reply("Неверный user_id")
-        return
-
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT tasks_completed FROM users WHERE user_id = ?", (target_id,)
-    ).fetchone()
-    if not row:
-        conn.close()
-        await message.reply("❌ Юзер не найден в базе")
-        return
-    old_count = row[0]
-    new_count = old_count + 1
-    conn.execute(
-        "UPDATE users SET tasks_completed = ? WHERE user_id = ?",
-        (new_count, target_id),
-    )
-
-    upgraded = 0
-    if new_count >= 2:
-        cursor = conn.execute(
-            "UPDATE custom_oracles SET level = 3 WHERE user_id = ? AND level = 2",
-            (target_id,),
-        )
-        upgraded = cursor.rowcount
-
-    conn.commit()
-    conn.close()
-
-    await message.reply(f"✅ Задание засчитано для {target_id} ({new_count}/2)")
-
-    try:
-        if new_count >= 2 and old_count < 2 and upgraded > 0:
-            await bot.send_message(
-                target_id,
-                "🏆 <b>Ты выполнил(а) 2 задания!</b>\n"
-                "Все твои оракулы достигли уровня 3 — <b>безлимит!</b>",
-                parse_mode="HTML",
-            )
-        elif new_count >= 2 and old_count < 2:
-            await bot.send_message(
-                target_id,
-                "🏆 <b>Ты выполнил(а) 2 задания!</b>\n"
-                "Новые оракулы уровня 2 будут автоматически прокачаны до уровня 3.",
-                parse_mode="HTML",
-            )
-        elif new_count < 2:
-            await bot.send_message(
-                target_id,
-                f"🎉 <b>Задание засчитано!</b> ({new_count}/2)\n"
-                "Ещё одно — и твои оракулы получат безлимит!",
-                parse_mode="HTML",
-            )
-        else:
-            await bot.send_message(
-                target_id,
-                f"🎉 <b>Задание засчитано!</b> ({new_count} выполнено)",
-                parse_mode="HTML",
-            )
-    except Exception:
-        pass
-
-
-def get_oracle_list_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Build inline keyboard with user's oracles + create button."""
-    conn = sqlite3.connect(DB_FILE)
-    oracles = conn.execute(
-        "SELECT id, name, level, uses FROM custom_oracles WHERE user_id = ? ORDER BY id",
-        (user_id,),
-    ).fetchall()
-    active_row = conn.execute(
-        "SELECT active_oracle_id FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    conn.close()
-    active_id = active_row[0] if active_row and active_row[0] else None
-
-    buttons = []
-    for oid, name, level, uses in oracles:
-        marker = " ✅" if oid == active_id else ""
-        lvl_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
-        max_u = lvl_info["max_uses"]
-        lvl_name = lvl_info["name"]
-        progress = f"{uses}/∞" if max_u is None else f"{uses}/{max_u}"
-        # Row 1: info + select
-        buttons.append([
-            InlineKeyboardButton(
-                text=f"🔮 {name}{marker} — {lvl_name} {progress}",
-                callback_data=f"oracle_select:{oid}",
-            ),
-        ])
-        # Row 2: actions
-        buttons.append([
-            InlineKeyboardButton(text="👁", callback_data=f"oracle_info:{oid}"),
-            InlineKeyboardButton(text="✏️", callback_data=f"oracle_edit:{oid}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"oracle_delete:{oid}"),
-        ])
-    if active_id:
-        buttons.append([
-            InlineKeyboardButton(
-                text="↩️ Стандартный Оракул",
-                callback_data="oracle_select:0",
-            )
-        ])
-    buttons.append([
-        InlineKeyboardButton(text="➕ Создать нового", callback_data="oracle_create")
-    ])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-
-@dp.message(Command("oracle"))
-async def cmd_oracle(message: types.Message):
-    """Show user's custom oracles."""
-    user_id = message.from_user.id
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT can_create_oracle FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    conn.close()
-
-    if not row or (not row[0] and user_id != ADMIN_ID):
-        await message.answer(
-            "🔒 Создание Оракулов пока недоступно.\n"
-            "Отправь 3 шифра через Шкатулку, чтобы разблокировать!"
-        )
-        return
-
-    kb = get_oracle_list_keyboard(user_id)
-    await message.answer(
-        "🔮 <b>Твои Оракулы</b>\n\n"
-        "Выбери активного или создай нового:\n\n"
-        "📊 <b>Прокачка оракулов:</b>\n"
-        "▫️ Лвл 1 (Новичок) → макс 3 запроса\n"
-        "▫️ Лвл 2 (Мастер) → макс 10 запросов\n"
-        "▫️ Лвл 3 (Великий) → безлимит ∞\n\n"
-        "⬆️ <b>Как прокачать:</b>\n"
-        "• Лвл 1 → 2: используй любого оракула 3 раза\n"
-        "• Лвл 2 → 3: выполни 2 задания от Оракула",
-        reply_markup=kb,
-        parse_mode="HTML",
-    )
-
-
-@dp.callback_query(F.data == "oracle_create")
-async def on_oracle_create(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT can_create_oracle FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    conn.close()
-    if not row or (not row[0] and user_id != ADMIN_ID):
-        await callback.answer("🔒 Нет доступа", show_alert=True)
-        return
-
-    oracle_create_mode[user_id] = "awaiting_name"
-    oracle_draft[user_id] = {}
-    await callback.message.answer(
-        "✍️ <b>Как назвать Оракула?</b>\n\n"
-        "Например: Нерд, Поэт, Пират\n\n"
-        "<i>Напиши «отмена» чтобы отменить</i>",
-        parse_mode="HTML",
-    )
-    await callback.answer()
-
-
-@dp.callback_query(F.data.startswith("oracle_select:"))
-async def on_oracle_select(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    if oracle_id == 0:
-        conn.execute(
-            "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
-            (user_id,),
-        )
-        conn.commit()
-        conn.close()
-        await callback.answer("✅ Стандартный Оракул активирован")
-        kb = get_oracle_list_keyboard(user_id)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=kb)
-        except Exception:
-            pass
-        return
-    # Verify oracle belongs to user
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    if not row:
-        conn.close()
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    conn.execute(
-        "UPDATE users SET active_oracle_id = ? WHERE user_id = ?",
-        (oracle_id, user_id),
-    )
-    conn.commit()
-    conn.close()
-    await callback.answer(f"✅ Оракул «{row[0]}» активирован")
-    kb = get_oracle_list_keyboard(user_id)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        pass
-
-
-@dp.callback_query(F.data.startswith("oracle_delete:"))
-async def on_oracle_delete(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    conn.close()
-    if not row:
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text=f"🗑 Да, удалить «{row[0]}»",
-            callback_data=f"oracle_confirm_delete:{oracle_id}",
-        )],
-        [InlineKeyboardButton(
-            text="↩️ Отмена",
-            callback_data="oracle_cancel_delete",
-        )],
-    ])
-    try:
-        await callback.message.edit_reply_markup(reply_markup=confirm_kb)
-    except Exception:
-        pass
-    await callback.answer()
-
-
-@dp.callback_query(F.data.startswith("oracle_confirm_delete:"))
-async def on_oracle_confirm_delete(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    if not row:
-        conn.close()
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    conn.execute("DELETE FROM custom_oracles WHERE id = ?", (oracle_id,))
-    conn.execute(
-        "UPDATE users SET active_oracle_id = NULL WHERE user_id = ? AND active_oracle_id = ?",
-        (user_id, oracle_id),
-    )
-    conn.commit()
-    conn.close()
-    await callback.answer(f"🗑 Оракул «{row[0]}» удалён")
-    kb = get_oracle_list_keyboard(user_id)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        pass
-
-
-@dp.callback_query(F.data == "oracle_cancel_delete")
-async def on_oracle_cancel_delete(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    kb = get_oracle_list_keyboard(user_id)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        pass
-    await callback.answer("Отменено")
-
-
-@dp.callback_query(F.data == "oracle_reset_standard")
-async def on_oracle_reset_standard(callback: types.CallbackQuery):
-    """Switch to standard oracle from the limit-hit keyboard."""
-    user_id = callback.from_user.id
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
-        (user_id,),
-    )
-    conn.commit()
-    conn.close()
-    try:
-        await callback.message.edit_text(
-            "✅ Переключено на стандартного Оракула.",
-        )
-    except Exception:
-        pass
-    await callback.answer("✅ Стандартный Оракул активирован")
-
-
-@dp.callback_query(F.data == "oracle_list")
-async def on_oracle_list(callback: types.CallbackQuery):
-    """Show oracle list from the limit-hit keyboard."""
-    user_id = callback.from_user.id
-    kb = get_oracle_list_keyboard(user_id)
-    await callback.message.answer(
-        "🔮 <b>Твои Оракулы</b>\n\nВыбери активного:",
-        reply_markup=kb,
-        parse_mode="HTML",
-    )
-    await callback.answer()
-
-
-@dp.callback_query(F.data.startswith("oracle_edit:"))
-async def on_oracle_edit(callback: types.CallbackQuery):
-    """Enter edit mode for an oracle via inline button."""
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    conn.close()
-    if not row:
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    safe_name = html_mod.escape(row[0])
-    oracle_create_mode[user_id] = "awaiting_edit_description"
-    oracle_draft[user_id] = {"oracle_id": oracle_id}
-    await callback.message.answer(
-        f"✏️ <b>Редактирование оракула «{safe_name}»</b>\n\n"
-        "Опиши новый характер оракула.\n"
-        "Например: <i>«саркастичный философ, который цитирует Ницше»</i>\n\n"
-        "<i>Напиши «отмена» чтобы отменить</i>",
-        parse_mode="HTML",
-    )
-    await callback.answer()
-
-
-@dp.callback_query(F.data.startswith("oracle_info:"))
-async def on_oracle_info(callback: types.CallbackQuery):
-    """Show oracle prompt preview as alert popup."""
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name, prompt FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    conn.close()
-    if not row:
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    name, prompt = row
-    header = f"🔮 «{name}»:\n"
-    max_preview = 200 - len(header)
-    preview = prompt[:max_preview - 3] + "..." if len(prompt) > max_preview else prompt
-    await callback.answer(header + preview, show_alert=True)
-
-
-@dp.callback_query(F.data.startswith("oracle_activate:"))
-async def on_oracle_activate_after_create(callback: types.CallbackQuery):
-    """Activate oracle right after creation."""
-    user_id = callback.from_user.id
-    oracle_id = int(callback.data.split(":")[1])
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    if not row:
-        conn.close()
-        await callback.answer("Оракул не найден", show_alert=True)
-        return
-    conn.execute(
-        "UPDATE users SET active_oracle_id = ? WHERE user_id = ?",
-        (oracle_id, user_id),
-    )
-    conn.commit()
-    conn.close()
-    safe_name = html_mod.escape(row[0])
-    await callback.message.edit_text(
-        f"✅ Оракул «{safe_name}» создан и активирован!",
-        parse_mode="HTML",
-    )
-    await callback.answer()
-
-
-@dp.callback_query(F.data == "oracle_activate_no")
-async def on_oracle_activate_no(callback: types.CallbackQuery):
-    await callback.message.edit_text(
-        "✅ Оракул создан, но не активирован.\n"
-        "Выбрать его можно в /oracle",
-        parse_mode="HTML",
-    )
-    await callback.answer()
-
-
-@dp.message(Command("editoracle"))
-async def cmd_editoracle(message: types.Message):
-    """Edit an existing oracle: /editoracle <id> новое описание"""
-    user_id = message.from_user.id
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 3:
-        await message.reply(
-            "Формат: /editoracle &lt;id&gt; новое описание",
-            parse_mode="HTML",
-        )
-        return
-    try:
-        oracle_id = int(parts[1])
-    except ValueError:
-        await message.reply("Неверный id оракула")
-        return
-    description = parts[2].strip()
-    conn = sqlite3.connect(DB_FILE)
-    row = conn.execute(
-        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
-        (oracle_id, user_id),
-    ).fetchone()
-    if not row:
-        conn.close()
-        await message.reply("Оракул не найден")
-        return
-    conn.close()
-    await message.reply("🔄 Пересоздаю промпт...")
-    new_prompt = await generate_oracle_prompt(description)
-    if not new_prompt:
-        await message.reply("😔 Не удалось сгенерировать промпт. Попробуй позже.")
-        return
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        "UPDATE custom_oracles SET prompt = ? WHERE id = ? AND user_id = ?",
-        (new_prompt, oracle_id, user_id),
-    )
-    conn.commit()
-    conn.close()
-    safe_name = html_mod.escape(row[0])
-    await message.reply(
-        f"✅ Оракул «{safe_name}» обновлён!",
-        parse_mode="HTML",
-    )
-
-
-@dp.message(F.text, ~F.text.startswith("/"))
-@dp.message(~F.content_type.in_({"web_app_data"}), ~F.text)
-async def on_user_message(message: types.Message):
-    user_id = message.from_user.id
-
-    # Handle oracle creation flow
-    if user_id in oracle_create_mode and message.text:
-        if message.text.strip().lower() in ("отмена", "cancel", "/cancel"):
-            del oracle_create_mode[user_id]
-            oracle_draft.pop(user_id, None)
-            await message.answer("❌ Создание оракула отменено.")
-            return
-
-        mode = oracle_create_mode[user_id]
-
-        if mode == "awaiting_name":
-            name = message.text.strip()
-            if len(name) > 50:
-                await message.answer("Слишком длинное имя. Максимум 50 символов.")
-                return
-            oracle_draft[user_id] = {"name": name}
-            oracle_create_mode[user_id] = "awaiting_description"
-            safe_name = html_mod.escape(name)
-            await message.answer(
-                f"👍 Оракул будет называться <b>«{safe_name}»</b>\n\n"
-                "Теперь опиши, какой он должен быть.\n"
-                "Например: <i>«дерзкий технический нерд, который всё объясняет через код»</i>",
-                parse_mode="HTML",
-            )
-            return
-
-        if mode == "awaiting_description":
-            description = message.text.strip()
-            draft = oracle_draft.get(user_id, {})
-            oracle_name = draft.get("name", "Оракул")
-            safe_name = html_mod.escape(oracle_name)
-
-            await message.answer(f"🔮 Создаю Оракула <b>«{safe_name}»</b>...", parse_mode="HTML")
-            prompt = await generate_oracle_prompt(description)
-            if not prompt:
-                await message.answer("😔 Не удалось создать Оракула. Попробуй ещё раз.")
-                del oracle_create_mode[user_id]
-                oracle_draft.pop(user_id, None)
-                return
-
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.execute(
-                "INSERT INTO custom_oracles (user_id, name, prompt) VALUES (?, ?, ?)",
-                (user_id, oracle_name, prompt),
-            )
-            new_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
-
-            del oracle_create_mode[user_id]
-            oracle_draft.pop(user_id, None)
-
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="✅ Да, сделать активным",
-                        callback_data=f"oracle_activate:{new_id}",
-                    ),
-                    InlineKeyboardButton(
-                        text="Нет",
-                        callback_data="oracle_activate_no",
-                    ),
-                ]
-            ])
-            await message.answer(
-                f"✅ Оракул <b>«{safe_name}»</b> создан!\n\n"
-                "Хочешь сделать его активным?",
-                reply_markup=kb,
-                parse_mode="HTML",
-            )
-            return
-
-        if mode == "awaiting_edit_description":
-            description = message.text.strip()
-            draft = oracle_draft.get(user_id, {})
-            oracle_id = draft.get("oracle_id")
-            if not oracle_id:
-                del oracle_create_mode[user_id]
-                oracle_draft.pop(user_id, None)
-                return
-
-            await message.answer("🔄 Пересоздаю промпт...")
-            new_prompt = await generate_oracle_prompt(description)
-            if not new_prompt:
-                await message.answer("😔 Не удалось сгенерировать. Попробуй позже.")
-                del oracle_create_mode[user_id]
-                oracle_draft.pop(user_id, None)
-                return
-
-            conn = sqlite3.connect(DB_FILE)
-            conn.execute(
-                "UPDATE custom_oracles SET prompt = ? WHERE id = ? AND user_id = ?",
-                (new_prompt, oracle_id, user_id),
-            )
-            conn.commit()
-            conn.close()
-
-            del oracle_create_mode[user_id]
-            oracle_draft.pop(user_id, None)
-            await message.answer("✅ Оракул обновлён!")
-            return
-
-    if user_id == ADMIN_ID:
-        return
-
-    user = message.from_user
-    name = html_mod.escape(user.full_name or user.username or "Неизвестный")
-
-    if user.id in write_mode:
-        write_mode.discard(user.id)
-
-    if ADMIN_ID:
-        await bot.send_message(
-            ADMIN_ID,
-            f"💬 <b>{name}:</b>\n<i>↩️ Ответь реплаем на сообщение ниже — она получит</i>",
-            parse_mode="HTML",
-        )
-        forwarded = await message.forward(ADMIN_ID)
-        reply_map[forwarded.message_id] = message.from_user.id
-        save_reply_map()
-
-    await message.answer("✅ Сообщение отправлено Люту!")
-
-
-# ==================== MAIN ====================
-
-async def main():
-    load_reply_map()
-    init_db()
-
-    # Start aiohttp API server
-    app = create_app()
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", API_PORT)
-    await site.start()
-    print(f"API server started on 0.0.0.0:{API_PORT}")
-
-    # Start bot polling
-    print("Bot started")
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await runner.cleanup()
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
+import asyncio
+import functools
+import gzip
+import hashlib
+import html as html_mod
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+from aiohttp.web import middleware
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandStart, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.types import (
+    BufferedInputFile,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    WebAppInfo,
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+
+try:
+    import brotli
+except ImportError:   # optional: gzip only
+    brotli = None
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+WEBAPP_URL = os.getenv("WEBAPP_URL", "")
+API_BASE_URL = os.getenv("API_BASE_URL", "")
+API_PORT = int(os.getenv("API_PORT", "8069"))
+# Serve webapp/ from the API server at /app/ (precompressed, hashed assets)
+WEBAPP_SERVE = os.getenv("WEBAPP_SERVE", "").lower() in ("1", "true", "yes")
+WEBAPP_DIR = Path(__file__).resolve().parent / "webapp"
+if WEBAPP_SERVE and not WEBAPP_URL:
+    WEBAPP_URL = f"{API_BASE_URL.rstrip('/')}/app/"
+# >0: serve the API from this many processes sharing API_PORT (SO_REUSEPORT);
+# the main process then only handles bot updates and background work
+API_WORKERS = int(os.getenv("API_WORKERS", "0"))
+# Webhook mode: set WEBHOOK_URL (public https base) to receive updates on the
+# API server instead of long polling. With API_WORKERS the main process
+# receives them on its own WEBHOOK_PORT; route WEBHOOK_PATH there.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or API_PORT + 1)
+# Same value on every instance; derived from the bot token when unset
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(
+    f"webhook:{BOT_TOKEN}".encode()
+).hexdigest()
+WEBAPP_WISH_MODE = os.getenv("WEBAPP_WISH_MODE", "")   # stream | job | sync
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("LLM_API_KEY", "")
+# Key for the OpenAI-compatible endpoint; never prefer a leftover Gemini key
+LLM_API_KEY = os.getenv("LLM_API_KEY") or os.getenv("GEMINI_API_KEY", "")
+LLM_API_URL = os.getenv("LLM_API_URL", "").rstrip("/")
+LLM_BACKEND = os.getenv("LLM_BACKEND") or ("openai" if LLM_API_URL else "gemini")
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_HEDGE_ATTEMPTS = int(os.getenv("LLM_HEDGE_ATTEMPTS", "2"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Bot API server; override to use a local Bot API server or a fake one
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    if TELEGRAM_API_URL else None,
+)
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+os.makedirs(DATA_DIR, exist_ok=True)
+
+REPLY_MAP_FILE = os.path.join(DATA_DIR, "reply_map.json")  # legacy, migrated into the DB
+REPLY_MAP_TTL = int(os.getenv("REPLY_MAP_TTL_DAYS", "30")) * 86400
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL_HOURS", "24")) * 3600
+WISH_JOB_TTL = int(os.getenv("WISH_JOB_TTL_HOURS", "24")) * 3600
+WISH_JOB_MAX_WAIT = 30   # seconds a GET /api/wish/{id} may long-poll
+WISH_JOB_POLL = 0.5      # re-check interval for jobs run by another process
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "4"))
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_LEASE = 60        # seconds a claimed message is hidden from other senders
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))   # messages per second
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_BATCH = 500
+BROADCAST_PROGRESS_INTERVAL = 5   # seconds between admin progress updates
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "").lower() in ("1", "true", "yes")
+TRACE_BUFFER_SIZE = 1000   # recent wish traces kept for /traces
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")   # if set, /metrics needs "Bearer <token>"
+NAME_CACHE_SIZE = 10_000
+NAME_CACHE_TTL = 3600    # seconds before a cached display name is re-read
+# Log callbacks that block the event loop longer than this (ms); 0 = off
+SLOW_CALLBACK_MS = float(os.getenv("SLOW_CALLBACK_MS", "100"))
+PROFILE_INTERVAL = 0.005   # seconds between /profile stack samples
+PROFILE_MAX_SECONDS = 300
+
+
+class WriteForm(StatesGroup):
+    writing = State()          # picked "write to Lyut" on the dates keyboard
+
+
+class OracleForm(StatesGroup):
+    awaiting_name = State()
+    awaiting_description = State()        # data: {"name": ...}
+    awaiting_edit_description = State()   # data: {"oracle_id": ...}
+
+ORACLE_LEVELS = {
+    1: {"max_uses": 3,    "name": "Новичок"},
+    2: {"max_uses": 10,   "name": "Мастер"},
+    3: {"max_uses": None, "name": "Великий"},   # безлимит
+}
+
+LLM_BASE_PROMPT = """Ты — Оракул Шкатулки Желаний. Твоя задача — зашифровать желание так, чтобы его нужно было РАЗГАДАТЬ.
+
+ЗАДАЧА: Замаскируй желание — замени ключевые слова на неожиданные образы. Получатель должен подумать, прежде чем поймёт о чём речь.
+
+ПРИМЕР:
+Желание: "хочу посмотреть тебе в глаза"
+ПЛОХО: "Хочу погрузиться в твои глаза, как искатель сокровищ" — это НЕ загадка, тут прямо написано "глаза"
+ХОРОШО: "Мечтаю нырнуть в две кроличьи норы, где вместо часов тикают секреты" — тут надо догадаться что "две кроличьи норы" = глаза
+
+ПРАВИЛА:
+- 1-2 предложения, не больше
+- НИКОГДА не используй слова из оригинального желания — заменяй их метафорами
+- Сохраняй направление: для себя / для другого
+- Образы из сказок, мифов, природы, космоса — но неожиданные
+- Суть должна угадываться, но не сразу — это загадка, а не пересказ
+- ТОЛЬКО фраза, без пояснений, кавычек и вступлений
+- Язык: русский"""
+
+LLM_STYLE_PROMPTS = [
+    ("""Ты — Оракул Шкатулки Желаний. Дерзкий, горячий, без стеснения.
+
+ЗАДАЧА: Перефразируй желание в пошловато-сексуальную метафору с двусмысленностью и жаром.
+
+ПРАВИЛА:
+- 1-2 предложения, не больше
+- Сохраняй направление: если автор хочет что-то ДЛЯ СЕБЯ — фраза про автора. Если хочет СДЕЛАТЬ ДРУГОМУ — фраза про получателя.
+- Пиши горячо, с откровенным подтекстом — но через метафору, не в лоб
+- Образы: плавящийся шоколад, раскалённый песок, мокрые губы, шёлк на коже, запотевшие окна
+- Двусмысленность на максимум — пусть щёки горят при чтении
+- Суть желания должна считываться сквозь жар
+- ТОЛЬКО фраза, без пояснений, кавычек и вступлений
+- Язык: русский""", 20),
+]
+
+def get_llm_prompt() -> str:
+    """Pick a prompt: base (80%) or random rare style (20%)."""
+    roll = random.randint(1, 100)
+    threshold = 0
+    for prompt, weight in LLM_STYLE_PROMPTS:
+        threshold += weight
+        if roll <= threshold:
+            return prompt
+    return LLM_BASE_PROMPT
+
+
+# ==================== METRICS ====================
+# Prometheus text format at GET /metrics. Recording is a dict lookup and a
+# bisect into fixed buckets, cheap enough for every request and query.
+# With API_WORKERS every process stores a snapshot of its metrics in the
+# DB every few seconds and /metrics on any worker returns all of them with
+# a "worker" label (main, api-0, api-1, ...), so each series stays
+# monotonic whichever worker the scrape lands on.
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5)
+
+METRICS: list = []
+METRICS_SNAPSHOT_INTERVAL = 5   # seconds between stored snapshots (API_WORKERS)
+METRICS_SNAPSHOT_TTL = 60       # a process silent this long drops out of /metrics
+metrics_worker = "main"         # "worker" label of this process
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: dict[tuple, float] = {} if labels else {(): 0}
+        METRICS.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self) -> list:
+        return [[list(labels), count] for labels, count in self.values.items()]
+
+    def render(self, workers: dict[str, list] | None = None) -> list[str]:
+        """This process's values, or every worker's snapshot with a worker label."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        names, items = self.labels, self.values.items()
+        if workers is not None:
+            names = ("worker", *self.labels)
+            items = [((w, *labels), c) for w, series in workers.items() for labels, c in series]
+        for values, count in sorted(items):
+            lines.append(f"{self.name}{format_labels(names, values)} {count}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        self.series: dict[tuple, list] = {}
+        METRICS.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def snapshot(self) -> list:
+        return [[list(labels), series] for labels, series in self.series.items()]
+
+    def render(self, workers: dict[str, list] | None = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names, items = self.labels, self.series.items()
+        if workers is not None:
+            names = ("worker", *self.labels)
+            items = [((w, *labels), s) for w, series in workers.items() for labels, s in series]
+        for values, (counts, total) in sorted(items):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = format_labels(names, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_str = format_labels(names, values)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+def render_metrics(snapshots: dict[str, dict] | None = None) -> str:
+    """Prometheus text; snapshots (worker -> metric name -> series) adds a worker label."""
+    lines = []
+    for metric in METRICS:
+        workers = None
+        if snapshots is not None:
+            workers = {w: snapshot.get(metric.name, []) for w, snapshot in snapshots.items()}
+        lines.extend(metric.render(workers))
+    return "\n".join(lines) + "\n"
+
+
+async def store_metrics_snapshot():
+    data = json.dumps({metric.name: metric.snapshot() for metric in METRICS})
+    await db.execute(
+        "INSERT OR REPLACE INTO metrics_snapshots (worker, data, updated_at) VALUES (?, ?, ?)",
+        (metrics_worker, data, time.time()),
+        name="store_metrics_snapshot",
+    )
+
+
+async def metrics_snapshot_loop():
+    while True:
+        try:
+            await store_metrics_snapshot()
+        except Exception as e:
+            print(f"Failed to store metrics snapshot: {e}")
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+
+async def load_metrics_snapshots() -> dict[str, dict]:
+    """Every live process's metrics, this one's as of now."""
+    await store_metrics_snapshot()
+    rows = await db.fetchall(
+        "SELECT worker, data FROM metrics_snapshots WHERE updated_at > ? ORDER BY worker",
+        (time.time() - METRICS_SNAPSHOT_TTL,),
+        name="load_metrics_snapshots",
+    )
+    return {worker: json.loads(data) for worker, data in rows}
+
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "API request time, end to end",
+    ("route", "method", "status"),
+)
+llm_request_seconds = Histogram(
+    "llm_request_duration_seconds", "LLM call time per oracle type",
+    ("oracle", "outcome"),
+)
+db_query_seconds = Histogram(
+    "db_query_duration_seconds", "Time on the DB thread per helper",
+    ("helper",), DB_BUCKETS,
+)
+telegram_request_seconds = Histogram(
+    "telegram_request_duration_seconds", "Bot API call time", ("method",),
+)
+telegram_errors = Counter(
+    "telegram_errors_total", "Failed Bot API calls", ("method", "error"),
+)
+oracle_limit_hits = Counter("oracle_limit_hits_total", "Wishes that hit an oracle use limit")
+oracle_unlocks = Counter("oracle_unlocks_total", "Users who unlocked oracle creation")
+oracle_level_ups = Counter("oracle_level_ups_total", "Oracle level-ups", ("level",))
+rate_limited = Counter("rate_limited_total", "Requests rejected with 429", ("route",))
+event_loop_stalls = Counter(
+    "event_loop_stalls_total", "Event loop blocked longer than SLOW_CALLBACK_MS",
+    ("function",),
+)
+
+
+# ==================== TRACES ====================
+# Each /api/wish request records a span per pipeline stage (DB helpers,
+# LLM queue wait and call, Bot API calls). The stages are returned in a
+# Server-Timing header and the trace goes into a ring buffer of recent
+# wishes; the admin's /traces shows the slowest of them. With API_WORKERS
+# the ring is kept in the traces table, since /traces runs in the main
+# process and the wishes are served by the workers.
+
+
+@dataclass
+class Trace:
+    name: str
+    started: float                       # time.monotonic()
+    wall: float                          # time.time(), for display
+    user_id: int | None = None
+    spans: list = field(default_factory=list)   # (name, offset, duration), seconds
+    total: float = 0.0
+    detached: bool = False               # finished by a background job, not the request
+
+    def add(self, name: str, started: float):
+        self.spans.append((name, started - self.started, time.monotonic() - started))
+
+    def server_timing(self) -> str:
+        stages: dict[str, float] = {}
+        for name, _, duration in self.spans:
+            stages[name] = stages.get(name, 0.0) + duration
+        total = self.total or time.monotonic() - self.started
+        stages["total"] = total
+        return ", ".join(f"{name};dur={d * 1000:.1f}" for name, d in stages.items())
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+recent_traces: deque[Trace] = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+@contextmanager
+def trace_span(name: str):
+    """Record the enclosed block as a span of the current trace, if any."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, started)
+
+
+def finish_trace(trace: Trace):
+    trace.total = time.monotonic() - trace.started
+    recent_traces.append(trace)
+    if API_WORKERS:
+        spawn(store_trace(trace))
+
+
+def _store_trace(conn: sqlite3.Connection, data: str, total: float):
+    cursor = conn.execute("INSERT INTO traces (total, data) VALUES (?, ?)", (total, data))
+    conn.execute("DELETE FROM traces WHERE id <= ?", (cursor.lastrowid - TRACE_BUFFER_SIZE,))
+
+
+async def store_trace(trace: Trace):
+    current_trace.set(None)   # the insert is not a span of the trace itself
+    try:
+        await db.run(_store_trace, json.dumps(asdict(trace)), trace.total)
+    except Exception as e:
+        print(f"Failed to store trace: {e}")
+
+
+async def slowest_traces(n: int) -> tuple[list[Trace], int]:
+    """The n slowest recent traces and how many recent traces there are."""
+    if not API_WORKERS:
+        traces = sorted(recent_traces, key=lambda t: t.total, reverse=True)[:n]
+        return traces, len(recent_traces)
+    rows = await db.fetchall(
+        "SELECT data FROM traces ORDER BY total DESC LIMIT ?", (n,), name="slowest_traces",
+    )
+    count = (await db.fetchone("SELECT COUNT(*) FROM traces", name="slowest_traces"))[0]
+    return [Trace(**json.loads(data)) for (data,) in rows], count
+
+
+def format_trace(trace: Trace) -> str:
+    when = datetime.fromtimestamp(trace.wall).strftime("%d.%m %H:%M:%S")
+    lines = [f"{when} {trace.name} uid={trace.user_id} {trace.total * 1000:.0f}ms"]
+    for name, offset, duration in trace.spans:
+        lines.append(f"  +{offset * 1000:6.0f}ms {duration * 1000:7.1f}ms {name}")
+    return "\n".join(lines)
+
+
+# ==================== PROFILING ====================
+# /profile N samples the stacks of every thread of the bot process (event
+# loop, DB thread, executors) for N seconds and sends them back in the
+# collapsed format flamegraph.pl / speedscope read. The loop watchdog is
+# always on: a thread notices when the loop stops ticking for longer than
+# SLOW_CALLBACK_MS and logs the function it is stuck in.
+
+# Innermost frames of a thread that is waiting for work, not doing any
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+}
+
+
+def frame_label(frame) -> str:
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})"
+
+
+def collapse_stack(frame) -> list[str]:
+    """Function labels from the outermost frame to frame."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL) -> tuple[dict, int, int]:
+    """Sample all other threads; returns (collapsed stack -> count, samples, idle samples)."""
+    me = threading.get_ident()
+    stacks: dict[str, int] = {}
+    samples = idle = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            samples += 1
+            if is_idle(frame):
+                idle += 1
+                continue
+            key = ";".join([names.get(ident, str(ident))] + collapse_stack(frame))
+            stacks[key] = stacks.get(key, 0) + 1
+        time.sleep(interval)
+    return stacks, samples, idle
+
+
+def summarize_profile(stacks: dict[str, int], top: int = 8) -> list[tuple[str, int]]:
+    """Busiest innermost bot.py functions (else innermost frame) by sample count."""
+    own: dict[str, int] = {}
+    for key, count in stacks.items():
+        frames = key.split(";")[1:]
+        ours = [f for f in frames if f.endswith("(bot.py)")]
+        label = ours[-1] if ours else frames[-1]
+        own[label] = own.get(label, 0) + count
+    return sorted(own.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+_profile_lock = asyncio.Lock()
+
+
+async def run_profile(seconds: float) -> tuple[dict, int, int]:
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+
+    def _run():
+        try:
+            value = sample_stacks(seconds)
+        except Exception as e:
+            loop.call_soon_threadsafe(result.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(result.set_result, value)
+
+    # Own thread rather than the default executor, which it would then sample
+    threading.Thread(target=_run, name="profiler", daemon=True).start()
+    return await result
+
+
+class LoopWatchdog:
+    """Logs the function the event loop is stuck in when it stops ticking."""
+
+    def __init__(self, threshold_ms: float):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self._last_tick = time.monotonic()
+        self._stop = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._tick()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _tick(self):
+        self._last_tick = time.monotonic()
+        if not self._stop.is_set():
+            self._loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        stalled_since = None
+        where = stack = None
+        while not self._stop.wait(self.interval):
+            last = self._last_tick
+            if stalled_since is not None and last > stalled_since:
+                blocked = last - stalled_since - self.interval
+                event_loop_stalls.inc(where)
+                print(f"Event loop blocked {blocked * 1000:.0f}ms in {where}\n  "
+                      + " <- ".join(reversed(stack[-6:])))
+                stalled_since = None
+            if stalled_since is None and time.monotonic() - last > self.threshold + self.interval:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                stalled_since = last
+                stack = collapse_stack(frame)
+                ours = [f for f in stack if f.endswith("(bot.py)")]
+                where = ours[-1] if ours else stack[-1]
+
+
+def start_loop_watchdog() -> LoopWatchdog | None:
+    if SLOW_CALLBACK_MS <= 0:
+        return None
+    watchdog = LoopWatchdog(SLOW_CALLBACK_MS)
+    watchdog.start(asyncio.get_running_loop())
+    return watchdog
+
+
+# ==================== DATABASE ====================
+
+DB_FILE = os.path.join(DATA_DIR, "wishes.db")
+
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+class Database:
+    """Long-lived SQLite connection owned by a single dedicated thread.
+
+    All queries run on that thread, so the event loop never blocks on disk
+    I/O. The sqlite3 statement cache keeps hot queries prepared between calls.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path, check_same_thread=False, cached_statements=256,
+            )
+            for pragma in DB_PRAGMAS:
+                conn.execute(pragma)
+            self._conn = conn
+        return self._conn
+
+    def _call(self, helper: str, fn, *args):
+        conn = self._connection()
+        started = time.perf_counter()
+        try:
+            with conn:
+                return fn(conn, *args)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - started, helper)
+
+    async def _submit(self, helper: str, fn, *args):
+        loop = asyncio.get_running_loop()
+        with trace_span(f"db.{helper}"):
+            return await loop.run_in_executor(
+                self._executor, functools.partial(self._call, helper, fn, *args),
+            )
+
+    # name labels the query in metrics and traces, by convention the
+    # function that issues it
+    async def run(self, fn, *args, name: str | None = None):
+        """Run fn(conn, *args) on the DB thread inside one transaction."""
+        return await self._submit(name or fn.__name__, fn, *args)
+
+    async def execute(self, sql: str, params=(), *, name: str) -> sqlite3.Cursor:
+        return await self._submit(name, lambda conn: conn.execute(sql, params))
+
+    async def fetchone(self, sql: str, params=(), *, name: str):
+        return await self._submit(name, lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=(), *, name: str) -> list:
+        return await self._submit(name, lambda conn: conn.execute(sql, params).fetchall())
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, _close)
+        self._executor.shutdown(wait=True)
+
+
+db = Database(DB_FILE)
+
+
+def _create_schema(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wishes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_name TEXT,
+            original_text TEXT NOT NULL,
+            metaphor TEXT,
+            source TEXT DEFAULT 'api',
+            created_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            user_name TEXT,
+            first_seen TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS custom_oracles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            created_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    # Migrations: add columns if missing
+    cursor = conn.execute("PRAGMA table_info(users)")
+    user_cols = {row[1] for row in cursor.fetchall()}
+    if "can_create_oracle" not in user_cols:
+        conn.execute("ALTER TABLE users ADD COLUMN can_create_oracle INTEGER DEFAULT 0")
+    if "active_oracle_id" not in user_cols:
+        conn.execute("ALTER TABLE users ADD COLUMN active_oracle_id INTEGER DEFAULT NULL")
+    if "tasks_completed" not in user_cols:
+        conn.execute("ALTER TABLE users ADD COLUMN tasks_completed INTEGER DEFAULT 0")
+
+    cursor = conn.execute("PRAGMA table_info(custom_oracles)")
+    oracle_cols = {row[1] for row in cursor.fetchall()}
+    if "level" not in oracle_cols:
+        conn.execute("ALTER TABLE custom_oracles ADD COLUMN level INTEGER DEFAULT 1")
+    if "uses" not in oracle_cols:
+        conn.execute("ALTER TABLE custom_oracles ADD COLUMN uses INTEGER DEFAULT 0")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reply_map (
+            message_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_reply_map_created ON reply_map (created_at)"
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at)"
+    )
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wish_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            user_name TEXT,
+            text TEXT NOT NULL,
+            allowed INTEGER NOT NULL DEFAULT 1,
+            reservation TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            metaphor TEXT,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            worker TEXT
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_wish_jobs_status ON wish_jobs (status, updated_at)"
+    )
+    # Process running the job, so a restarted API worker's jobs can be adopted
+    cursor = conn.execute("PRAGMA table_info(wish_jobs)")
+    if "worker" not in {row[1] for row in cursor.fetchall()}:
+        conn.execute("ALTER TABLE wish_jobs ADD COLUMN worker TEXT")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            reply_target INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox (next_attempt_at)"
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            admin_chat_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS traces (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            total REAL NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_snapshots (
+            worker TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+    # Indexes: per-user lookups must not scan the whole table
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_wishes_user ON wishes (user_id, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_custom_oracles_user "
+        "ON custom_oracles (user_id, id, name, level, uses)"
+    )
+
+    # Denormalized wish counter, kept in sync by save_wish
+    if "wishes_count" not in user_cols:
+        conn.execute("ALTER TABLE users ADD COLUMN wishes_count INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            "UPDATE users SET wishes_count = "
+            "(SELECT COUNT(*) FROM wishes WHERE wishes.user_id = users.user_id)"
+        )
+
+    # Per-user version of everything /api/bootstrap returns (its ETag).
+    # Bumped by triggers so no code path can forget it.
+    if "version" not in user_cols:
+        conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_version
+        AFTER UPDATE OF active_oracle_id, can_create_oracle, wishes_count ON users
+        BEGIN
+            UPDATE users SET version = version + 1 WHERE user_id = NEW.user_id;
+        END
+    """)
+    for event, ref in (("INSERT", "NEW"), ("DELETE", "OLD"),
+                       ("UPDATE OF name, level, uses", "NEW")):
+        name = event.split()[0].lower()
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_custom_oracles_{name}_version
+            AFTER {event} ON custom_oracles
+            BEGIN
+                UPDATE users SET version = version + 1 WHERE user_id = {ref}.user_id;
+            END
+        """)
+
+
+async def init_db():
+    """Create tables if they don't exist."""
+    await db.run(_create_schema)
+
+
+async def register_user(user_id: int, user_name: str):
+    """Register user for daily prompts."""
+    await db.execute(
+        "INSERT OR IGNORE INTO users (user_id, user_name) VALUES (?, ?)",
+        (user_id, user_name),
+        name="register_user",
+    )
+
+
+def _import_reply_map_file(conn: sqlite3.Connection):
+    """One-time import of the legacy reply_map.json into the reply_map table."""
+    try:
+        with open(REPLY_MAP_FILE, "r") as f:
+            raw = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO reply_map (message_id, chat_id, created_at) VALUES (?, ?, ?)",
+        [(int(k), v, now) for k, v in raw.items()],
+    )
+    os.replace(REPLY_MAP_FILE, REPLY_MAP_FILE + ".migrated")
+
+
+async def save_reply_target(message_id: int, chat_id: int):
+    """Remember which user chat an admin-side message belongs to."""
+    await db.execute(
+        "INSERT OR REPLACE INTO reply_map (message_id, chat_id, created_at) VALUES (?, ?, ?)",
+        (message_id, chat_id, int(time.time())),
+        name="save_reply_target",
+    )
+
+
+async def get_reply_target(message_id: int) -> int | None:
+    """User chat for an admin-side message, unless the mapping has expired."""
+    row = await db.fetchone(
+        "SELECT chat_id FROM reply_map WHERE message_id = ? AND created_at >= ?",
+        (message_id, int(time.time()) - REPLY_MAP_TTL),
+        name="get_reply_target",
+    )
+    return row[0] if row else None
+
+
+def _expire_stale_rows(conn: sqlite3.Connection):
+    now = int(time.time())
+    conn.execute("DELETE FROM reply_map WHERE created_at < ?", (now - REPLY_MAP_TTL,))
+    conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (now - FSM_STATE_TTL,))
+    conn.execute(
+        "DELETE FROM wish_jobs WHERE status != 'pending' AND updated_at < ?",
+        (now - WISH_JOB_TTL,),
+    )
+
+
+async def expire_stale_rows_loop(interval: float = 3600):
+    """Periodically drop expired reply mappings and abandoned FSM states."""
+    while True:
+        try:
+            await db.run(_expire_stale_rows)
+        except Exception as e:
+            print(f"Expiry of stale rows failed: {e}")
+        await asyncio.sleep(interval)
+
+
+# ==================== FSM STORAGE ====================
+
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage in the fsm_state table.
+
+    States idle for longer than ttl seconds read back as empty and are
+    purged by expire_stale_rows_loop.
+    """
+
+    def __init__(self, database: Database, ttl: int = FSM_STATE_TTL):
+        self.db = database
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    async def _load(self, key: StorageKey) -> tuple[str | None, dict]:
+        row = await self.db.fetchone(
+            "SELECT state, data FROM fsm_state WHERE key = ? AND updated_at >= ?",
+            (self._key(key), int(time.time()) - self.ttl),
+            name="fsm_load",
+        )
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    async def _store(self, key: StorageKey, column: str, value):
+        k = self._key(key)
+        now = int(time.time())
+
+        def _write(conn):
+            conn.execute(
+                "DELETE FROM fsm_state WHERE key = ? AND updated_at < ?", (k, now - self.ttl),
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO fsm_state (key, updated_at) VALUES (?, ?)", (k, now),
+            )
+            conn.execute(
+                f"UPDATE fsm_state SET {column} = ?, updated_at = ? WHERE key = ?",
+                (value, now, k),
+            )
+            # Nothing left to remember — keep the table bounded
+            conn.execute(
+                "DELETE FROM fsm_state WHERE key = ? AND state IS NULL AND data = '{}'",
+                (k,),
+            )
+
+        await self.db.run(_write, name="fsm_store")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._store(key, "state", value)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        await self._store(key, "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, data = await self._load(key)
+        return data
+
+    async def close(self) -> None:
+        pass
+
+
+dp = Dispatcher(storage=SQLiteStorage(db))
+
+
+# ==================== OUTBOX ====================
+# Bot messages that nobody has to wait for are written to the outbox table
+# (in the same transaction as the change they announce) and delivered by
+# background senders with retries, so Telegram latency and outages stay off
+# the request path and a crash does not lose them.
+
+outbox_wakeup = asyncio.Event()
+_outbox_paused_until = 0.0   # set from Telegram's RetryAfter, shared by all senders
+
+
+def _enqueue_message(conn: sqlite3.Connection, chat_id: int, text: str,
+                     parse_mode: str | None = "HTML",
+                     reply_markup: InlineKeyboardMarkup | None = None,
+                     reply_target: int | None = None):
+    """reply_target: once sent, admin replies to the message go to this chat."""
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    conn.execute(
+        "INSERT INTO outbox (chat_id, text, parse_mode, reply_markup, reply_target, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (chat_id, text, parse_mode, markup, reply_target, int(time.time())),
+    )
+
+
+async def enqueue_message(chat_id: int, text: str, parse_mode: str | None = "HTML",
+                          reply_markup: InlineKeyboardMarkup | None = None,
+                          reply_target: int | None = None):
+    """Queue a bot message for background delivery."""
+    await db.run(_enqueue_message, chat_id, text, parse_mode, reply_markup, reply_target)
+    outbox_wakeup.set()
+
+
+def _claim_outbox_message(conn: sqlite3.Connection):
+    now = time.time()
+    return conn.execute(
+        "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? "
+        "WHERE id = (SELECT id FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT 1) "
+        "RETURNING id, chat_id, text, parse_mode, reply_markup, reply_target, attempts",
+        (now + OUTBOX_LEASE, now),
+    ).fetchone()
+
+
+async def _deliver_outbox_message(row):
+    global _outbox_paused_until
+    msg_id, chat_id, text, parse_mode, markup, reply_target, attempts = row
+    try:
+        sent = await bot.send_message(
+            chat_id, text, parse_mode=parse_mode,
+            reply_markup=InlineKeyboardMarkup.model_validate_json(markup) if markup else None,
+        )
+    except TelegramRetryAfter as e:
+        # Flood control applies to the whole bot: pause every sender
+        _outbox_paused_until = time.monotonic() + e.retry_after
+        await db.execute(
+            "UPDATE outbox SET attempts = attempts - 1, next_attempt_at = ? WHERE id = ?",
+            (time.time() + e.retry_after, msg_id),
+            name="_deliver_outbox_message",
+        )
+        return
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        print(f"Outbox message to {chat_id} dropped: {e}")
+    except Exception as e:
+        if attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = min(2 ** attempts, 300)
+            print(f"Outbox message to {chat_id} failed ({e}), retry in {delay}s")
+            await db.execute(
+                "UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                (time.time() + delay, msg_id),
+                name="_deliver_outbox_message",
+            )
+            return
+        print(f"Outbox message to {chat_id} dropped after {attempts} attempts: {e}")
+    else:
+        if reply_target:
+            await save_reply_target(sent.message_id, reply_target)
+    await db.execute(
+        "DELETE FROM outbox WHERE id = ?", (msg_id,), name="_deliver_outbox_message",
+    )
+
+
+async def outbox_sender(poll_interval: float = 5.0):
+    """Deliver queued messages until cancelled."""
+    while True:
+        pause = _outbox_paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        outbox_wakeup.clear()
+        try:
+            row = await db.run(_claim_outbox_message)
+        except Exception as e:
+            print(f"Outbox claim failed: {e}")
+            row = None
+        if row is None:
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await _deliver_outbox_message(row)
+        except Exception as e:
+            # The claim lease expires and the message is retried later
+            print(f"Outbox delivery of message {row[0]} failed: {e}")
+
+
+# ==================== BROADCAST ====================
+# /prompt fans a message out to every user. Recipients are copied into
+# broadcast_recipients with one INSERT ... SELECT and then paged through by
+# user_id, so neither the user list nor the progress lives only in memory:
+# after a restart, running broadcasts continue with their pending rows.
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. on Telegram's RetryAfter)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:   # FIFO among waiters
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+
+def _create_broadcast(conn: sqlite3.Connection, text: str, admin_chat_id: int) -> tuple[int, int]:
+    broadcast_id = conn.execute(
+        "INSERT INTO broadcasts (text, admin_chat_id, created_at) VALUES (?, ?, ?)",
+        (text, admin_chat_id, int(time.time())),
+    ).lastrowid
+    total = conn.execute(
+        "INSERT INTO broadcast_recipients (broadcast_id, user_id) "
+        "SELECT ?, user_id FROM users WHERE user_id != ?",
+        (broadcast_id, ADMIN_ID),
+    ).rowcount
+    conn.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, broadcast_id))
+    return broadcast_id, total
+
+
+async def _broadcast_counts(broadcast_id: int) -> dict[str, int]:
+    rows = await db.fetchall(
+        "SELECT status, COUNT(*) FROM broadcast_recipients "
+        "WHERE broadcast_id = ? GROUP BY status",
+        (broadcast_id,),
+        name="_broadcast_counts",
+    )
+    return dict(rows)
+
+
+def format_broadcast_progress(broadcast_id: int, total: int, counts: dict[str, int],
+                              done: bool = False) -> str:
+    sent = counts.get("sent", 0)
+    failed = counts.get("failed", 0)
+    head = "✅ Рассылка завершена" if done else "📨 Рассылка идёт"
+    return (
+        f"{head} (#{broadcast_id})\n"
+        f"Отправлено: {sent} из {total}\n"
+        f"Не доставлено: {failed}"
+    )
+
+
+async def _send_broadcast_message(broadcast_id: int, text: str, user_id: int):
+    while True:
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(user_id, text, parse_mode="HTML")
+        except TelegramRetryAfter as e:
+            broadcast_bucket.pause(e.retry_after)
+            continue
+        except Exception as e:
+            status, error = "failed", str(e)[:200]
+        else:
+            status, error = "sent", None
+        break
+    await _record_broadcast_recipient(broadcast_id, user_id, status, error)
+
+
+async def _record_broadcast_recipient(broadcast_id: int, user_id: int, status: str,
+                                      error: str | None):
+    await db.execute(
+        "UPDATE broadcast_recipients SET status = ?, error = ? "
+        "WHERE broadcast_id = ? AND user_id = ?",
+        (status, error, broadcast_id, user_id),
+        name="_record_broadcast_recipient",
+    )
+
+
+async def _report_broadcast_progress(broadcast_id: int, done: bool = False):
+    row = await db.fetchone(
+        "SELECT admin_chat_id, progress_message_id, total FROM broadcasts WHERE id = ?",
+        (broadcast_id,),
+        name="_report_broadcast_progress",
+    )
+    if not row:
+        return
+    chat_id, message_id, total = row
+    text = format_broadcast_progress(
+        broadcast_id, total, await _broadcast_counts(broadcast_id), done
+    )
+    try:
+        if message_id:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        else:
+            sent = await bot.send_message(chat_id, text)
+            await db.execute(
+                "UPDATE broadcasts SET progress_message_id = ? WHERE id = ?",
+                (sent.message_id, broadcast_id),
+                name="_report_broadcast_progress",
+            )
+    except TelegramBadRequest:
+        pass   # "message is not modified"
+    except Exception as e:
+        print(f"Broadcast #{broadcast_id} progress update failed: {e}")
+
+
+async def run_broadcast(broadcast_id: int):
+    """Send a broadcast to its pending recipients, then mark it done."""
+    row = await db.fetchone(
+        "SELECT text FROM broadcasts WHERE id = ?", (broadcast_id,), name="run_broadcast",
+    )
+    if not row:
+        return
+    text = row[0]
+    recipients: asyncio.Queue[int | None] = asyncio.Queue(maxsize=BROADCAST_BATCH)
+
+    async def sender():
+        # A sender must survive any error: once all are gone, put() blocks forever
+        while (user_id := await recipients.get()) is not None:
+            try:
+                await _send_broadcast_message(broadcast_id, text, user_id)
+            except Exception as e:
+                print(f"Broadcast {broadcast_id} to {user_id} failed: {e}")
+                try:
+                    await _record_broadcast_recipient(
+                        broadcast_id, user_id, "failed", str(e)[:200],
+                    )
+                except Exception as e:
+                    print(f"Failed to record broadcast recipient: {e}")
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await _report_broadcast_progress(broadcast_id)
+
+    senders = [asyncio.create_task(sender()) for _ in range(BROADCAST_CONCURRENCY)]
+    progress = asyncio.create_task(reporter())
+    try:
+        last_id = None
+        while True:
+            rows = await db.fetchall(
+                "SELECT user_id FROM broadcast_recipients "
+                "WHERE broadcast_id = ? AND status = 'pending' AND user_id > ? "
+                "ORDER BY user_id LIMIT ?",
+                (broadcast_id, last_id if last_id is not None else -2**63, BROADCAST_BATCH),
+                name="run_broadcast",
+            )
+            if not rows:
+                break
+            for (user_id,) in rows:
+                await recipients.put(user_id)
+            last_id = rows[-1][0]
+        for _ in senders:
+            await recipients.put(None)
+        await asyncio.gather(*senders)
+    finally:
+        progress.cancel()
+        for task in senders:
+            task.cancel()
+
+    await db.execute(
+        "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?",
+        (int(time.time()), broadcast_id),
+        name="run_broadcast",
+    )
+    await _report_broadcast_progress(broadcast_id, done=True)
+
+
+async def start_broadcast(text: str, admin_chat_id: int) -> tuple[int, int]:
+    """Record a broadcast and its recipients, and start sending in the background."""
+    broadcast_id, total = await db.run(_create_broadcast, text, admin_chat_id)
+    if total:
+        spawn(run_broadcast(broadcast_id))
+    else:
+        await db.execute(
+            "UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,),
+            name="start_broadcast",
+        )
+    return broadcast_id, total
+
+
+async def resume_broadcasts():
+    """Continue broadcasts interrupted by a restart."""
+    rows = await db.fetchall(
+        "SELECT id FROM broadcasts WHERE status = 'running'", name="resume_broadcasts",
+    )
+    for (broadcast_id,) in rows:
+        spawn(run_broadcast(broadcast_id))
+    if rows:
+        print(f"Resumed {len(rows)} broadcast(s)")
+
+
+def _save_wish(conn: sqlite3.Connection, user_id: int | None, user_name: str,
+               original_text: str, metaphor: str | None, source: str):
+    conn.execute(
+        "INSERT INTO wishes (user_id, user_name, original_text, metaphor, source) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (user_id, user_name, original_text, metaphor, source),
+    )
+    if user_id:
+        # Upsert: a webapp uid may have no users row yet. A new row starts at
+        # version 1 so it cannot match the ETag of the row-less bootstrap.
+        conn.execute(
+            "INSERT INTO users (user_id, user_name, wishes_count, version) "
+            "VALUES (?, ?, 1, 1) "
+            "ON CONFLICT (user_id) DO UPDATE SET wishes_count = wishes_count + 1",
+            (user_id, user_name),
+        )
+
+
+async def save_wish(user_id: int | None, user_name: str, original_text: str,
+                    metaphor: str | None, source: str = "api"):
+    """Save a wish to the database and bump the user's wishes_count."""
+    await db.run(_save_wish, user_id, user_name, original_text, metaphor, source)
+
+
+@dataclass
+class UserContext:
+    """Everything the wish pipeline needs about a user, loaded in one query."""
+    user_id: int
+    user_name: str | None
+    can_create_oracle: bool
+    tasks_completed: int
+    wishes_count: int
+    oracle_id: int | None = None
+    oracle_name: str | None = None
+    oracle_prompt: str | None = None
+    oracle_level: int = 1
+    oracle_uses: int = 0
+
+
+USER_CONTEXT_SQL = """
+    SELECT u.user_id, u.user_name, u.can_create_oracle, u.tasks_completed,
+           u.wishes_count, o.id, o.name, o.prompt, o.level, o.uses
+    FROM users u
+    LEFT JOIN custom_oracles o ON o.id = u.active_oracle_id
+    WHERE u.user_id = ?
+"""
+
+
+async def load_user_context(user_id: int | None) -> UserContext | None:
+    """Load user + active oracle + wish count. None for unknown users."""
+    if not user_id:
+        return None
+    row = await db.fetchone(USER_CONTEXT_SQL, (user_id,), name="load_user_context")
+    if not row:
+        return None
+    (uid, user_name, can_create, tasks, wishes_count,
+     oracle_id, oracle_name, oracle_prompt, level, uses) = row
+    return UserContext(
+        user_id=uid,
+        user_name=user_name,
+        can_create_oracle=bool(can_create),
+        tasks_completed=tasks or 0,
+        wishes_count=wishes_count,
+        oracle_id=oracle_id,
+        oracle_name=oracle_name,
+        oracle_prompt=oracle_prompt,
+        oracle_level=level or 1,
+        oracle_uses=uses or 0,
+    )
+
+
+# ==================== NAME CACHE ====================
+# Display names for notifications. users.user_name is kept current from the
+# from_user of incoming updates, so the wish path never asks the Bot API.
+
+
+class NameCache:
+    """LRU of user_id -> display name with a TTL per entry."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    def get(self, user_id: int) -> str | None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return name
+
+    def put(self, user_id: int, name: str):
+        self._entries[user_id] = (name, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+name_cache = NameCache(NAME_CACHE_SIZE, NAME_CACHE_TTL)
+
+
+def display_name(user: types.User) -> str:
+    return user.full_name or user.username or "Аноним"
+
+
+async def get_display_name(user_id: int | None, ctx: UserContext | None = None) -> str:
+    """Cached name, else users.user_name (from ctx if already loaded)."""
+    if not user_id:
+        return "Аноним"
+    name = name_cache.get(user_id)
+    if name is not None:
+        return name
+    if ctx is not None:
+        name = ctx.user_name
+    else:
+        row = await db.fetchone(
+            "SELECT user_name FROM users WHERE user_id = ?", (user_id,),
+            name="get_display_name",
+        )
+        name = row[0] if row else None
+    if not name:
+        return "Аноним"
+    name_cache.put(user_id, name)
+    return name
+
+
+async def remember_user_name(user: types.User):
+    """Refresh the stored name when a user's Telegram name changed."""
+    name = display_name(user)
+    if name_cache.get(user.id) == name:
+        return
+    name_cache.put(user.id, name)
+    await db.execute(
+        "UPDATE users SET user_name = ? WHERE user_id = ? AND user_name IS NOT ?",
+        (name, user.id, name),
+        name="remember_user_name",
+    )
+
+
+@dp.update.outer_middleware()
+async def user_name_middleware(handler, event: types.Update, data: dict):
+    user = data.get("event_from_user")
+    if user and not user.is_bot:
+        try:
+            await remember_user_name(user)
+        except Exception as e:
+            print(f"Failed to refresh user name: {e}")
+    return await handler(event, data)
+
+
+# ==================== LLM API ====================
+
+def _unlock_oracle_creation(conn: sqlite3.Connection, ctx: UserContext | None):
+    if not ctx or ctx.can_create_oracle or ctx.wishes_count + 1 < 3:
+        return
+    cursor = conn.execute(
+        "UPDATE users SET can_create_oracle = 1 "
+        "WHERE user_id = ? AND can_create_oracle = 0 "
+        "AND wishes_count >= 3",
+        (ctx.user_id,),
+    )
+    if cursor.rowcount:
+        oracle_unlocks.inc()
+        _enqueue_message(
+            conn, ctx.user_id,
+            "🎉 <b>Ты отправил(а) 3 шифра!</b>\n"
+            "Теперь можешь создать своего Оракула — напиши /oracle",
+        )
+
+
+async def check_oracle_unlock(ctx: UserContext | None):
+    """Check if user reached 3 wishes and unlock oracle creation.
+    Call after save_wish: ctx.wishes_count does not include the new wish.
+    """
+    if not ctx or ctx.can_create_oracle or ctx.wishes_count + 1 < 3:
+        return
+    await db.run(_unlock_oracle_creation, ctx)
+    outbox_wakeup.set()
+
+
+def _oracle_limit_sql() -> str:
+    """SQL predicate: the oracle row still has uses left on its level."""
+    whens = []
+    for level, info in ORACLE_LEVELS.items():
+        max_uses = info["max_uses"]
+        whens.append(f"WHEN {level} THEN {'1' if max_uses is None else f'uses < {max_uses}'}")
+    default = ORACLE_LEVELS[1]["max_uses"]
+    return f"CASE level {' '.join(whens)} ELSE uses < {default} END"
+
+
+ORACLE_RESERVE_SQL = (
+    "UPDATE custom_oracles SET uses = uses + 1 "
+    f"WHERE id = ? AND user_id = ? AND {_oracle_limit_sql()} "
+    "RETURNING name, level, uses"
+)
+
+
+@dataclass
+class OracleUse:
+    """A use reserved on a custom oracle; refund it if the wish fails."""
+    user_id: int
+    oracle_id: int
+    name: str
+    level: int
+    uses: int
+    leveled_up: bool = False
+
+
+def _reserve_oracle_use(conn: sqlite3.Connection, user_id: int, oracle_id: int,
+                        tasks_completed: int):
+    row = conn.execute(ORACLE_RESERVE_SQL, (oracle_id, user_id)).fetchone()
+    if not row:
+        return None, conn.execute(
+            "SELECT name, level, uses FROM custom_oracles WHERE id = ?", (oracle_id,)
+        ).fetchone()
+    name, level, uses = row
+    use = OracleUse(user_id, oracle_id, name, level, uses)
+    if level == 1 and uses >= 3:
+        # Level-up happens in the same transaction, so it fires exactly once
+        use.level = 3 if tasks_completed >= 2 else 2
+        use.leveled_up = True
+        conn.execute(
+            "UPDATE custom_oracles SET level = ? WHERE id = ?",
+            (use.level, oracle_id),
+        )
+    return use, None
+
+
+async def reserve_oracle_use(ctx: UserContext | None) -> tuple[OracleUse | None, str | None]:
+    """Atomically check the active oracle's limit and consume one use.
+    Returns (reservation, limit_message). Standard oracle is always allowed
+    and returns (None, None); a hit limit returns (None, message).
+    """
+    if not ctx or not ctx.oracle_id:
+        return None, None
+    use, current = await db.run(
+        _reserve_oracle_use, ctx.user_id, ctx.oracle_id, ctx.tasks_completed,
+    )
+    if use and use.leveled_up:
+        oracle_level_ups.inc(str(use.level))
+    if use or not current:
+        return use, None
+    oracle_limit_hits.inc()
+    name, level, uses = current
+    level_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
+    max_uses = level_info["max_uses"]
+    safe_name = html_mod.escape(name)
+    return None, (
+        f"🔒 Оракул «{safe_name}» достиг лимита ({uses}/{max_uses}) на уровне {level}.\n"
+        f"Шифр будет отправлен через стандартного Оракула."
+    )
+
+
+async def refund_oracle_use(use: OracleUse | None):
+    """Give back a reserved use (e.g. the LLM call failed), undoing its level-up.
+    The level-up stays if later uses were reserved on top of it.
+    """
+    if not use:
+        return
+    await db.execute(
+        "UPDATE custom_oracles SET uses = uses - 1, "
+        "level = CASE WHEN ? AND level = ? AND uses - 1 < ? THEN 1 ELSE level END "
+        "WHERE id = ? AND uses > 0",
+        (use.leveled_up, use.level, ORACLE_LEVELS[1]["max_uses"], use.oracle_id),
+        name="refund_oracle_use",
+    )
+
+
+def _queue_level_up(conn: sqlite3.Connection, use: OracleUse | None):
+    if not use or not use.leveled_up:
+        return
+    safe_name = html_mod.escape(use.name)
+    if use.level == 3:
+        text = (
+            f"⬆️ <b>Оракул «{safe_name}» сразу достиг уровня 3 — Великий!</b>\n"
+            f"Безлимитные запросы!"
+        )
+    else:
+        text = (
+            f"⬆️ <b>Оракул «{safe_name}» достиг уровня 2 — Мастер!</b>\n"
+            f"Теперь доступно до 10 запросов."
+        )
+    _enqueue_message(conn, use.user_id, text)
+
+
+async def announce_level_up(use: OracleUse | None):
+    """Tell the user their oracle levelled up on this use."""
+    if not use or not use.leveled_up:
+        return
+    await db.run(_queue_level_up, use)
+    outbox_wakeup.set()
+
+
+def get_limit_hit_keyboard() -> InlineKeyboardMarkup:
+    """Keyboard shown when oracle limit is reached."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="↩️ Переключить на стандартного",
+            callback_data="oracle_reset_standard",
+        )],
+        [InlineKeyboardButton(
+            text="📋 Мои оракулы",
+            callback_data="oracle_list",
+        )],
+    ])
+
+
+def _activate_oracle(conn: sqlite3.Connection, user_id: int, oracle_id: int):
+    """Make oracle_id active if it belongs to user_id. Returns (name,) or None."""
+    row = conn.execute(
+        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
+        (oracle_id, user_id),
+    ).fetchone()
+    if row:
+        conn.execute(
+            "UPDATE users SET active_oracle_id = ? WHERE user_id = ?",
+            (oracle_id, user_id),
+        )
+    return row
+
+
+class LLMBackend:
+    """Interface for text generation providers behind call_llm."""
+
+    async def generate(self, contents: str) -> str | None:
+        raise NotImplementedError
+
+    async def stream(self, contents: str):
+        """Yield the response in chunks as they are produced."""
+        result = await self.generate(contents)
+        if result:
+            yield result
+
+    async def close(self):
+        pass
+
+
+class GeminiBackend(LLMBackend):
+    """google-genai SDK; one client whose HTTP connection pool is reused."""
+
+    def __init__(self, api_key: str, model: str):
+        from google import genai
+        self.model = model
+        self.client = genai.Client(api_key=api_key)
+
+    async def generate(self, contents: str) -> str | None:
+        response = await self.client.aio.models.generate_content(
+            model=self.model, contents=contents,
+        )
+        return response.text
+
+    async def stream(self, contents: str):
+        async for chunk in await self.client.aio.models.generate_content_stream(
+            model=self.model, contents=contents,
+        ):
+            if chunk.text:
+                yield chunk.text
+
+    async def close(self):
+        aclose = getattr(self.client.aio, "aclose", None)
+        if aclose:
+            await aclose()
+
+
+class OpenAIBackend(LLMBackend):
+    """Any OpenAI-compatible /chat/completions endpoint (LLM_API_URL)."""
+
+    def __init__(self, base_url: str, api_key: str, model: str, pool_size: int):
+        self.url = f"{base_url}/chat/completions"
+        self.model = model
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.pool_size = pool_size
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                headers=self.headers,
+            )
+        return self._session
+
+    async def generate(self, contents: str) -> str | None:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": contents}],
+        }
+        async with self.session.post(self.url, json=payload) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        choices = data.get("choices") or []
+        if not choices:
+            return None
+        return (choices[0].get("message") or {}).get("content")
+
+    async def stream(self, contents: str):
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": contents}],
+            "stream": True,
+        }
+        async with self.session.post(self.url, json=payload) as resp:
+            resp.raise_for_status()
+            async for raw in resp.content:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if delta:
+                    yield delta
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_llm_backend: LLMBackend | None = None
+
+
+def get_llm_backend() -> LLMBackend:
+    """Shared backend chosen by LLM_BACKEND (default: openai if LLM_API_URL is set)."""
+    global _llm_backend
+    if _llm_backend is None:
+        if LLM_BACKEND == "openai":
+            _llm_backend = OpenAIBackend(
+                LLM_API_URL, LLM_API_KEY, LLM_MODEL,
+                pool_size=LLM_WORKERS * LLM_HEDGE_ATTEMPTS,
+            )
+        else:
+            _llm_backend = GeminiBackend(GEMINI_API_KEY, LLM_MODEL)
+    return _llm_backend
+
+
+def llm_configured() -> bool:
+    return bool(LLM_API_URL if LLM_BACKEND == "openai" else GEMINI_API_KEY)
+
+
+async def close_llm_backend():
+    global _llm_backend
+    if _llm_backend is not None:
+        await _llm_backend.close()
+        _llm_backend = None
+
+
+class LLMQueueFull(Exception):
+    """The LLM work queue is full; retry_after is a hint in seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMQueue:
+    """Fixed pool of workers draining a bounded queue of LLM calls."""
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        self.avg_wait = 0.0      # EWMA of time spent queued, seconds
+        self.max_wait = 0.0
+        self.avg_service = 1.0   # EWMA of call duration, seconds
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def retry_after(self) -> int:
+        backlog = self.depth() + self.busy
+        return max(1, math.ceil(backlog * self.avg_service / self.workers))
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        """Queue fn(*args); the future resolves to its result. Raises LLMQueueFull."""
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((fn, args, fut, time.monotonic(), current_trace.get()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise LLMQueueFull(self.retry_after()) from None
+        return fut
+
+    async def run(self, fn, *args):
+        """Queue fn(*args) and wait for its result. Raises LLMQueueFull."""
+        return await self.submit(fn, *args)
+
+    async def _worker(self):
+        while True:
+            fn, args, fut, enqueued, trace = await self._queue.get()
+            started = time.monotonic()
+            wait = started - enqueued
+            self.avg_wait = 0.9 * self.avg_wait + 0.1 * wait
+            self.max_wait = max(self.max_wait, wait)
+            if fut.cancelled():   # caller went away while queued
+                continue
+            if trace:
+                trace.add("llm_queue", enqueued)
+            # The call's own spans go to the trace of whoever queued it
+            trace_token = current_trace.set(trace)
+            self.busy += 1
+            try:
+                result = await fn(*args)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+            finally:
+                current_trace.reset(trace_token)
+                self.busy -= 1
+                self.processed += 1
+                self.avg_service = 0.9 * self.avg_service + 0.1 * (time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queue_depth": self.depth(),
+            "queue_size": self.maxsize,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.avg_wait * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_service_ms": round(self.avg_service * 1000, 1),
+        }
+
+
+llm_queue = LLMQueue(LLM_WORKERS, LLM_QUEUE_SIZE)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `cooldown`
+    seconds lets a single probe call through (half-open). A probe that never
+    reports back (rejected or cancelled) is replaced after probe_timeout.
+    """
+
+    def __init__(self, threshold: int, cooldown: float, probe_timeout: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_started: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (
+            self._probe_started is None or now - self._probe_started > self.probe_timeout
+        ):
+            self._probe_started = now
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, math.ceil(self.cooldown - (time.monotonic() - self.opened_at)))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe_started is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self._probe_started = None
+
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN, LLM_TIMEOUT)
+
+# Recent successful wish latencies; the hedge delay follows their p95
+llm_latencies: deque[float] = deque(maxlen=200)
+
+
+def llm_hedge_delay() -> float:
+    """Delay before firing a hedged second request: observed p95, clamped."""
+    if len(llm_latencies) < 20:
+        return LLM_TIMEOUT / 3
+    p95 = sorted(llm_latencies)[int(len(llm_latencies) * 0.95) - 1]
+    return min(max(p95, 0.5), LLM_TIMEOUT / 2)
+
+
+async def hedged_call(make_call, timeout: float, hedge_delay: float | None = None,
+                      attempts: int = 1):
+    """Await make_call() with an overall deadline.
+
+    If no attempt has finished after hedge_delay, or the last one failed,
+    start another (up to `attempts` in total) and return the first success.
+    Losing attempts are cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    pending = {asyncio.ensure_future(make_call())}
+    launched = 1
+    error: BaseException = asyncio.TimeoutError()
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            wait = remaining
+            if launched < attempts and hedge_delay is not None:
+                wait = min(wait, hedge_delay)
+            done, pending = await asyncio.wait(
+                pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if launched < attempts and (not pending or (not done and hedge_delay is not None)):
+                pending.add(asyncio.ensure_future(make_call()))
+                launched += 1
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _generate(contents: str, hedge: bool = False) -> str | None:
+    """One guarded LLM request: deadline, optional hedging, circuit breaker."""
+    backend = get_llm_backend()
+    started = time.monotonic()
+    try:
+        result = await hedged_call(
+            lambda: backend.generate(contents),
+            timeout=LLM_TIMEOUT,
+            hedge_delay=llm_hedge_delay() if hedge else None,
+            attempts=LLM_HEDGE_ATTEMPTS if hedge else 1,
+        )
+    except Exception:
+        llm_breaker.record_failure()
+        raise
+    llm_breaker.record_success()
+    if hedge:
+        llm_latencies.append(time.monotonic() - started)
+    return result.strip() if result else None
+
+
+async def call_llm(text: str, ctx: UserContext | None = None) -> str | None:
+    """Call the LLM backend to metaphorically rephrase a wish.
+    Uses the active custom oracle from ctx, or the standard prompts if None.
+    Goes through llm_queue; raises LLMQueueFull when the queue is saturated.
+    Returns None at once while the circuit breaker is open.
+    """
+    fut = submit_llm(text, ctx)
+    return await fut if fut is not None else None
+
+
+def submit_llm(text: str, ctx: UserContext | None = None) -> asyncio.Future | None:
+    """Queue a call_llm without waiting for it. None if no LLM is configured
+    or the breaker is open; raises LLMQueueFull when the queue is saturated.
+    """
+    if not llm_configured() or not llm_breaker.allow():
+        return None
+    return llm_queue.submit(_call_llm, text, ctx)
+
+
+def build_wish_prompt(text: str, ctx: UserContext | None) -> tuple[str, str]:
+    """The LLM input and the oracle type it uses: base, style or custom."""
+    custom_prompt = ctx.oracle_prompt if ctx else None
+    if custom_prompt:
+        prompt, kind = custom_prompt, "custom"
+    else:
+        prompt = get_llm_prompt()
+        kind = "base" if prompt is LLM_BASE_PROMPT else "style"
+    return f"{prompt}\n\nЖелание: {text}", kind
+
+
+async def _call_llm(text: str, ctx: UserContext | None) -> str | None:
+    contents, kind = build_wish_prompt(text, ctx)
+    started = time.monotonic()
+    try:
+        with trace_span(f"llm.{kind}"):
+            result = await _generate(contents, hedge=True)
+    except Exception as e:
+        llm_request_seconds.observe(time.monotonic() - started, kind, "error")
+        print(f"LLM call failed: {e!r}")
+        return None
+    llm_request_seconds.observe(time.monotonic() - started, kind, "ok")
+    return result
+
+
+def stream_llm(text: str, ctx: UserContext | None,
+               chunks: asyncio.Queue) -> asyncio.Future | None:
+    """Streaming variant of call_llm.
+
+    Chunks are put on `chunks` as they arrive, followed by None. The returned
+    future resolves to the full metaphor (or None on failure). Returns None
+    right away if no LLM is configured or the breaker is open; raises
+    LLMQueueFull when the queue is saturated.
+    """
+    if not llm_configured() or not llm_breaker.allow():
+        return None
+    contents, kind = build_wish_prompt(text, ctx)
+    return llm_queue.submit(_stream_llm, contents, kind, chunks)
+
+
+async def _stream_llm(contents: str, kind: str, chunks: asyncio.Queue) -> str | None:
+    parts = []
+    started = time.monotonic()
+    trace = current_trace.get()
+    try:
+        async with asyncio.timeout(LLM_TIMEOUT):
+            async for chunk in get_llm_backend().stream(contents):
+                parts.append(chunk)
+                chunks.put_nowait(chunk)
+    except Exception as e:
+        llm_breaker.record_failure()
+        llm_request_seconds.observe(time.monotonic() - started, kind, "error")
+        print(f"LLM stream failed: {e!r}")
+        return None
+    finally:
+        chunks.put_nowait(None)
+    llm_breaker.record_success()
+    llm_request_seconds.observe(time.monotonic() - started, kind, "ok")
+    if trace:
+        trace.add(f"llm.{kind}", started)
+    result = "".join(parts).strip()
+    return result or None
+
+
+async def generate_oracle_prompt(description: str) -> str | None:
+    """Use LLM to generate a system prompt from a user description."""
+    if not llm_configured():
+        return None
+    if not llm_breaker.allow():
+        return None
+    try:
+        return await llm_queue.run(_generate_oracle_prompt, description)
+    except LLMQueueFull:
+        return None
+
+
+async def _generate_oracle_prompt(description: str) -> str | None:
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        meta_prompt = (
+            "Ты — генератор системных промптов для Оракула Шкатулки Желаний.\n"
+            "Оракул получает желание и должен зашифровать его в метафору-загадку.\n\n"
+            "Пользователь хочет Оракула с таким характером:\n"
+            f"{description}\n\n"
+            "Напиши системный промпт для этого Оракула. Промпт должен:\n"
+            "- Описать характер и стиль речи Оракула\n"
+            "- Содержать правила: 1-2 предложения, метафоры вместо прямых слов, "
+            "сохранять направление (для себя/для другого), только фраза без пояснений, русский язык\n"
+            "- Быть готовым к использованию как system prompt\n\n"
+            "Ответь ТОЛЬКО текстом промпта, без пояснений."
+        )
+        result = await _generate(meta_prompt)
+        outcome = "ok"
+        return result
+    except Exception as e:
+        print(f"Generate oracle prompt failed: {e!r}")
+        return None
+    finally:
+        llm_request_seconds.observe(time.monotonic() - started, "generator", outcome)
+
+
+# ==================== AIOHTTP WEB SERVER ====================
+
+def set_cors_headers(response: web.StreamResponse):
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, If-None-Match"
+    response.headers["Access-Control-Expose-Headers"] = "Retry-After, ETag, Server-Timing"
+    response.headers["Timing-Allow-Origin"] = "*"
+    response.headers["Access-Control-Max-Age"] = "3600"
+
+
+# ==================== RATE LIMITING ====================
+# Token buckets per route and scope: "uid" (the uid the webapp sends), "ip"
+# and "global". Values are (requests per minute, burst). Routes not listed
+# are not limited. Override with RATE_LIMITS='{"/api/wish": {"uid": [3, 2]}}'.
+
+RATE_LIMITS = {
+    "/api/wish": {"uid": (6, 3), "ip": (30, 10), "global": (600, 60)},
+    "/api/wish/stream": {"uid": (6, 3), "ip": (30, 10), "global": (600, 60)},
+    "/api/wish/{job_id}": {"ip": (300, 30)},
+    "/api/bootstrap": {"uid": (60, 20), "ip": (600, 100)},
+    "/api/oracles": {"uid": (60, 20), "ip": (600, 100)},
+    "/api/oracle/select": {"uid": (60, 10), "ip": (300, 50)},
+}
+
+
+def load_rate_limit_overrides() -> dict:
+    raw = os.getenv("RATE_LIMITS") or "{}"
+    try:
+        overrides = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise SystemExit(f"RATE_LIMITS is not valid JSON: {e}")
+    if not isinstance(overrides, dict) or not all(
+        isinstance(scopes, dict) for scopes in overrides.values()
+    ):
+        raise SystemExit(
+            'RATE_LIMITS must be a JSON object like {"/api/wish": {"uid": [6, 3]}}'
+        )
+    return overrides
+
+
+RATE_LIMITS.update(load_rate_limit_overrides())
+
+
+class RateLimiter:
+    """Non-blocking token buckets, two floats per active key.
+
+    Buckets are kept in least-recently-used order; one idle long enough to
+    have refilled completely is equal to a fresh one, so it is dropped.
+    """
+
+    def __init__(self, idle_ttl: float, max_keys: int = 100_000):
+        self.idle_ttl = idle_ttl
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[tuple, tuple[float, float]] = OrderedDict()
+
+    def take(self, limits: list[tuple[tuple, float, float]]) -> float:
+        """Take a token from every (key, per-second rate, burst) bucket, or
+        from none. Returns 0 if admitted, else seconds until it would be.
+        """
+        now = time.monotonic()
+        levels = []
+        for key, rate, burst in limits:
+            bucket = self._buckets.pop(key, None)
+            tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+            levels.append((key, rate, tokens))
+        wait = max(((1 - tokens) / rate for _, rate, tokens in levels if tokens < 1), default=0.0)
+        for key, _, tokens in levels:
+            self._buckets[key] = (tokens if wait else tokens - 1, now)
+        self._evict(now)
+        return wait
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - updated < self.idle_ttl:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+rate_limiter = RateLimiter(idle_ttl=max((
+    60 * burst / per_minute
+    for scopes in RATE_LIMITS.values() for per_minute, burst in scopes.values()
+), default=60))
+
+
+def client_ip(request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote or ""
+
+
+async def request_uid(request) -> str | None:
+    uid = request.query.get("uid")
+    if uid is None and request.method == "POST" and request.content_type == "application/json":
+        try:
+            data = await request.json()   # cached, the handler reads it again for free
+            uid = data.get("uid") if isinstance(data, dict) else None
+        except Exception:
+            uid = None
+    return str(uid) if uid else None
+
+
+@middleware
+async def rate_limit_middleware(request, handler):
+    route = request.match_info.route.resource
+    scopes = RATE_LIMITS.get(route.canonical) if route else None
+    if not scopes:
+        return await handler(request)
+
+    path = route.canonical
+    limits = []
+    for scope, (per_minute, burst) in scopes.items():
+        if scope == "uid":
+            key = await request_uid(request)
+            if key is None:
+                continue
+        elif scope == "ip":
+            key = client_ip(request)
+        else:
+            key = ""
+        limits.append(((path, scope, key), per_minute / 60, burst))
+
+    wait = rate_limiter.take(limits)
+    if wait:
+        rate_limited.inc(path)
+        retry_after = math.ceil(wait)
+        return web.json_response(
+            {"error": "Too many requests", "retry_after": retry_after}, status=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    return await handler(request)
+
+
+@middleware
+async def cors_middleware(request, handler):
+    if request.method == "OPTIONS":
+        response = web.Response(status=200)
+    else:
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            response = e
+
+    # Streaming responses set their headers before the body starts
+    if not response.prepared:
+        set_cors_headers(response)
+    return response
+
+
+@dataclass
+class Wish:
+    """A validated /api/wish request with its reserved oracle use."""
+    text: str
+    user_id: int | None
+    user_name: str
+    ctx: UserContext | None
+    oracle_use: OracleUse | None
+    allowed: bool
+    job: bool = False   # client asked for 202 + polling instead of waiting
+    limit_msg: str | None = None   # oracle limit notice, sent once the wish is admitted
+
+    @property
+    def llm_ctx(self) -> UserContext | None:
+        # If the limit was hit, ctx=None forces the standard oracle
+        return self.ctx if self.allowed else None
+
+
+async def begin_wish(request) -> Wish | web.Response:
+    """Validate a wish request, look up the user and reserve an oracle use.
+    Returns an error response if the request is invalid.
+    """
+    try:
+        data = await request.json()
+    except Exception:
+        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+    text = data.get("text", "").strip()
+    uid = data.get("uid")
+
+    if not text:
+        return web.json_response({"error": "Empty wish"}, status=400)
+
+    if len(text) > 500:
+        return web.json_response({"error": "Too long"}, status=400)
+
+    # Extract user info
+    try:
+        user_id = int(uid) if uid else None
+    except (ValueError, TypeError):
+        user_id = None
+
+    trace = current_trace.get()
+    if trace:
+        trace.user_id = user_id
+
+    ctx = await load_user_context(user_id)
+    user_name = await get_display_name(user_id, ctx)
+
+    # Reserve an oracle use — fallback to standard if limit exceeded
+    oracle_use, limit_msg = await reserve_oracle_use(ctx)
+    allowed = limit_msg is None
+
+    job = bool(data.get("async")) or "respond-async" in request.headers.get("Prefer", "")
+    return Wish(text, user_id, user_name, ctx, oracle_use, allowed, job, limit_msg)
+
+
+async def notify_limit_hit(wish: Wish):
+    """Tell the user their oracle hit its limit. Only call once the LLM queue
+    has admitted the wish, so a rejected request sends nothing.
+    """
+    if wish.limit_msg and wish.user_id:
+        await enqueue_message(wish.user_id, wish.limit_msg, reply_markup=get_limit_hit_keyboard())
+
+
+async def complete_wish(wish: Wish, metaphor: str):
+    """Side effects of a successful wish: save it, level-up/unlock, and queue
+    the notifications — all in one transaction, delivered by the outbox.
+    """
+    user_id, user_name, text = wish.user_id, wish.user_name, wish.text
+    safe_metaphor = html_mod.escape(metaphor)
+
+    def _complete(conn):
+        _save_wish(conn, user_id, user_name, text, metaphor, "api")
+        _queue_level_up(conn, wish.oracle_use)
+        _unlock_oracle_creation(conn, wish.ctx)
+
+        # Send metaphor to user in bot chat
+        if user_id:
+            _enqueue_message(
+                conn, user_id,
+                f"🔮 <b>Оракул передал шифр Люту:</b>\n\n"
+                f"<i>{safe_metaphor}</i>",
+            )
+
+        # Send to admin
+        if ADMIN_ID:
+            safe_name = html_mod.escape(user_name)
+            _enqueue_message(
+                conn, ADMIN_ID,
+                f"🔮 <b>Новое желание из Шкатулки!</b>\n\n"
+                f"👤 От: <b>{safe_name}</b>\n\n"
+                f"✨ <b>Метафора:</b>\n<i>{safe_metaphor}</i>",
+            )
+
+    await db.run(_complete)
+    outbox_wakeup.set()
+
+
+def oracle_busy_response(e: LLMQueueFull) -> web.Response:
+    return web.json_response(
+        {"error": "Oracle busy", "retry_after": e.retry_after}, status=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def oracle_unavailable_response() -> web.Response:
+    headers = {}
+    if llm_breaker.state != "closed":
+        headers["Retry-After"] = str(llm_breaker.retry_after())
+    return web.json_response({"error": "Oracle unavailable"}, status=503, headers=headers)
+
+
+async def handle_wish(request):
+    """API endpoint: receive wish, call LLM, return metaphor, notify admin."""
+    wish = await begin_wish(request)
+    if isinstance(wish, web.Response):
+        return wish
+    if wish.job:
+        return await start_wish_job(wish)
+
+    try:
+        fut = submit_llm(wish.text, wish.llm_ctx)
+    except LLMQueueFull as e:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_busy_response(e)
+    if fut is None:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_unavailable_response()
+    await notify_limit_hit(wish)
+
+    metaphor = await fut
+    if metaphor is None:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_unavailable_response()
+
+    await complete_wish(wish, metaphor)
+    return web.json_response({"metaphor": metaphor})
+
+
+# ==================== WISH JOBS ====================
+# Opt-in async mode: POST /api/wish with {"async": true} (or the header
+# "Prefer: respond-async") answers 202 with a job id right away, and
+# GET /api/wish/{id}?wait=N long-polls for the result. Jobs live in the
+# wish_jobs table, so results — and unfinished jobs — survive a restart.
+
+_job_waiters: dict[str, asyncio.Event] = {}
+_background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Run a fire-and-forget task, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def start_wish_job(wish: Wish) -> web.Response:
+    try:
+        fut = submit_llm(wish.text, wish.llm_ctx)
+    except LLMQueueFull as e:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_busy_response(e)
+    if fut is None:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_unavailable_response()
+    await notify_limit_hit(wish)
+
+    job_id = secrets.token_urlsafe(12)
+    now = int(time.time())
+    reservation = json.dumps(asdict(wish.oracle_use)) if wish.oracle_use else None
+    await db.execute(
+        "INSERT INTO wish_jobs (id, user_id, user_name, text, allowed, reservation, "
+        "created_at, updated_at, worker) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, wish.user_id, wish.user_name, wish.text, wish.allowed,
+         reservation, now, now, metrics_worker),
+        name="start_wish_job",
+    )
+    trace = current_trace.get()
+    if trace:
+        trace.detached = True   # run_wish_job finishes it
+    spawn(run_wish_job(job_id, wish, fut))
+    return web.json_response(
+        {"job_id": job_id, "status": "pending"}, status=202,
+        headers={"Location": f"/api/wish/{job_id}"},
+    )
+
+
+async def run_wish_job(job_id: str, wish: Wish, llm_result):
+    try:
+        await _run_wish_job(job_id, wish, llm_result)
+    finally:
+        trace = current_trace.get()   # inherited from the POST that started it
+        if trace and trace.detached:
+            finish_trace(trace)
+
+
+async def _run_wish_job(job_id: str, wish: Wish, llm_result):
+    try:
+        metaphor = await llm_result
+    except Exception:
+        metaphor = None
+    if not metaphor:
+        await refund_oracle_use(wish.oracle_use)
+        await finish_wish_job(job_id, "failed", error="Oracle unavailable")
+        return
+    # Publish the result first; notifications must not delay the poller
+    await finish_wish_job(job_id, "done", metaphor=metaphor)
+    await complete_wish(wish, metaphor)
+
+
+async def finish_wish_job(job_id: str, status: str, metaphor: str | None = None,
+                          error: str | None = None):
+    await db.execute(
+        "UPDATE wish_jobs SET status = ?, metaphor = ?, error = ?, updated_at = ? "
+        "WHERE id = ?",
+        (status, metaphor, error, int(time.time()), job_id),
+        name="finish_wish_job",
+    )
+    event = _job_waiters.pop(job_id, None)
+    if event:
+        event.set()
+
+
+async def _call_llm_when_free(text: str, ctx: UserContext | None) -> str | None:
+    while True:
+        try:
+            return await call_llm(text, ctx)
+        except LLMQueueFull as e:
+            await asyncio.sleep(e.retry_after)
+
+
+def _adopt_wish_jobs(conn: sqlite3.Connection, worker: str | None) -> list:
+    where = "status = 'pending'" + (" AND worker = ?" if worker else "")
+    params = (worker,) if worker else ()
+    rows = conn.execute(
+        "SELECT id, user_id, user_name, text, allowed, reservation "
+        f"FROM wish_jobs WHERE {where} ORDER BY created_at",
+        params,
+    ).fetchall()
+    conn.execute(f"UPDATE wish_jobs SET worker = ? WHERE {where}", (metrics_worker, *params))
+    return rows
+
+
+async def resume_wish_jobs(worker: str | None = None):
+    """Restart jobs left pending by a previous process (use stays reserved):
+    all of them at start-up, or those of one API worker that died.
+    """
+    rows = await db.run(_adopt_wish_jobs, worker)
+    for job_id, user_id, user_name, text, allowed, reservation in rows:
+        ctx = await load_user_context(user_id)
+        oracle_use = OracleUse(**json.loads(reservation)) if reservation else None
+        wish = Wish(text, user_id, user_name, ctx, oracle_use, bool(allowed), job=True)
+        spawn(run_wish_job(job_id, wish, _call_llm_when_free(text, wish.llm_ctx)))
+    if rows:
+        print(f"Resumed {len(rows)} pending wish jobs" + (f" of {worker}" if worker else ""))
+
+
+async def handle_wish_job(request):
+    """API endpoint: job status; ?wait=N long-polls up to N seconds."""
+    job_id = request.match_info["job_id"]
+    try:
+        wait = min(float(request.query.get("wait", 0)), WISH_JOB_MAX_WAIT)
+    except ValueError:
+        return web.json_response({"error": "Invalid wait"}, status=400)
+
+    query = "SELECT status, metaphor, error FROM wish_jobs WHERE id = ?"
+    row = await db.fetchone(query, (job_id,), name="handle_wish_job")
+    if not row:
+        return web.json_response({"error": "Job not found"}, status=404)
+    # The job may be running in another API worker: wake on the local event
+    # or re-check the table every WISH_JOB_POLL seconds
+    deadline = time.monotonic() + wait
+    if row[0] == "pending" and wait > 0:
+        event = _job_waiters.setdefault(job_id, asyncio.Event())
+        try:
+            while row[0] == "pending" and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, WISH_JOB_POLL))
+                except asyncio.TimeoutError:
+                    pass
+                row = await db.fetchone(query, (job_id,), name="handle_wish_job")
+        finally:
+            # Finished elsewhere or timed out: _finish_job never popped it here
+            if _job_waiters.get(job_id) is event:
+                del _job_waiters[job_id]
+
+    status, metaphor, error = row
+    result = {"job_id": job_id, "status": status}
+    if metaphor:
+        result["metaphor"] = metaphor
+    if error:
+        result["error"] = error
+    return web.json_response(result)
+
+
+def sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+async def handle_wish_stream(request):
+    """API endpoint: like /api/wish, but relays metaphor tokens as Server-Sent
+    Events (token..., then done or error). Side effects run after the stream.
+    """
+    wish = await begin_wish(request)
+    if isinstance(wish, web.Response):
+        return wish
+
+    chunks: asyncio.Queue = asyncio.Queue()
+    try:
+        result = stream_llm(wish.text, wish.llm_ctx, chunks)
+    except LLMQueueFull as e:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_busy_response(e)
+    if result is None:
+        await refund_oracle_use(wish.oracle_use)
+        return oracle_unavailable_response()
+    await notify_limit_hit(wish)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    set_cors_headers(response)
+    await response.prepare(request)
+
+    connected = True
+
+    async def send(event: str, data: dict):
+        nonlocal connected
+        if not connected:
+            return
+        try:
+            await response.write(sse_event(event, data))
+        except (ConnectionResetError, RuntimeError):
+            connected = False   # keep going: the wish still has to be saved
+
+    while (chunk := await chunks.get()) is not None:
+        await send("token", {"text": chunk})
+
+    try:
+        metaphor = await result
+    except Exception:
+        metaphor = None
+    if not metaphor:
+        await refund_oracle_use(wish.oracle_use)
+        await send("error", {"error": "Oracle unavailable"})
+        return response
+
+    trace = current_trace.get()
+    done = {"metaphor": metaphor}
+    if trace:
+        done["server_timing"] = trace.server_timing()
+    await send("done", done)
+    await complete_wish(wish, metaphor)
+    return response
+
+
+BOOTSTRAP_SQL = """
+    SELECT u.version, u.active_oracle_id, u.can_create_oracle, u.wishes_count,
+           o.id, o.name, o.level, o.uses
+    FROM users u
+    LEFT JOIN custom_oracles o ON o.user_id = u.user_id
+    WHERE u.user_id = ?
+    ORDER BY o.id
+"""
+
+# Part of every ETag, so changing the level table invalidates cached copies
+LEVELS_TAG = hashlib.sha256(json.dumps(ORACLE_LEVELS).encode()).hexdigest()[:8]
+
+
+def bootstrap_etag(user_id: int, version: int) -> str:
+    return f'"{user_id}.{version}.{LEVELS_TAG}"'
+
+
+async def load_bootstrap(user_id: int) -> tuple[int, dict]:
+    """Everything the webapp shows on open, in one query, with its version."""
+    rows = await db.fetchall(BOOTSTRAP_SQL, (user_id,), name="load_bootstrap")
+    if not rows:
+        version, active_id, can_create, wishes_count = 0, None, False, 0
+    else:
+        version, active_id, can_create, wishes_count = rows[0][:4]
+    oracle_list = []
+    for *_, oid, name, level, uses in rows:
+        if oid is None:
+            continue
+        lvl_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
+        oracle_list.append({
+            "id": oid,
+            "name": name,
+            "level": level,
+            "uses": uses,
+            "max_uses": lvl_info["max_uses"],
+            "level_name": lvl_info["name"],
+        })
+    return version, {
+        "oracles": oracle_list,
+        "active_id": active_id or None,
+        "can_create": bool(can_create),
+        "wishes_count": wishes_count,
+    }
+
+
+def parse_uid(request) -> int | web.Response:
+    uid = request.query.get("uid")
+    if not uid:
+        return web.json_response({"error": "Missing uid"}, status=400)
+    try:
+        return int(uid)
+    except (ValueError, TypeError):
+        return web.json_response({"error": "Invalid uid"}, status=400)
+
+
+async def handle_oracles(request):
+    """API endpoint: return user's oracles and active oracle."""
+    user_id = parse_uid(request)
+    if isinstance(user_id, web.Response):
+        return user_id
+    _, data = await load_bootstrap(user_id)
+    return web.json_response(data)
+
+
+async def handle_bootstrap(request):
+    """API endpoint: webapp start-up data; 304 when If-None-Match is current."""
+    user_id = parse_uid(request)
+    if isinstance(user_id, web.Response):
+        return user_id
+    headers = {"Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        row = await db.fetchone(
+            "SELECT version FROM users WHERE user_id = ?", (user_id,), name="handle_bootstrap",
+        )
+        headers["ETag"] = bootstrap_etag(user_id, row[0] if row else 0)
+        if headers["ETag"] in (t.strip() for t in if_none_match.split(",")):
+            return web.Response(status=304, headers=headers)
+
+    version, data = await load_bootstrap(user_id)
+    data["levels"] = [
+        {"level": level, "name": info["name"], "max_uses": info["max_uses"]}
+        for level, info in ORACLE_LEVELS.items()
+    ]
+    headers["ETag"] = bootstrap_etag(user_id, version)
+    return web.json_response(data, headers=headers)
+
+
+async def handle_oracle_select(request):
+    """API endpoint: switch user's active oracle."""
+    try:
+        data = await request.json()
+    except Exception:
+        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+    uid = data.get("uid")
+    oracle_id = data.get("oracle_id")
+    if uid is None:
+        return web.json_response({"error": "Missing uid"}, status=400)
+    try:
+        user_id = int(uid)
+    except (ValueError, TypeError):
+        return web.json_response({"error": "Invalid uid"}, status=400)
+
+    if oracle_id is None or oracle_id == 0:
+        await db.execute(
+            "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
+            (user_id,),
+            name="handle_oracle_select",
+        )
+        return web.json_response({"ok": True, "active_id": None})
+
+    try:
+        oracle_id = int(oracle_id)
+    except (ValueError, TypeError):
+        return web.json_response({"error": "Invalid oracle_id"}, status=400)
+
+    row = await db.run(_activate_oracle, user_id, oracle_id)
+    if not row:
+        return web.json_response({"error": "Oracle not found"}, status=404)
+
+    return web.json_response({"ok": True, "active_id": oracle_id})
+
+
+async def handle_llm_stats(request):
+    """API endpoint: LLM worker pool and queue statistics."""
+    stats = llm_queue.stats()
+    stats["breaker"] = llm_breaker.state
+    stats["hedge_delay_ms"] = round(llm_hedge_delay() * 1000, 1)
+    return web.json_response(stats)
+
+
+TRACED_ROUTES = {"/api/wish", "/api/wish/stream"}
+
+
+@middleware
+async def trace_middleware(request, handler):
+    resource = request.match_info.route.resource
+    if not resource or resource.canonical not in TRACED_ROUTES:
+        return await handler(request)
+    trace = Trace(resource.canonical, time.monotonic(), time.time())
+    token = current_trace.set(trace)
+    try:
+        response = await handler(request)
+    finally:
+        current_trace.reset(token)
+    if not response.prepared:   # a stream reports its timing in the done event
+        response.headers["Server-Timing"] = trace.server_timing()
+    if not trace.detached:
+        finish_trace(trace)
+    return response
+
+
+@middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else "unmatched"
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_request_seconds.observe(
+            time.monotonic() - started, route, request.method, str(status),
+        )
+
+
+async def handle_metrics(request):
+    """Prometheus scrape endpoint."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.json_response({"error": "Unauthorized"}, status=401)
+    snapshots = await load_metrics_snapshots() if API_WORKERS else None
+    return web.Response(
+        text=render_metrics(snapshots), content_type="text/plain", charset="utf-8",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+async def telegram_metrics_middleware(make_request, bot, method):
+    """aiogram request middleware: time every Bot API call."""
+    name = type(method).__name__
+    started = time.monotonic()
+    try:
+        with trace_span(f"telegram.{name}"):
+            return await make_request(bot, method)
+    except Exception as e:
+        telegram_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        telegram_request_seconds.observe(time.monotonic() - started, name)
+
+
+bot.session.middleware(telegram_metrics_middleware)
+
+
+# ==================== STATIC WEBAPP ====================
+# With WEBAPP_SERVE the pages are served from /app/ so opening the webapp is
+# one request to this server. Everything is read and compressed once at
+# startup. Assets get content-hashed names and are cached forever; the HTML
+# is revalidated by ETag, and the fonts stylesheet is inlined into it.
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+STATIC_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
+    ".woff2": "font/woff2",
+    ".png": "image/png",
+    ".svg": "image/svg+xml",
+}
+COMPRESSIBLE = {".html", ".css", ".js", ".svg"}
+CSS_LINK_RE = re.compile(r'<link rel="stylesheet" href="([^":]+)">')
+CSS_URL_RE = re.compile(r"url\('([^':]+)'\)")
+
+
+@dataclass
+class StaticAsset:
+    body: bytes
+    content_type: str
+    cache_control: str
+    etag: str
+    encoded: dict[str, bytes]   # Content-Encoding -> body
+
+
+def make_static_asset(body: bytes, suffix: str, cache_control: str) -> StaticAsset:
+    encoded = {}
+    if suffix in COMPRESSIBLE:
+        encoded["gzip"] = gzip.compress(body, 9, mtime=0)
+        if brotli:
+            encoded["br"] = brotli.compress(body, quality=11)
+    return StaticAsset(
+        body=body,
+        content_type=STATIC_TYPES.get(suffix, "application/octet-stream"),
+        cache_control=cache_control,
+        etag=f'"{hashlib.sha256(body).hexdigest()[:16]}"',
+        encoded={k: v for k, v in encoded.items() if len(v) < len(body)},
+    )
+
+
+def build_webapp_assets(root: Path) -> dict[str, StaticAsset]:
+    """Map URL paths under /app/ to prepared responses."""
+    assets: dict[str, StaticAsset] = {}
+    hashed: dict[str, str] = {}   # source path -> content-hashed path
+
+    def add_hashed(rel: str, body: bytes):
+        path = Path(rel)
+        digest = hashlib.sha256(body).hexdigest()[:10]
+        name = path.with_name(f"{path.stem}.{digest}{path.suffix}").as_posix()
+        assets[name] = make_static_asset(body, path.suffix, IMMUTABLE)
+        hashed[rel] = name
+
+    files = sorted(p for p in root.rglob("*") if p.is_file() and p.suffix in STATIC_TYPES)
+    # Leaves first, then stylesheets that point at them, then pages
+    for path in files:
+        if path.suffix not in (".css", ".html"):
+            add_hashed(path.relative_to(root).as_posix(), path.read_bytes())
+
+    stylesheets: dict[str, str] = {}
+    for path in files:
+        if path.suffix == ".css":
+            rel = path.relative_to(root)
+            base = rel.parent.as_posix()
+
+            def to_hashed(m, base=base):
+                target = f"{base}/{m.group(1)}" if base != "." else m.group(1)
+                return f"url('/app/{hashed[target]}')" if target in hashed else m.group(0)
+
+            stylesheets[rel.as_posix()] = CSS_URL_RE.sub(to_hashed, path.read_text())
+            add_hashed(rel.as_posix(), stylesheets[rel.as_posix()].encode())
+
+    for path in files:
+        if path.suffix == ".html":
+            def inline_css(m):
+                css = stylesheets.get(m.group(1))
+                return f"<style>\n{css}</style>" if css is not None else m.group(0)
+
+            html = CSS_LINK_RE.sub(inline_css, path.read_text())
+            assets[path.relative_to(root).as_posix()] = make_static_asset(
+                html.encode(), ".html", "no-cache",
+            )
+    if "index.html" in assets:
+        assets[""] = assets["index.html"]
+    return assets
+
+
+webapp_assets: dict[str, StaticAsset] = {}
+
+
+async def handle_webapp(request):
+    """Serve a prepared webapp file, compressed if the client accepts it."""
+    asset = webapp_assets.get(request.match_info["path"])
+    if asset is None:
+        raise web.HTTPNotFound()
+    headers = {
+        "Cache-Control": asset.cache_control,
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("If-None-Match") == asset.etag:
+        return web.Response(status=304, headers=headers)
+
+    body = asset.body
+    accepted = request.headers.get("Accept-Encoding", "")
+    for encoding in ("br", "gzip"):
+        if encoding in asset.encoded and encoding in accepted:
+            body = asset.encoded[encoding]
+            headers["Content-Encoding"] = encoding
+            break
+    headers["Content-Type"] = asset.content_type
+    return web.Response(body=body, headers=headers)
+
+
+async def handle_webapp_root(request):
+    raise web.HTTPFound("/app/")
+
+
+def mount_webapp(app: web.Application):
+    webapp_assets.update(build_webapp_assets(WEBAPP_DIR))
+    app.router.add_get("/app", handle_webapp_root)
+    app.router.add_get("/app/{path:.*}", handle_webapp)
+
+
+def create_app():
+    app = web.Application(
+        middlewares=[cors_middleware, metrics_middleware, rate_limit_middleware,
+                     trace_middleware],
+    )
+    app.router.add_post("/api/wish", handle_wish)
+    app.router.add_post("/api/wish/stream", handle_wish_stream)
+    app.router.add_get("/api/wish/{job_id}", handle_wish_job)
+    app.router.add_get("/api/oracles", handle_oracles)
+    app.router.add_get("/api/bootstrap", handle_bootstrap)
+    app.router.add_post("/api/oracle/select", handle_oracle_select)
+    app.router.add_get("/api/llm/stats", handle_llm_stats)
+    app.router.add_get("/metrics", handle_metrics)
+    if WEBHOOK_URL and not API_WORKERS:
+        mount_webhook(app)
+    if WEBAPP_SERVE:
+        mount_webapp(app)
+    return app
+
+
+def mount_webhook(app: web.Application):
+    """Receive Telegram updates on this app; requests without the secret get 401."""
+    SimpleRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+
+# ==================== BOT HANDLERS ====================
+
+def get_webapp_url(user_id: int = None):
+    """Build webapp URL with API base and user_id parameters."""
+    url = WEBAPP_URL
+    if API_BASE_URL:
+        sep = "&" if "?" in url else "?"
+        url += f"{sep}api={API_BASE_URL}"
+    if user_id:
+        sep = "&" if "?" in url else "?"
+        url += f"{sep}uid={user_id}"
+    if WEBAPP_WISH_MODE:
+        sep = "&" if "?" in url else "?"
+        url += f"{sep}mode={WEBAPP_WISH_MODE}"
+    return url
+
+
+def get_certificate_url():
+    """Derive certificate URL from webapp URL."""
+    if "index.html" in WEBAPP_URL:
+        return WEBAPP_URL.replace("index.html", "certificate.html")
+    url = WEBAPP_URL.rstrip("/")
+    return url + "/certificate.html"
+
+
+@dp.message(CommandStart())
+async def cmd_start(message: types.Message):
+    user = message.from_user
+    await register_user(user.id, display_name(user))
+
+    kb = ReplyKeyboardMarkup(
+        keyboard=[
+            [
+                KeyboardButton(
+                    text="🔮 Шкатулка Желаний",
+                    web_app=WebAppInfo(url=get_webapp_url(message.from_user.id)),
+                )
+            ],
+            [
+                KeyboardButton(
+                    text="🎁 Мой сертификат",
+                    web_app=WebAppInfo(url=get_certificate_url()),
+                )
+            ],
+        ],
+        resize_keyboard=True,
+    )
+    await message.answer(
+        "✨ <b>Привет!</b>\n\n"
+        "Добро пожаловать в <b>Клуб Подпольных Авантюристов</b>.\n\n"
+        "🔮 <b>Шкатулка Желаний</b> — нашепчи своё желание,\n"
+        "оракул превратит его в загадку и отправит Люту.\n\n"
+        "🎁 <b>Сертификат</b> — твой подарок на массаж.\n\n"
+        "📋 <b>Команды:</b>\n"
+        "/help — справка\n"
+        "/oracle — управление Оракулами\n\n"
+        "Выбирай 👇",
+        reply_markup=kb,
+        parse_mode="HTML",
+    )
+
+    if ADMIN_ID:
+        user = message.from_user
+        name = html_mod.escape(user.full_name or user.username or "Неизвестный")
+        username = f" (@{user.username})" if user.username else ""
+        await enqueue_message(
+            ADMIN_ID,
+            f"👀 <b>{name}</b>{username} запустил(а) бота\n"
+            f"ID: <code>{user.id}</code>",
+        )
+
+
+@dp.message(F.web_app_data)
+async def on_web_app_data(message: types.Message):
+    try:
+        data = json.loads(message.web_app_data.data)
+    except (json.JSONDecodeError, AttributeError):
+        return
+
+    action = data.get("action")
+
+    if action == "activate":
+        # Certificate activation (legacy)
+        await message.answer(
+            "🎉 <b>Сертификат успешно активирован!</b>\n\n"
+            "Теперь выбери удобную дату для массажа 👇",
+            reply_markup=build_dates_keyboard(),
+            parse_mode="HTML",
+        )
+        if ADMIN_ID:
+            user = message.from_user
+            name = html_mod.escape(user.full_name or user.username or "Неизвестный")
+            await enqueue_message(
+                ADMIN_ID,
+                f"🔔 <b>{name}</b> активировала сертификат на массаж!",
+            )
+
+    elif action == "wish":
+        # Fallback: wish sent via sendData (no API server available)
+        text = data.get("text", "").strip()
+        if not text:
+            return
+
+        await message.answer(
+            "🔮 <b>Оракул получил твоё желание!</b>\n"
+            "Зашифровываю...",
+            parse_mode="HTML",
+        )
+
+        # Reserve an oracle use
+        uid = message.from_user.id
+        ctx = await load_user_context(uid)
+        oracle_use, limit_msg = await reserve_oracle_use(ctx)
+        allowed = limit_msg is None
+
+        try:
+            fut = submit_llm(text, ctx if allowed else None)
+        except LLMQueueFull:
+            fut = None
+        # Only tell about the limit once the wish is admitted, as notify_limit_hit does
+        if fut is not None and not allowed:
+            limit_kb = get_limit_hit_keyboard()
+            await message.answer(limit_msg, parse_mode="HTML", reply_markup=limit_kb)
+        metaphor = await fut if fut is not None else None
+        if metaphor is None:
+            await refund_oracle_use(oracle_use)
+
+        # Save to database
+        user = message.from_user
+        await save_wish(
+            user.id,
+            user.full_name or user.username or "Аноним",
+            text, metaphor, source="sendData",
+        )
+
+        if metaphor:
+            await announce_level_up(oracle_use)
+
+        # Check oracle unlock
+        await check_oracle_unlock(ctx)
+
+        if metaphor:
+            safe_metaphor = html_mod.escape(metaphor)
+            await message.answer(
+                f"✨ <b>Оракул говорит:</b>\n\n"
+                f"<i>{safe_metaphor}</i>\n\n"
+                f"Отправлено Люту!",
+                parse_mode="HTML",
+            )
+            if ADMIN_ID:
+                user = message.from_user
+                name = html_mod.escape(user.full_name or user.username or "Неизвестная")
+                safe_text = html_mod.escape(text)
+                await enqueue_message(
+                    ADMIN_ID,
+                    f"🔮 <b>Новое желание из Шкатулки!</b>\n\n"
+                    f"👤 От: <b>{name}</b>\n\n"
+                    f"✨ <b>Метафора:</b>\n<i>{safe_metaphor}</i>",
+                    reply_target=message.from_user.id,
+                )
+        else:
+            await message.answer(
+                "😔 Оракул сейчас медитирует. Попробуй позже!",
+                parse_mode="HTML",
+            )
+
+
+def build_dates_keyboard() -> InlineKeyboardMarkup:
+    dates = [
+        ("28 марта", "2026-03-28"),
+        ("7 марта", "2026-03-07"),
+        ("26 марта (особенно:))", "2026-03-26"),
+    ]
+    buttons = [
+        [InlineKeyboardButton(text=f"📅 {label}", callback_data=f"date:{value}")]
+        for label, value in dates
+    ]
+    buttons.append(
+        [InlineKeyboardButton(text="✍️ Написать Люту (он ждёт)", callback_data="date:custom")]
+    )
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.callback_query(F.data.startswith("date:"))
+async def on_date_selected(callback: types.CallbackQuery, state: FSMContext):
+    raw = callback.data.split(":", 1)[1]
+
+    if raw == "custom":
+        await state.set_state(WriteForm.writing)
+        await callback.message.answer(
+            "✍️ <b>Напиши что угодно</b> — Лют получит твоё сообщение!\n\n"
+            "(секретная связь)\n\n"
+            "<i>Кнопки с датами всё ещё доступны выше ☝️</i>",
+            parse_mode="HTML",
+        )
+        await callback.answer()
+        return
+
+    try:
+        d = datetime.strptime(raw, "%Y-%m-%d")
+        pretty = d.strftime("%d.%m.%Y (%A)")
+    except ValueError:
+        pretty = raw
+
+    await callback.message.edit_text(
+        f"✅ <b>Отлично!</b>\n\n"
+        f"Ты записана на <b>{pretty}</b>.\n\n"
+        f"Они сошлись. Волна и камень. Стихи и проза, лед и пламень.",
+        parse_mode="HTML",
+    )
+
+    if ADMIN_ID:
+        user = callback.from_user
+        name = html_mod.escape(user.full_name or user.username or "Неизвестный")
+        await enqueue_message(
+            ADMIN_ID,
+            f"📋 <b>{name}</b> выбрала дату массажа: <b>{pretty}</b>",
+            reply_target=callback.from_user.id,
+        )
+
+    await callback.answer("Записано!")
+
+
+@dp.message(Command("send"), F.from_user.id == ADMIN_ID)
+async def cmd_send(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply("Формат: /send <chat_id> [текст]\nИли: /send <chat_id> + реплай на контент")
+        return
+
+    try:
+        target_chat_id = int(parts[1].split()[0])
+    except ValueError:
+        await message.reply("Неверный chat_id")
+        return
+
+    text_after_id = parts[1].split(maxsplit=1)[1] if len(parts[1].split()) > 1 else None
+
+    if text_after_id:
+        sent = await bot.send_message(target_chat_id, text_after_id)
+        await save_reply_target(message.message_id, target_chat_id)
+        await message.reply(f"✅ Отправлено в чат {target_chat_id}")
+    elif message.reply_to_message:
+        await message.reply_to_message.copy_to(target_chat_id)
+        await save_reply_target(message.message_id, target_chat_id)
+        await message.reply(f"✅ Контент отправлен в чат {target_chat_id}")
+    else:
+        await message.reply("Добавь текст после chat_id или реплайни на сообщение с контентом")
+
+
+@dp.message(F.reply_to_message, F.from_user.id == ADMIN_ID)
+async def on_admin_reply(message: types.Message):
+    replied_id = message.reply_to_message.message_id
+    user_chat_id = await get_reply_target(replied_id)
+    if not user_chat_id:
+        return
+
+    await message.copy_to(user_chat_id)
+    await message.reply("✅ Отправлено!")
+
+
+@dp.message(Command("prompt"), F.from_user.id == ADMIN_ID)
+async def cmd_prompt(message: types.Message):
+    """Admin sends a prompt to all users right now."""
+    text = message.text.split(maxsplit=1)
+    if len(text) < 2:
+        await message.reply("Формат: /prompt текст подсказки")
+        return
+
+    prompt_text = text[1].strip()
+    broadcast_id, total = await start_broadcast(prompt_text, message.chat.id)
+    if not total:
+        await message.reply("Нет зарегистрированных юзеров.")
+        return
+
+    await message.reply(
+        f"📨 Рассылка #{broadcast_id} запущена: {total} получателей.\n"
+        f"Прогресс будет приходить сюда."
+    )
+
+
+@dp.message(Command("wish"), F.from_user.id == ADMIN_ID)
+async def cmd_admin_wish(message: types.Message):
+    """Admin sends a wish to a specific user — Oracle encrypts it."""
+    parts = message.text.split(maxsplit=2)
+    if len(parts) < 3:
+        await message.reply("Формат: /wish &lt;user_id&gt; текст желания")
+        return
+
+    try:
+        target_id = int(parts[1])
+    except ValueError:
+        await message.reply("Неверный user_id")
+        return
+
+    wish_text = parts[2].strip()
+    admin_id = message.from_user.id
+
+    # Reserve a use on admin's oracle
+    ctx = await load_user_context(admin_id)
+    oracle_use, limit_msg = await reserve_oracle_use(ctx)
+    allowed = limit_msg is None
+    if not allowed:
+        await message.reply(f"{limit_msg}\nИспользую стандартного.", parse_mode="HTML")
+
+    await message.reply("🔮 Зашифровываю...")
+
+    try:
+        metaphor = await call_llm(wish_text, ctx if allowed else None)
+    except LLMQueueFull:
+        metaphor = None
+    if not metaphor:
+        await refund_oracle_use(oracle_use)
+        await message.reply("😔 Оракул сейчас медитирует.")
+        return
+
+    await announce_level_up(oracle_use)
+
+    safe_metaphor = html_mod.escape(metaphor)
+
+    # Get oracle name if admin uses a custom oracle
+    oracle_label = "Оракул"
+    if allowed and ctx and ctx.oracle_name:
+        oracle_label = f"Оракул «{html_mod.escape(ctx.oracle_name)}»"
+
+    try:
+        await bot.send_message(
+            target_id,
+            f"🔮 <b>{oracle_label} передаёт шифр от Люта:</b>\n\n"
+            f"<i>{safe_metaphor}</i>",
+            parse_mode="HTML",
+        )
+        await message.reply(
+            f"✅ Отправлено!\n\n"
+            f"<b>Метафора:</b>\n<i>{safe_metaphor}</i>",
+            parse_mode="HTML",
+        )
+    except Exception as e:
+        await message.reply(f"Не удалось отправить: {e}")
+
+
+@dp.message(Command("traces"), F.from_user.id == ADMIN_ID)
+async def cmd_traces(message: types.Message):
+    """Admin: the slowest recent /api/wish requests, stage by stage."""
+    parts = message.text.split(maxsplit=1)
+    try:
+        n = int(parts[1]) if len(parts) > 1 else 5
+    except ValueError:
+        await message.reply("Формат: /traces [N]")
+        return
+    traces, count = await slowest_traces(max(1, min(n, 50)))
+    if not traces:
+        await message.reply("Трейсов пока нет.")
+        return
+    text = "\n\n".join(format_trace(t) for t in traces)
+    header = f"🐢 Самые медленные из последних {count} желаний:\n\n"
+    if len(header) + len(text) <= 4000:
+        await message.reply(header + f"<pre>{html_mod.escape(text)}</pre>", parse_mode="HTML")
+    else:
+        await message.reply_document(
+            BufferedInputFile(text.encode(), filename="traces.txt"), caption=header.strip(),
+        )
+
+
+@dp.message(Command("profile"), F.from_user.id == ADMIN_ID)
+async def cmd_profile(message: types.Message):
+    """Admin: sample all threads of the bot process for N seconds."""
+    parts = message.text.split(maxsplit=1)
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else 10
+    except ValueError:
+        await message.reply("Формат: /profile [секунд]")
+        return
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+    if _profile_lock.locked():
+        await message.reply("Профилирование уже идёт.")
+        return
+    async with _profile_lock:
+        await message.reply(f"⏱ Профилирую {seconds:g} с…")
+        stacks, samples, idle = await run_profile(seconds)
+    if not stacks:
+        await message.reply(f"Все {samples} сэмплов — ожидание, процесс простаивал.")
+        return
+    busy = samples - idle
+    top = "\n".join(
+        f"{count * 100 / busy:5.1f}% {label}" for label, count in summarize_profile(stacks)
+    )
+    collapsed = "\n".join(
+        f"{key} {count}" for key, count in sorted(stacks.items(), key=lambda kv: -kv[1])
+    )
+    caption = f"{samples} сэмплов, {busy} не в ожидании.\n\n{top}"
+    filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed"
+    await message.reply_document(
+        BufferedInputFile(collapsed.encode(), filename=filename), caption=caption[:1024],
+    )
+
+
+@dp.message(Command("help"))
+async def cmd_help(message: types.Message):
+    """Show help — different output for admin vs regular user."""
+    text = (
+        "🔮 <b>Шкатулка Желаний — помощь</b>\n\n"
+        "/help — эта справка\n"
+        "/oracle — управление своими Оракулами\n"
+    )
+    if message.from_user.id == ADMIN_ID:
+        text += (
+            "\n👑 <b>Команды админа:</b>\n"
+            "/wish &lt;user_id&gt; текст — отправить шифр юзеру\n"
+            "/prompt текст — отправить подсказку всем\n"
+            "/send &lt;chat_id&gt; текст — отправить сообщение\n"
+            "/grant &lt;user_id&gt; — дать доступ к созданию Оракула\n"
+            "/taskdone &lt;user_id&gt; — засчитать задание юзеру\n"
+            "/traces [N] — самые медленные желания по этапам\n"
+            "/profile [N] — профиль процесса бота за N секунд\n"
+        )
+    await message.answer(text, parse_mode="HTML")
+
+
+@dp.message(Command("grant"), F.from_user.id == ADMIN_ID)
+async def cmd_grant(message: types.Message):
+    """Admin grants oracle creation access to a user."""
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply("Формат: /grant &lt;user_id&gt;", parse_mode="HTML")
+        return
+    try:
+        target_id = int(parts[1].strip())
+    except ValueError:
+        await message.reply("Неверный user_id")
+        return
+    cursor = await db.execute(
+        "UPDATE users SET can_create_oracle = 1 WHERE user_id = ?", (target_id,),
+        name="cmd_grant",
+    )
+    if cursor.rowcount == 0:
+        await message.reply("❌ Юзер не найден в базе (не запускал бота)")
+        return
+    await message.reply(f"✅ Доступ к созданию Оракула выдан для {target_id}")
+    try:
+        await bot.send_message(
+            target_id,
+            "🎉 <b>Тебе открыт доступ к созданию своего Оракула!</b>\n"
+            "Напиши /oracle чтобы начать.",
+            parse_mode="HTML",
+        )
+    except Exception:
+        pass
+
+
+@dp.message(Command("taskdone"), F.from_user.id == ADMIN_ID)
+async def cmd_taskdone(message: types.Message):
+    """Admin confirms a user completed a task. 2 tasks → level 3 for all oracles."""
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply("Формат: /taskdone &lt;user_id&gt;", parse_mode="HTML")
+        return
+    try:
+        target_id = int(parts[1].strip())
+    except ValueError:
+        await message.reply("Неверный user_id")
+        return
+
+    def _complete_task(conn):
+        row = conn.execute(
+            "SELECT tasks_completed FROM users WHERE user_id = ?", (target_id,)
+        ).fetchone()
+        if not row:
+            return None
+        old_count = row[0]
+        new_count = old_count + 1
+        conn.execute(
+            "UPDATE users SET tasks_completed = ? WHERE user_id = ?",
+            (new_count, target_id),
+        )
+        upgraded = 0
+        if new_count >= 2:
+            cursor = conn.execute(
+                "UPDATE custom_oracles SET level = 3 WHERE user_id = ? AND level = 2",
+                (target_id,),
+            )
+            upgraded = cursor.rowcount
+        return old_count, new_count, upgraded
+
+    result = await db.run(_complete_task)
+    if result is None:
+        await message.reply("❌ Юзер не найден в базе")
+        return
+    old_count, new_count, upgraded = result
+
+    await message.reply(f"✅ Задание засчитано для {target_id} ({new_count}/2)")
+
+    try:
+        if new_count >= 2 and old_count < 2 and upgraded > 0:
+            await bot.send_message(
+                target_id,
+                "🏆 <b>Ты выполнил(а) 2 задания!</b>\n"
+                "Все твои оракулы достигли уровня 3 — <b>безлимит!</b>",
+                parse_mode="HTML",
+            )
+        elif new_count >= 2 and old_count < 2:
+            await bot.send_message(
+                target_id,
+                "🏆 <b>Ты выполнил(а) 2 задания!</b>\n"
+                "Новые оракулы уровня 2 будут автоматически прокачаны до уровня 3.",
+                parse_mode="HTML",
+            )
+        elif new_count < 2:
+            await bot.send_message(
+                target_id,
+                f"🎉 <b>Задание засчитано!</b> ({new_count}/2)\n"
+                "Ещё одно — и твои оракулы получат безлимит!",
+                parse_mode="HTML",
+            )
+        else:
+            await bot.send_message(
+                target_id,
+                f"🎉 <b>Задание засчитано!</b> ({new_count} выполнено)",
+                parse_mode="HTML",
+            )
+    except Exception:
+        pass
+
+
+async def get_oracle_list_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Build inline keyboard with user's oracles + create button."""
+    def _load(conn):
+        oracles = conn.execute(
+            "SELECT id, name, level, uses FROM custom_oracles WHERE user_id = ? ORDER BY id",
+            (user_id,),
+        ).fetchall()
+        active_row = conn.execute(
+            "SELECT active_oracle_id FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return oracles, active_row
+
+    oracles, active_row = await db.run(_load)
+    active_id = active_row[0] if active_row and active_row[0] else None
+
+    buttons = []
+    for oid, name, level, uses in oracles:
+        marker = " ✅" if oid == active_id else ""
+        lvl_info = ORACLE_LEVELS.get(level, ORACLE_LEVELS[1])
+        max_u = lvl_info["max_uses"]
+        lvl_name = lvl_info["name"]
+        progress = f"{uses}/∞" if max_u is None else f"{uses}/{max_u}"
+        # Row 1: info + select
+        buttons.append([
+            InlineKeyboardButton(
+                text=f"🔮 {name}{marker} — {lvl_name} {progress}",
+                callback_data=f"oracle_select:{oid}",
+            ),
+        ])
+        # Row 2: actions
+        buttons.append([
+            InlineKeyboardButton(text="👁", callback_data=f"oracle_info:{oid}"),
+            InlineKeyboardButton(text="✏️", callback_data=f"oracle_edit:{oid}"),
+            InlineKeyboardButton(text="🗑", callback_data=f"oracle_delete:{oid}"),
+        ])
+    if active_id:
+        buttons.append([
+            InlineKeyboardButton(
+                text="↩️ Стандартный Оракул",
+                callback_data="oracle_select:0",
+            )
+        ])
+    buttons.append([
+        InlineKeyboardButton(text="➕ Создать нового", callback_data="oracle_create")
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(Command("oracle"))
+async def cmd_oracle(message: types.Message):
+    """Show user's custom oracles."""
+    user_id = message.from_user.id
+    row = await db.fetchone(
+        "SELECT can_create_oracle FROM users WHERE user_id = ?", (user_id,),
+        name="cmd_oracle",
+    )
+
+    if not row or (not row[0] and user_id != ADMIN_ID):
+        await message.answer(
+            "🔒 Создание Оракулов пока недоступно.\n"
+            "Отправь 3 шифра через Шкатулку, чтобы разблокировать!"
+        )
+        return
+
+    kb = await get_oracle_list_keyboard(user_id)
+    await message.answer(
+        "🔮 <b>Твои Оракулы</b>\n\n"
+        "Выбери активного или создай нового:\n\n"
+        "📊 <b>Прокачка оракулов:</b>\n"
+        "▫️ Лвл 1 (Новичок) → макс 3 запроса\n"
+        "▫️ Лвл 2 (Мастер) → макс 10 запросов\n"
+        "▫️ Лвл 3 (Великий) → безлимит ∞\n\n"
+        "⬆️ <b>Как прокачать:</b>\n"
+        "• Лвл 1 → 2: используй любого оракула 3 раза\n"
+        "• Лвл 2 → 3: выполни 2 задания от Оракула",
+        reply_markup=kb,
+        parse_mode="HTML",
+    )
+
+
+@dp.callback_query(F.data == "oracle_create")
+async def on_oracle_create(callback: types.CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    row = await db.fetchone(
+        "SELECT can_create_oracle FROM users WHERE user_id = ?", (user_id,),
+        name="on_oracle_create",
+    )
+    if not row or (not row[0] and user_id != ADMIN_ID):
+        await callback.answer("🔒 Нет доступа", show_alert=True)
+        return
+
+    await state.set_state(OracleForm.awaiting_name)
+    await state.set_data({})
+    await callback.message.answer(
+        "✍️ <b>Как назвать Оракула?</b>\n\n"
+        "Например: Нерд, Поэт, Пират\n\n"
+        "<i>Напиши «отмена» чтобы отменить</i>",
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("oracle_select:"))
+async def on_oracle_select(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    if oracle_id == 0:
+        await db.execute(
+            "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
+            (user_id,),
+            name="on_oracle_select",
+        )
+        await callback.answer("✅ Стандартный Оракул активирован")
+        kb = await get_oracle_list_keyboard(user_id)
+        try:
+            await callback.message.edit_reply_markup(reply_markup=kb)
+        except Exception:
+            pass
+        return
+    # Verify oracle belongs to user
+    row = await db.run(_activate_oracle, user_id, oracle_id)
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    await callback.answer(f"✅ Оракул «{row[0]}» активирован")
+    kb = await get_oracle_list_keyboard(user_id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+
+
+@dp.callback_query(F.data.startswith("oracle_delete:"))
+async def on_oracle_delete(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    row = await db.fetchone(
+        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
+        (oracle_id, user_id),
+        name="on_oracle_delete",
+    )
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"🗑 Да, удалить «{row[0]}»",
+            callback_data=f"oracle_confirm_delete:{oracle_id}",
+        )],
+        [InlineKeyboardButton(
+            text="↩️ Отмена",
+            callback_data="oracle_cancel_delete",
+        )],
+    ])
+    try:
+        await callback.message.edit_reply_markup(reply_markup=confirm_kb)
+    except Exception:
+        pass
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("oracle_confirm_delete:"))
+async def on_oracle_confirm_delete(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    def _delete(conn):
+        row = conn.execute(
+            "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
+            (oracle_id, user_id),
+        ).fetchone()
+        if not row:
+            return None
+        conn.execute("DELETE FROM custom_oracles WHERE id = ?", (oracle_id,))
+        conn.execute(
+            "UPDATE users SET active_oracle_id = NULL WHERE user_id = ? AND active_oracle_id = ?",
+            (user_id, oracle_id),
+        )
+        return row
+
+    row = await db.run(_delete)
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    await callback.answer(f"🗑 Оракул «{row[0]}» удалён")
+    kb = await get_oracle_list_keyboard(user_id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+
+
+@dp.callback_query(F.data == "oracle_cancel_delete")
+async def on_oracle_cancel_delete(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    kb = await get_oracle_list_keyboard(user_id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+    await callback.answer("Отменено")
+
+
+@dp.callback_query(F.data == "oracle_reset_standard")
+async def on_oracle_reset_standard(callback: types.CallbackQuery):
+    """Switch to standard oracle from the limit-hit keyboard."""
+    user_id = callback.from_user.id
+    await db.execute(
+        "UPDATE users SET active_oracle_id = NULL WHERE user_id = ?",
+        (user_id,),
+        name="on_oracle_reset_standard",
+    )
+    try:
+        await callback.message.edit_text(
+            "✅ Переключено на стандартного Оракула.",
+        )
+    except Exception:
+        pass
+    await callback.answer("✅ Стандартный Оракул активирован")
+
+
+@dp.callback_query(F.data == "oracle_list")
+async def on_oracle_list(callback: types.CallbackQuery):
+    """Show oracle list from the limit-hit keyboard."""
+    user_id = callback.from_user.id
+    kb = await get_oracle_list_keyboard(user_id)
+    await callback.message.answer(
+        "🔮 <b>Твои Оракулы</b>\n\nВыбери активного:",
+        reply_markup=kb,
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("oracle_edit:"))
+async def on_oracle_edit(callback: types.CallbackQuery, state: FSMContext):
+    """Enter edit mode for an oracle via inline button."""
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    row = await db.fetchone(
+        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
+        (oracle_id, user_id),
+        name="on_oracle_edit",
+    )
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    safe_name = html_mod.escape(row[0])
+    await state.set_state(OracleForm.awaiting_edit_description)
+    await state.set_data({"oracle_id": oracle_id})
+    await callback.message.answer(
+        f"✏️ <b>Редактирование оракула «{safe_name}»</b>\n\n"
+        "Опиши новый характер оракула.\n"
+        "Например: <i>«саркастичный философ, который цитирует Ницше»</i>\n\n"
+        "<i>Напиши «отмена» чтобы отменить</i>",
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("oracle_info:"))
+async def on_oracle_info(callback: types.CallbackQuery):
+    """Show oracle prompt preview as alert popup."""
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    row = await db.fetchone(
+        "SELECT name, prompt FROM custom_oracles WHERE id = ? AND user_id = ?",
+        (oracle_id, user_id),
+        name="on_oracle_info",
+    )
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    name, prompt = row
+    header = f"🔮 «{name}»:\n"
+    max_preview = 200 - len(header)
+    preview = prompt[:max_preview - 3] + "..." if len(prompt) > max_preview else prompt
+    await callback.answer(header + preview, show_alert=True)
+
+
+@dp.callback_query(F.data.startswith("oracle_activate:"))
+async def on_oracle_activate_after_create(callback: types.CallbackQuery):
+    """Activate oracle right after creation."""
+    user_id = callback.from_user.id
+    oracle_id = int(callback.data.split(":")[1])
+    row = await db.run(_activate_oracle, user_id, oracle_id)
+    if not row:
+        await callback.answer("Оракул не найден", show_alert=True)
+        return
+    safe_name = html_mod.escape(row[0])
+    await callback.message.edit_text(
+        f"✅ Оракул «{safe_name}» создан и активирован!",
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "oracle_activate_no")
+async def on_oracle_activate_no(callback: types.CallbackQuery):
+    await callback.message.edit_text(
+        "✅ Оракул создан, но не активирован.\n"
+        "Выбрать его можно в /oracle",
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@dp.message(Command("editoracle"))
+async def cmd_editoracle(message: types.Message):
+    """Edit an existing oracle: /editoracle <id> новое описание"""
+    user_id = message.from_user.id
+    parts = message.text.split(maxsplit=2)
+    if len(parts) < 3:
+        await message.reply(
+            "Формат: /editoracle &lt;id&gt; новое описание",
+            parse_mode="HTML",
+        )
+        return
+    try:
+        oracle_id = int(parts[1])
+    except ValueError:
+        await message.reply("Неверный id оракула")
+        return
+    description = parts[2].strip()
+    row = await db.fetchone(
+        "SELECT name FROM custom_oracles WHERE id = ? AND user_id = ?",
+        (oracle_id, user_id),
+        name="cmd_editoracle",
+    )
+    if not row:
+        await message.reply("Оракул не найден")
+        return
+    await message.reply("🔄 Пересоздаю промпт...")
+    new_prompt = await generate_oracle_prompt(description)
+    if not new_prompt:
+        await message.reply("😔 Не удалось сгенерировать промпт. Попробуй позже.")
+        return
+    await db.execute(
+        "UPDATE custom_oracles SET prompt = ? WHERE id = ? AND user_id = ?",
+        (new_prompt, oracle_id, user_id),
+        name="cmd_editoracle",
+    )
+    safe_name = html_mod.escape(row[0])
+    await message.reply(
+        f"✅ Оракул «{safe_name}» обновлён!",
+        parse_mode="HTML",
+    )
+
+
+CANCEL_WORDS = ("отмена", "cancel", "/cancel")
+
+
+@dp.message(StateFilter(OracleForm), F.text.func(lambda t: t.strip().lower() in CANCEL_WORDS))
+async def on_oracle_form_cancel(message: types.Message, state: FSMContext):
+    await state.clear()
+    await message.answer("❌ Создание оракула отменено.")
+
+
+@dp.message(OracleForm.awaiting_name, F.text, ~F.text.startswith("/"))
+async def on_oracle_form_name(message: types.Message, state: FSMContext):
+    name = message.text.strip()
+    if len(name) > 50:
+        await message.answer("Слишком длинное имя. Максимум 50 символов.")
+        return
+    await state.set_state(OracleForm.awaiting_description)
+    await state.set_data({"name": name})
+    safe_name = html_mod.escape(name)
+    await message.answer(
+        f"👍 Оракул будет называться <b>«{safe_name}»</b>\n\n"
+        "Теперь опиши, какой он должен быть.\n"
+        "Например: <i>«дерзкий технический нерд, который всё объясняет через код»</i>",
+        parse_mode="HTML",
+    )
+
+
+@dp.message(OracleForm.awaiting_description, F.text, ~F.text.startswith("/"))
+async def on_oracle_form_description(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    description = message.text.strip()
+    draft = await state.get_data()
+    oracle_name = draft.get("name", "Оракул")
+    safe_name = html_mod.escape(oracle_name)
+
+    await message.answer(f"🔮 Создаю Оракула <b>«{safe_name}»</b>...", parse_mode="HTML")
+    prompt = await generate_oracle_prompt(description)
+    if not prompt:
+        await message.answer("😔 Не удалось создать Оракула. Попробуй ещё раз.")
+        await state.clear()
+        return
+
+    cursor = await db.execute(
+        "INSERT INTO custom_oracles (user_id, name, prompt) VALUES (?, ?, ?)",
+        (user_id, oracle_name, prompt),
+        name="on_oracle_form_description",
+    )
+    new_id = cursor.lastrowid
+
+    await state.clear()
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="✅ Да, сделать активным",
+                callback_data=f"oracle_activate:{new_id}",
+            ),
+            InlineKeyboardButton(
+                text="Нет",
+                callback_data="oracle_activate_no",
+            ),
+        ]
+    ])
+    await message.answer(
+        f"✅ Оракул <b>«{safe_name}»</b> создан!\n\n"
+        "Хочешь сделать его активным?",
+        reply_markup=kb,
+        parse_mode="HTML",
+    )
+
+
+@dp.message(OracleForm.awaiting_edit_description, F.text, ~F.text.startswith("/"))
+async def on_oracle_form_edit_description(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    description = message.text.strip()
+    draft = await state.get_data()
+    oracle_id = draft.get("oracle_id")
+    if not oracle_id:
+        await state.clear()
+        return
+
+    await message.answer("🔄 Пересоздаю промпт...")
+    new_prompt = await generate_oracle_prompt(description)
+    if not new_prompt:
+        await message.answer("😔 Не удалось сгенерировать. Попробуй позже.")
+        await state.clear()
+        return
+
+    await db.execute(
+        "UPDATE custom_oracles SET prompt = ? WHERE id = ? AND user_id = ?",
+        (new_prompt, oracle_id, user_id),
+        name="on_oracle_form_edit_description",
+    )
+
+    await state.clear()
+    await message.answer("✅ Оракул обновлён!")
+
+
+@dp.message(F.text, ~F.text.startswith("/"))
+@dp.message(~F.content_type.in_({"web_app_data"}), ~F.text)
+async def on_user_message(message: types.Message, state: FSMContext,
+                          raw_state: str | None = None):
+    user_id = message.from_user.id
+
+    if user_id == ADMIN_ID:
+        return
+
+    user = message.from_user
+    name = html_mod.escape(user.full_name or user.username or "Неизвестный")
+
+    if raw_state == WriteForm.writing.state:
+        await state.clear()
+
+    if ADMIN_ID:
+        await bot.send_message(
+            ADMIN_ID,
+            f"💬 <b>{name}:</b>\n<i>↩️ Ответь реплаем на сообщение ниже — она получит</i>",
+            parse_mode="HTML",
+        )
+        forwarded = await message.forward(ADMIN_ID)
+        await save_reply_target(forwarded.message_id, message.from_user.id)
+
+    await message.answer("✅ Сообщение отправлено Люту!")
+
+
+# ==================== MAIN ====================
+
+def start_outbox_senders() -> list[asyncio.Task]:
+    return [asyncio.create_task(outbox_sender()) for _ in range(OUTBOX_SENDERS)]
+
+
+async def start_api_server(reuse_port: bool = False) -> web.AppRunner:
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", API_PORT, reuse_port=reuse_port)
+    await site.start()
+    print(f"API server started on 0.0.0.0:{API_PORT} (pid {os.getpid()})")
+    return runner
+
+
+async def start_webhook_server() -> web.AppRunner:
+    """Webhook-only server of the main process, used with API_WORKERS."""
+    app = web.Application()
+    mount_webhook(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT)
+    await site.start()
+    print(f"Webhook server started on 0.0.0.0:{WEBHOOK_PORT}")
+    return runner
+
+
+# ==================== API WORKERS ====================
+# With API_WORKERS=N the main process starts N API processes that bind the
+# same port with SO_REUSEPORT, so the kernel spreads connections across
+# cores. Everything they share — users, oracles, FSM state, reply map,
+# wish jobs, outbox — already lives in the SQLite database (WAL mode), so
+# no extra service is needed. The main process keeps the update loop (long
+# polling, or the webhook on WEBHOOK_PORT) and the singletons: job and
+# broadcast resume, row expiry.
+
+
+async def api_worker(index: int):
+    global metrics_worker
+    metrics_worker = f"api-{index}"
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    watchdog = start_loop_watchdog()
+    if llm_configured():
+        get_llm_backend()
+    llm_queue.start()
+    senders = start_outbox_senders()
+    snapshots = asyncio.create_task(metrics_snapshot_loop())
+    runner = await start_api_server(reuse_port=True)
+    try:
+        await stop.wait()
+    finally:
+        if watchdog:
+            watchdog.stop()
+        snapshots.cancel()
+        for task in senders:
+            task.cancel()
+        await runner.cleanup()
+        await llm_queue.stop()
+        await close_llm_backend()
+        await bot.session.close()
+        await db.close()
+
+
+def run_api_worker(index: int):
+    asyncio.run(api_worker(index))
+
+
+def start_api_process(index: int) -> multiprocessing.Process:
+    # spawn: a fresh interpreter, not a fork of a process with live threads
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_api_worker, args=(index,), name=f"api-worker-{index}", daemon=True,
+    )
+    process.start()
+    return process
+
+
+async def supervise_api_workers(processes: list[multiprocessing.Process]):
+    """Restart API workers that exit; their unfinished wish jobs move here."""
+    while True:
+        await asyncio.sleep(5)
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"API worker {process.pid} exited ({process.exitcode}), restarting")
+                # Before the restart, or the new worker's jobs would be taken too
+                try:
+                    await resume_wish_jobs(f"api-{i}")
+                except Exception as e:
+                    print(f"Resuming wish jobs of api-{i} failed: {e}")
+                processes[i] = start_api_process(i)
+
+
+def stop_api_workers(processes: list[multiprocessing.Process]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=10)
+
+
+async def main():
+    watchdog = start_loop_watchdog()
+    await init_db()
+    await db.run(_import_reply_map_file)
+    if llm_configured():
+        get_llm_backend()
+    llm_queue.start()
+    await resume_wish_jobs()
+    await resume_broadcasts()
+    senders = start_outbox_senders()
+    expiry_task = asyncio.create_task(expire_stale_rows_loop())
+
+    # Start aiohttp API server, in this process or in API_WORKERS processes
+    runner = None
+    workers: list[multiprocessing.Process] = []
+    if API_WORKERS > 0:
+        workers = [start_api_process(i) for i in range(API_WORKERS)]
+        supervisor = asyncio.create_task(supervise_api_workers(workers))
+        snapshots = asyncio.create_task(metrics_snapshot_loop())
+        if WEBHOOK_URL:
+            runner = await start_webhook_server()
+    else:
+        runner = await start_api_server()
+
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            print(f"Bot started (webhook {WEBHOOK_URL + WEBHOOK_PATH})")
+            await asyncio.Event().wait()
+        else:
+            # Start bot polling
+            print("Bot started")
+            await bot.delete_webhook()   # in case webhook mode was used before
+            await dp.start_polling(bot)
+    finally:
+        if watchdog:
+            watchdog.stop()
+        expiry_task.cancel()
+        for task in senders:
+            task.cancel()
+        if workers:
+            supervisor.cancel()
+            snapshots.cancel()
+            stop_api_workers(workers)
+        if runner:
+            await runner.cleanup()
+        if WEBHOOK_URL:
+            await bot.session.close()
+        await llm_queue.stop()
+        await close_llm_backend()
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,11 @@
+"""Point bot.py at a scratch database before any test module imports it."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# bot.py reads its settings at import time
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-fake-token")
+os.environ["RATE_LIMITS"] = ""
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
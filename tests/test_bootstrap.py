@@ -0,0 +1,40 @@
+"""GET /api/bootstrap: ETag revalidation."""
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+import bot
+
+
+async def bootstrap(user_id: int, etag: str | None = None):
+    headers = {"If-None-Match": etag} if etag else {}
+    request = make_mocked_request("GET", f"/api/bootstrap?uid={user_id}", headers=headers)
+    return await bot.handle_bootstrap(request)
+
+
+def test_unchanged_user_revalidates_with_304():
+    async def scenario():
+        await bot.init_db()
+        await bot.register_user(5001, "Test")
+        first = await bootstrap(5001)
+        again = await bootstrap(5001, first.headers["ETag"])
+        listed = await bootstrap(5001, f'"stale", {first.headers["ETag"]}')
+        return first, again, listed
+
+    first, again, listed = asyncio.run(scenario())
+    assert first.status == 200 and first.headers["ETag"]
+    assert again.status == 304 and again.headers["ETag"] == first.headers["ETag"]
+    assert listed.status == 304
+
+
+def test_change_invalidates_etag():
+    async def scenario():
+        await bot.init_db()
+        await bot.register_user(5002, "Test")
+        first = await bootstrap(5002)
+        await bot.save_wish(5002, "Test", "Хочу в Париж", "metaphor")
+        return first, await bootstrap(5002, first.headers["ETag"])
+
+    first, after = asyncio.run(scenario())
+    assert after.status == 200
+    assert after.headers["ETag"] != first.headers["ETag"]
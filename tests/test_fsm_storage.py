@@ -0,0 +1,64 @@
+"""aiogram FSM state kept in the fsm_state table."""
+import asyncio
+import time
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import bot
+
+
+class Form(StatesGroup):
+    name = State()
+
+
+def key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=123456, chat_id=user_id, user_id=user_id)
+
+
+async def fsm_rows(user_id: int) -> int:
+    row = await bot.db.fetchone(
+        "SELECT COUNT(*) FROM fsm_state WHERE key = ?",
+        (bot.SQLiteStorage(bot.db)._key(key(user_id)),),
+        name="fsm_rows",
+    )
+    return row[0]
+
+
+def test_state_and_data_round_trip():
+    async def scenario():
+        await bot.init_db()
+        storage = bot.SQLiteStorage(bot.db)
+        await storage.set_state(key(4001), Form.name)
+        await storage.set_data(key(4001), {"name": "Оракул", "level": 2})
+        # A fresh storage object reads what the last one wrote
+        storage = bot.SQLiteStorage(bot.db)
+        return await storage.get_state(key(4001)), await storage.get_data(key(4001))
+
+    assert asyncio.run(scenario()) == (Form.name.state, {"name": "Оракул", "level": 2})
+
+
+def test_cleared_state_leaves_no_row():
+    async def scenario():
+        await bot.init_db()
+        storage = bot.SQLiteStorage(bot.db)
+        await storage.set_state(key(4002), Form.name)
+        await storage.set_data(key(4002), {"name": "x"})
+        await storage.set_state(key(4002), None)
+        await storage.set_data(key(4002), {})
+        return await storage.get_state(key(4002)), await fsm_rows(4002)
+
+    assert asyncio.run(scenario()) == (None, 0)
+
+
+def test_idle_state_expires(monkeypatch):
+    async def scenario():
+        await bot.init_db()
+        storage = bot.SQLiteStorage(bot.db, ttl=60)
+        await storage.set_state(key(4003), Form.name)
+        await storage.set_data(key(4003), {"name": "x"})
+        monkeypatch.setattr(bot.time, "time", lambda: now + 61)
+        return await storage.get_state(key(4003)), await storage.get_data(key(4003))
+
+    now = time.time()
+    assert asyncio.run(scenario()) == (None, {})
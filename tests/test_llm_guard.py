@@ -0,0 +1,125 @@
+"""Circuit breaker state transitions and hedged LLM calls."""
+import asyncio
+
+import pytest
+
+import bot
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    return clock
+
+
+def open_breaker() -> bot.CircuitBreaker:
+    breaker = bot.CircuitBreaker(threshold=3, cooldown=30, probe_timeout=20)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = bot.CircuitBreaker(threshold=3, cooldown=30, probe_timeout=20)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()   # resets the consecutive count
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    clock.now += 10
+    assert breaker.retry_after() == 20
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.retry_after() == 30
+
+
+def test_lost_probe_is_replaced_after_probe_timeout(clock):
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 20
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def make_calls(*behaviours):
+    """make_call for hedged_call: the n-th call sleeps, then returns or raises."""
+    started = []
+
+    async def call():
+        delay, result = behaviours[len(started)]
+        started.append(asyncio.current_task())
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return call, started
+
+
+def test_hedge_wins_over_slow_attempt():
+    async def scenario():
+        call, started = make_calls((1.0, "slow"), (0.01, "fast"))
+        result = await bot.hedged_call(call, timeout=2, hedge_delay=0.05, attempts=2)
+        await asyncio.sleep(0)
+        return result, started
+
+    result, started = asyncio.run(scenario())
+    assert result == "fast"
+    assert len(started) == 2 and started[0].cancelled()
+
+
+def test_failed_attempt_is_retried_without_waiting_for_hedge_delay():
+    async def scenario():
+        call, started = make_calls((0, RuntimeError("boom")), (0, "ok"))
+        result = await bot.hedged_call(call, timeout=2, hedge_delay=10, attempts=2)
+        return result, len(started)
+
+    assert asyncio.run(scenario()) == ("ok", 2)
+
+
+def test_last_error_is_raised_when_every_attempt_fails():
+    call, _ = make_calls((0, RuntimeError("first")), (0, ValueError("second")))
+    with pytest.raises(ValueError):
+        asyncio.run(bot.hedged_call(call, timeout=2, attempts=2))
+
+
+def test_deadline_cancels_pending_attempts():
+    async def scenario():
+        call, started = make_calls((10, "late"))
+        with pytest.raises(asyncio.TimeoutError):
+            await bot.hedged_call(call, timeout=0.05)
+        await asyncio.sleep(0)
+        return started
+
+    started = asyncio.run(scenario())
+    assert started[0].cancelled()
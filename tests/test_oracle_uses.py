@@ -0,0 +1,61 @@
+"""Oracle use reservation and refund against a scratch database."""
+import asyncio
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def make_oracle(user_id: int, level: int, uses: int) -> int:
+    await bot.init_db()
+    await bot.register_user(user_id, "Test")
+    cursor = await bot.db.execute(
+        "INSERT INTO custom_oracles (user_id, name, prompt, level, uses) "
+        "VALUES (?, 'Тест', 'prompt', ?, ?)",
+        (user_id, level, uses),
+        name="make_oracle",
+    )
+    oracle_id = cursor.lastrowid
+    await bot.db.execute(
+        "UPDATE users SET active_oracle_id = ? WHERE user_id = ?", (oracle_id, user_id),
+        name="make_oracle",
+    )
+    return oracle_id
+
+
+async def oracle_row(oracle_id: int) -> tuple:
+    return await bot.db.fetchone(
+        "SELECT level, uses FROM custom_oracles WHERE id = ?", (oracle_id,),
+        name="oracle_row",
+    )
+
+
+def test_refund_undoes_level_up():
+    async def scenario():
+        oracle_id = await make_oracle(1001, level=1, uses=2)
+        ctx = await bot.load_user_context(1001)
+        use, limit_msg = await bot.reserve_oracle_use(ctx)
+        assert limit_msg is None and use.leveled_up and use.level == 2
+        await bot.refund_oracle_use(use)
+        return await oracle_row(oracle_id)
+
+    assert run(scenario()) == (1, 2)
+
+
+def test_refund_keeps_level_up_other_use_depends_on():
+    async def scenario():
+        oracle_id = await make_oracle(1002, level=1, uses=2)
+        ctx = await bot.load_user_context(1002)
+        first, _ = await bot.reserve_oracle_use(ctx)
+        second, _ = await bot.reserve_oracle_use(ctx)
+        assert first.leveled_up and not second.leveled_up
+        await bot.refund_oracle_use(first)
+        after_refund = await oracle_row(oracle_id)
+        third, limit_msg = await bot.reserve_oracle_use(ctx)
+        return after_refund, third, limit_msg
+
+    after_refund, third, limit_msg = run(scenario())
+    assert after_refund == (2, 3)
+    assert limit_msg is None and third.level == 2 and third.uses == 4
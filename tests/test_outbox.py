@@ -0,0 +1,156 @@
+"""Outbox claiming, leases and the delivery retry paths."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """An empty outbox, and a send_message that fails with the queued errors."""
+    errors = []
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        if errors:
+            raise errors.pop(0)
+        sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(sent))
+
+    async def clear():
+        await bot.init_db()
+        await bot.db.execute("DELETE FROM outbox", name="clear")
+
+    run(clear())
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    monkeypatch.setattr(bot, "_outbox_paused_until", 0.0)
+    return SimpleNamespace(errors=errors, sent=sent)
+
+
+async def outbox_rows() -> list:
+    return await bot.db.fetchall(
+        "SELECT chat_id, attempts, next_attempt_at FROM outbox ORDER BY id", name="outbox_rows",
+    )
+
+
+async def deliver_one():
+    row = await bot.db.run(bot._claim_outbox_message)
+    await bot._deliver_outbox_message(row)
+
+
+def test_claim_hides_message_for_the_lease(outbox):
+    async def scenario():
+        await bot.enqueue_message(3001, "hello")
+        first = await bot.db.run(bot._claim_outbox_message)
+        second = await bot.db.run(bot._claim_outbox_message)
+        # Lease expired: the sender holding it died
+        await bot.db.execute("UPDATE outbox SET next_attempt_at = 0", name="expire")
+        third = await bot.db.run(bot._claim_outbox_message)
+        return first, second, third, await outbox_rows()
+
+    first, second, third, rows = run(scenario())
+    assert first[1:3] == (3001, "hello") and first[-1] == 1
+    assert second is None
+    assert third[0] == first[0] and third[-1] == 2
+    assert rows[0][2] >= time.time() + bot.OUTBOX_LEASE - 5
+
+
+def test_delivered_message_is_deleted(outbox):
+    async def scenario():
+        await bot.enqueue_message(3002, "hello")
+        await deliver_one()
+        return await outbox_rows()
+
+    assert run(scenario()) == []
+    assert outbox.sent == [(3002, "hello")]
+
+
+def test_failure_schedules_retry_with_backoff(outbox):
+    outbox.errors.append(RuntimeError("network down"))
+
+    async def scenario():
+        await bot.enqueue_message(3003, "hello")
+        await deliver_one()
+        return await outbox_rows()
+
+    [(chat_id, attempts, next_attempt_at)] = run(scenario())
+    assert attempts == 1
+    assert next_attempt_at == pytest.approx(time.time() + 2, abs=1)
+
+
+def test_message_dropped_after_max_attempts(outbox):
+    outbox.errors.append(RuntimeError("network down"))
+
+    async def scenario():
+        await bot.enqueue_message(3004, "hello")
+        await bot.db.execute(
+            "UPDATE outbox SET attempts = ?", (bot.OUTBOX_MAX_ATTEMPTS - 1,), name="age",
+        )
+        await deliver_one()
+        return await outbox_rows()
+
+    assert run(scenario()) == []
+
+
+def test_blocked_chat_is_dropped(outbox):
+    outbox.errors.append(TelegramForbiddenError(None, "bot was blocked by the user"))
+
+    async def scenario():
+        await bot.enqueue_message(3005, "hello")
+        await deliver_one()
+        return await outbox_rows()
+
+    assert run(scenario()) == [] and outbox.sent == []
+
+
+def test_flood_control_pauses_without_using_an_attempt(outbox):
+    outbox.errors.append(TelegramRetryAfter(None, "Too Many Requests", retry_after=7))
+
+    async def scenario():
+        await bot.enqueue_message(3006, "hello")
+        await deliver_one()
+        return await outbox_rows()
+
+    [(_, attempts, next_attempt_at)] = run(scenario())
+    assert attempts == 0
+    assert next_attempt_at == pytest.approx(time.time() + 7, abs=1)
+    assert bot._outbox_paused_until > time.monotonic() + 5
+
+
+def test_sender_survives_a_failing_delivery(outbox, monkeypatch):
+    deliver = bot._deliver_outbox_message
+    attempted = []
+
+    async def flaky_deliver(row):
+        attempted.append(row[1])
+        if len(attempted) == 1:
+            raise RuntimeError("database is locked")
+        await deliver(row)
+
+    monkeypatch.setattr(bot, "_deliver_outbox_message", flaky_deliver)
+    monkeypatch.setattr(bot, "outbox_wakeup", asyncio.Event())
+
+    async def scenario():
+        await bot.enqueue_message(3007, "first")
+        await bot.enqueue_message(3008, "second")
+        sender = asyncio.create_task(bot.outbox_sender(poll_interval=0.05))
+        for _ in range(100):
+            if outbox.sent:
+                break
+            await asyncio.sleep(0.01)
+        sender.cancel()
+        return await outbox_rows()
+
+    rows = run(scenario())
+    assert attempted[:2] == [3007, 3008]
+    assert outbox.sent == [(3008, "second")]
+    # The first message waits out its lease and is retried later
+    assert [row[0] for row in rows] == [3007]
@@ -0,0 +1,69 @@
+"""Token-bucket rate limiter and the RATE_LIMITS override parser."""
+import pytest
+
+import bot
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    return clock
+
+
+def test_burst_then_refill(clock):
+    limiter = bot.RateLimiter(idle_ttl=60)
+    limits = [(("/api/wish", "uid", "1"), 0.5, 2)]
+    assert limiter.take(limits) == 0
+    assert limiter.take(limits) == 0
+    assert limiter.take(limits) == pytest.approx(2.0)
+    clock.now += 1.5
+    assert limiter.take(limits) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter.take(limits) == 0
+
+
+def test_refused_request_takes_from_no_bucket(clock):
+    limiter = bot.RateLimiter(idle_ttl=60)
+    uid = (("/api/wish", "uid", "1"), 1.0, 1)
+    ip = (("/api/wish", "ip", "10.0.0.1"), 1.0, 5)
+    assert limiter.take([uid, ip]) == 0
+    for _ in range(3):
+        assert limiter.take([uid, ip]) > 0
+    # The ip bucket only paid for the admitted request
+    assert limiter.take([ip]) == 0 and limiter.take([ip]) == 0
+    assert limiter.take([ip]) == 0 and limiter.take([ip]) == 0
+    assert limiter.take([ip]) > 0
+
+
+def test_idle_and_excess_buckets_are_evicted(clock):
+    limiter = bot.RateLimiter(idle_ttl=10, max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.take([((key,), 1.0, 1)])
+    assert len(limiter) == 2
+    clock.now += 10
+    limiter.take([(("d",), 1.0, 1)])
+    assert len(limiter) == 1
+    # An evicted bucket comes back full
+    assert limiter.take([(("a",), 1.0, 1)]) == 0
+
+
+@pytest.mark.parametrize("value", ["", "{}"])
+def test_empty_overrides(monkeypatch, value):
+    monkeypatch.setenv("RATE_LIMITS", value)
+    assert bot.load_rate_limit_overrides() == {}
+
+
+@pytest.mark.parametrize("value", ["{", "[]", '{"/api/wish": [6, 3]}'])
+def test_malformed_overrides_are_rejected(monkeypatch, value):
+    monkeypatch.setenv("RATE_LIMITS", value)
+    with pytest.raises(SystemExit):
+        bot.load_rate_limit_overrides()
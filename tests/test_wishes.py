@@ -0,0 +1,34 @@
+"""Wish bookkeeping: the denormalized wishes_count and the bootstrap ETag."""
+import asyncio
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_save_wish_counts_registered_user():
+    async def scenario():
+        await bot.init_db()
+        await bot.register_user(2001, "Test")
+        await bot.save_wish(2001, "Test", "Хочу в Париж", "metaphor")
+        await bot.save_wish(2001, "Test", "Хочу собаку", "metaphor")
+        return await bot.load_user_context(2001)
+
+    assert run(scenario()).wishes_count == 2
+
+
+def test_save_wish_creates_row_for_unknown_uid():
+    async def scenario():
+        await bot.init_db()
+        before, _ = await bot.load_bootstrap(2002)
+        await bot.save_wish(2002, "Webapp", "Хочу в Париж", "metaphor")
+        after, data = await bot.load_bootstrap(2002)
+        await bot.register_user(2002, "Webapp")   # /start later keeps the count
+        return before, after, data, await bot.load_user_context(2002)
+
+    before, after, data, ctx = run(scenario())
+    assert data["wishes_count"] == 1 and ctx.wishes_count == 1
+    # A cached row-less bootstrap must not revalidate against the new row
+    assert bot.bootstrap_etag(2002, before) != bot.bootstrap_etag(2002, after)
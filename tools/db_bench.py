@@ -0,0 +1,280 @@
+"""DB micro-benchmark: bot.py's database functions against a large synthetic wishes.db.
+
+    python tools/db_bench.py --data-dir /tmp/db_bench --json db_bench.json
+
+Builds DATA_DIR/wishes.db with bot.py's own schema (100k users, 5M wishes,
+200k custom oracles by default; reused on later runs unless --rebuild or
+the sizes change), then calls each DB-touching function through bot.db,
+the same single-thread executor the bot uses, and reports per-call latency
+(mean, p50/p95/p99, max, calls/s). Run it before and after a schema or
+index change and compare the JSON reports.
+
+Each timed call gets its own random user, so caches only help as much as
+they would in production. Writes are real: use a throwaway --data-dir.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+FIRST_UID = 1_000_000
+WISH_TEXTS = [
+    "Хочу в Париж на выходные",
+    "Мечтаю научиться играть на гитаре",
+    "Хочу завтрак в постель",
+    "Пусть у нас будет собака",
+    "Хочу увидеть северное сияние",
+]
+METAPHOR = "Мечтаю о чае на облаке, где сахар — это смех."
+# Dropped while bulk-loading and recreated by bot._create_schema afterwards
+BULK_DROP = (
+    "DROP INDEX IF EXISTS idx_wishes_user",
+    "DROP INDEX IF EXISTS idx_custom_oracles_user",
+    "DROP TRIGGER IF EXISTS trg_users_version",
+    "DROP TRIGGER IF EXISTS trg_custom_oracles_insert_version",
+)
+BATCH = 50_000
+
+
+def batched(rows, size: int = BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def skewed_uid(users: int) -> int:
+    """A few users send most of the wishes."""
+    return FIRST_UID + int(users * random.random() ** 3)
+
+
+def generate(bot, path: str, users: int, wishes: int, oracles: int):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    bot._create_schema(conn)
+    for sql in BULK_DROP:
+        conn.execute(sql)
+
+    started = time.perf_counter()
+    conn.executemany(
+        "INSERT INTO users (user_id, user_name, first_seen) VALUES (?, ?, datetime('now'))",
+        ((FIRST_UID + i, f"User {i}") for i in range(users)),
+    )
+    for batch in batched(
+        (uid, f"User {uid - FIRST_UID}", random.choice(WISH_TEXTS), METAPHOR)
+        for uid in (skewed_uid(users) for _ in range(wishes))
+    ):
+        conn.executemany(
+            "INSERT INTO wishes (user_id, user_name, original_text, metaphor) "
+            "VALUES (?, ?, ?, ?)",
+            batch,
+        )
+    print(f"  users and wishes: {time.perf_counter() - started:.0f}s", file=sys.stderr)
+
+    owners = [FIRST_UID + random.randrange(users) for _ in range(oracles)]
+    levels = [random.choice((1, 1, 2, 3)) for _ in range(oracles)]
+    conn.executemany(
+        "INSERT INTO custom_oracles (user_id, name, prompt, level, uses) VALUES (?, ?, ?, ?, ?)",
+        (
+            (uid, f"Оракул {n}", "Ты — загадочный оракул. " * 20, level,
+             random.randrange(3 if level == 1 else 10 if level == 2 else 50))
+            for n, (uid, level) in enumerate(zip(owners, levels))
+        ),
+    )
+    conn.execute(
+        "UPDATE users SET wishes_count = w.n "
+        "FROM (SELECT user_id, COUNT(*) AS n FROM wishes GROUP BY user_id) AS w "
+        "WHERE users.user_id = w.user_id"
+    )
+    # Oracle owners have unlocked creation; half of them use their newest oracle
+    conn.execute(
+        "UPDATE users SET can_create_oracle = 1, active_oracle_id = CASE "
+        "WHEN user_id % 2 = 0 THEN "
+        "(SELECT MAX(id) FROM custom_oracles o WHERE o.user_id = users.user_id) END "
+        "WHERE user_id IN (SELECT user_id FROM custom_oracles)"
+    )
+    conn.commit()
+    bot._create_schema(conn)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"  total: {time.perf_counter() - started:.0f}s", file=sys.stderr)
+
+
+def describe(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    info = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "wishes", "custom_oracles")
+    }
+    conn.close()
+    info["file_mb"] = round(os.path.getsize(path) / 1024**2, 1)
+    info["sqlite_version"] = sqlite3.sqlite_version
+    return info
+
+
+def summarize(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    n = len(samples)
+
+    def pct(q: float) -> float:
+        return round(samples[min(n - 1, int(q * n))] * 1e6, 1)
+
+    mean = statistics.fmean(samples)
+    return {
+        "calls": n,
+        "mean_us": round(mean * 1e6, 1),
+        "p50_us": pct(0.50),
+        "p95_us": pct(0.95),
+        "p99_us": pct(0.99),
+        "max_us": round(samples[-1] * 1e6, 1),
+        "calls_per_sec": round(1 / mean, 1),
+    }
+
+
+async def run_benchmarks(bot, users: int, iterations: int, only: set[str]) -> dict:
+    from aiohttp.test_utils import make_mocked_request
+
+    def random_uids(where: str) -> list[int]:
+        rows = bot.db._connection().execute(
+            f"SELECT user_id FROM users WHERE {where} ORDER BY random() LIMIT ?",
+            (iterations,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    async def contexts(where: str) -> list:
+        return [await bot.load_user_context(uid) for uid in random_uids(where)]
+
+    new_uids = iter(range(FIRST_UID + users, FIRST_UID + users + iterations))
+    reservations = []
+
+    async def reserve(ctx):
+        use, _ = await bot.reserve_oracle_use(ctx)
+        reservations.append(use)
+
+    def oracles_requests() -> list:
+        return [make_mocked_request("GET", f"/api/oracles?uid={uid}") for uid in random_uids("1")]
+
+    async def handle_oracles(request):
+        response = await bot.handle_oracles(request)
+        assert response.status == 200, response.status
+
+    # name -> (call, argument per iteration); arguments are prepared untimed
+    cases = {
+        "register_user.new": (
+            lambda uid: bot.register_user(uid, "Bench"), lambda: list(new_uids)),
+        "register_user.existing": (
+            lambda uid: bot.register_user(uid, "Bench"), lambda: random_uids("1")),
+        "load_user_context": (bot.load_user_context, lambda: random_uids("1")),
+        "save_wish": (
+            lambda uid: bot.save_wish(uid, "Bench", random.choice(WISH_TEXTS), METAPHOR),
+            lambda: random_uids("1")),
+        "check_oracle_unlock": (
+            bot.check_oracle_unlock,
+            lambda: contexts("can_create_oracle = 0 AND wishes_count >= 2")),
+        "reserve_oracle_use": (
+            reserve, lambda: contexts("active_oracle_id IS NOT NULL")),
+        "refund_oracle_use": (bot.refund_oracle_use, lambda: [use for use in reservations if use]),
+        "get_oracle_list_keyboard": (
+            bot.get_oracle_list_keyboard, lambda: random_uids("can_create_oracle = 1")),
+        "load_bootstrap": (bot.load_bootstrap, lambda: random_uids("1")),
+        "handle_oracles": (handle_oracles, oracles_requests),
+    }
+
+    results = {}
+    for name, (call, prepare) in cases.items():
+        if only and name not in only:
+            continue
+        args = prepare()
+        if asyncio.iscoroutine(args):
+            args = await args
+        if not args:
+            print(f"  {name}: no matching rows, skipped", file=sys.stderr)
+            continue
+        samples = []
+        for arg in args:
+            started = time.perf_counter()
+            await call(arg)
+            samples.append(time.perf_counter() - started)
+        results[name] = summarize(samples)
+        print(f"  {name}: p50 {results[name]['p50_us']} us", file=sys.stderr)
+    return results
+
+
+def print_report(report: dict):
+    print(f"\n{report['db']}")
+    header = f"{'function':<26} {'calls':>6} {'mean us':>9} {'p50 us':>9} " \
+             f"{'p95 us':>9} {'p99 us':>9} {'max us':>9} {'calls/s':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, row in report["results"].items():
+        print(f"{name:<26} {row['calls']:>6} {row['mean_us']:>9} {row['p50_us']:>9} "
+              f"{row['p95_us']:>9} {row['p99_us']:>9} {row['max_us']:>9} "
+              f"{row['calls_per_sec']:>9}")
+
+
+async def main_async(args, bot):
+    path = bot.DB_FILE
+    sizes = {"users": args.users, "wishes": args.wishes, "custom_oracles": args.oracles}
+    existing = describe(path) if os.path.exists(path) else None
+    if args.rebuild or not existing or any(existing[t] < n for t, n in sizes.items()):
+        print(f"Generating {path} ({sizes})", file=sys.stderr)
+        generate(bot, path, args.users, args.wishes, args.oracles)
+
+    report = {"db": describe(path), "iterations": args.iterations}
+    await bot.init_db()
+    try:
+        report["results"] = await run_benchmarks(
+            bot, args.users, args.iterations, set(args.only or ()),
+        )
+    finally:
+        await bot.db.close()
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", default="/tmp/db_bench")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--wishes", type=int, default=5_000_000)
+    parser.add_argument("--oracles", type=int, default=200_000)
+    parser.add_argument("--iterations", type=int, default=2000, help="calls per function")
+    parser.add_argument("--only", action="append", help="run just this function (repeatable)")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate the database")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report here ('-' for stdout only)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # bot.py reads its settings at import time
+    os.environ["DATA_DIR"] = args.data_dir
+    os.environ.setdefault("BOT_TOKEN", "123456:DBBENCH-fake-token")
+    sys.path.insert(0, str(ROOT))
+    import bot
+
+    asyncio.run(main_async(args, bot))
+
+
+if __name__ == "__main__":
+    main()
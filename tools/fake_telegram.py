@@ -0,0 +1,179 @@
+"""Fake Telegram Bot API server for offline runs and load tests.
+
+    python tools/fake_telegram.py --port 8081 --latency 40
+
+Then start the bot with TELEGRAM_API_URL=http://127.0.0.1:8081 and any
+well-formed BOT_TOKEN. Updates are fed to getUpdates by POSTing them to
+/updates (a single update or a list, update_id is filled in); every Bot API
+call is answered with plausible JSON and counted, see GET /stats.
+
+A share of calls can be answered with 429 (--flood-rate) to exercise the
+RetryAfter handling. tools/loadtest.py runs this in-process.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Load Test", "username": "loadtest_bot"}
+
+# Methods that answer with the Message they created or edited
+MESSAGE_METHODS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup", "forwardMessage",
+    "sendDocument", "sendPhoto",
+}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.updates: list[dict] = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+        self.calls = Counter()
+        self.sent: dict[int, int] = Counter()
+        # chat_id -> push times of updates still waiting for a reply
+        self._pending: dict[int, deque] = defaultdict(deque)
+        self.reply_latencies: list[float] = []
+
+    def push_update(self, update: dict, track: bool = True):
+        """Queue an update for getUpdates; the next message to its chat counts as the reply."""
+        update = {**update, "update_id": next(self.update_ids)}
+        self.updates.append(update)
+        self.new_updates.set()
+        if track:
+            chat_id = _update_chat_id(update)
+            if chat_id is not None:
+                self._pending[chat_id].append(time.perf_counter())
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        waiting = self._pending.get(chat_id)
+        if waiting:
+            self.reply_latencies.append(time.perf_counter() - waiting.popleft())
+        self.sent[chat_id] += 1
+        message = {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    async def get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        # Confirmed updates are dropped, like the real server does
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100))
+        return self.updates[:limit]
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        params.update(request.query)
+        self.calls[method] += 1
+        if method != "getUpdates":
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.flood_rate and random.random() < self.flood_rate:
+                self.calls["429"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+
+        if method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method == "getChat":
+            chat_id = int(params.get("chat_id", 0))
+            result = {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+        elif method == "copyMessage":
+            self._message(params)
+            result = {"message_id": next(self.message_ids)}
+        elif method in MESSAGE_METHODS:
+            result = self._message(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_push(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        for update in data if isinstance(data, list) else [data]:
+            self.push_update(update)
+        return web.json_response({"ok": True})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": dict(self.calls),
+            "pending_updates": len(self.updates),
+            "replies": len(self.reply_latencies),
+        })
+
+
+def _update_chat_id(update: dict) -> int | None:
+    for key in ("message", "edited_message"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return None
+
+
+def make_message_update(user_id: int, text: str) -> dict:
+    """A private-chat text message update from user_id."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    message = {
+        "message_id": random.randrange(1, 2**31),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"message": message}
+
+
+def create_app(fake: FakeTelegram) -> web.Application:
+    app = web.Application(client_max_size=50 * 1024**2)
+    app["fake"] = fake
+    app.router.add_post("/updates", fake.handle_push)
+    app.router.add_get("/stats", fake.handle_stats)
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle_method)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay before every Bot API answer, ms")
+    parser.add_argument("--flood-rate", type=float, default=0.0,
+                        help="share of calls answered with 429, 0..1")
+    args = parser.parse_args()
+    fake = FakeTelegram(args.latency / 1000, args.flood_rate)
+    web.run_app(create_app(fake), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Download the webapp fonts from Google Fonts and self-host them in webapp/fonts.
+
+    python tools/fetch_fonts.py
+
+Keeps only the latin and cyrillic subsets, writes the .woff2 files and
+regenerates webapp/fonts/fonts.css. With fontTools installed
+(pip install fonttools brotli) each file is further subset to the
+characters the pages can show, with hinting dropped.
+The Docker build runs it, so images always self-host the fonts. For the
+separately hosted webapp, commit the result; until then fonts.css falls
+back to Google Fonts. The bot serves the files with immutable caching
+(WEBAPP_SERVE).
+"""
+import argparse
+import re
+import urllib.request
+from io import BytesIO
+from pathlib import Path
+
+FONTS_CSS_URL = (
+    "https://fonts.googleapis.com/css2?family=Playfair+Display:wght@400;700;900"
+    "&family=Montserrat:wght@300;400;600;700&family=Great+Vibes&display=swap"
+)
+SUBSETS = ("cyrillic", "latin")
+# Google only returns woff2 to browsers it recognises
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+)
+
+FONTS_DIR = Path(__file__).resolve().parent.parent / "webapp" / "fonts"
+
+FACE_RE = re.compile(r"/\* ([\w-]+) \*/\s*@font-face\s*{(.*?)}", re.S)
+
+
+def fetch(url: str) -> bytes:
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+def parse_faces(css: str) -> list[dict]:
+    faces = []
+    for subset, body in FACE_RE.findall(css):
+        props = dict(
+            (k.strip(), v.strip())
+            for k, v in (line.split(":", 1) for line in body.split(";") if ":" in line)
+        )
+        url = re.search(r"url\((.*?)\)", props["src"]).group(1)
+        faces.append({
+            "subset": subset,
+            "family": props["font-family"].strip("'\""),
+            "style": props.get("font-style", "normal"),
+            "weight": props.get("font-weight", "400"),
+            "unicode_range": props.get("unicode-range"),
+            "url": url,
+        })
+    return faces
+
+
+def parse_unicode_range(value: str) -> set[int]:
+    codepoints = set()
+    for part in value.split(","):
+        part = part.strip().removeprefix("U+")
+        if "-" in part:
+            start, end = part.split("-")
+            codepoints.update(range(int(start, 16), int(end, 16) + 1))
+        else:
+            codepoints.add(int(part, 16))
+    return codepoints
+
+
+def subset_font(data: bytes, codepoints: set[int]) -> bytes:
+    try:
+        from fontTools import subset
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        return data
+    font = TTFont(BytesIO(data))
+    options = subset.Options()
+    options.flavor = "woff2"
+    options.hinting = False
+    options.desubroutinize = True
+    options.layout_features = ["kern", "liga", "calt", "locl"]
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+    out = BytesIO()
+    font.flavor = "woff2"
+    font.save(out)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", type=Path, default=FONTS_DIR)
+    args = parser.parse_args()
+    args.out.mkdir(parents=True, exist_ok=True)
+
+    faces = [f for f in parse_faces(fetch(FONTS_CSS_URL).decode()) if f["subset"] in SUBSETS]
+    # Variable fonts come back as one file for every weight of a subset
+    urls_per_key: dict[tuple, set] = {}
+    for face in faces:
+        urls_per_key.setdefault((face["family"], face["subset"]), set()).add(face["url"])
+
+    files: dict[str, str] = {}
+    css = [f"/* Generated by tools/fetch_fonts.py from {FONTS_CSS_URL} */"]
+    for face in faces:
+        slug = face["family"].lower().replace(" ", "-")
+        if len(urls_per_key[(face["family"], face["subset"])]) == 1:
+            name = f"{slug}-{face['subset']}.woff2"
+        else:
+            name = f"{slug}-{face['weight']}-{face['subset']}.woff2"
+        if name not in files:
+            data = fetch(face["url"])
+            if face["unicode_range"]:
+                data = subset_font(data, parse_unicode_range(face["unicode_range"]))
+            (args.out / name).write_bytes(data)
+            files[name] = face["url"]
+            print(f"{name}: {len(data) // 1024} KiB")
+        css.append(
+            "@font-face {\n"
+            f"  font-family: '{face['family']}';\n"
+            f"  font-style: {face['style']};\n"
+            f"  font-weight: {face['weight']};\n"
+            "  font-display: swap;\n"
+            f"  src: url('{name}') format('woff2');\n"
+            + (f"  unicode-range: {face['unicode_range']};\n" if face["unicode_range"] else "")
+            + "}"
+        )
+    (args.out / "fonts.css").write_text("\n".join(css) + "\n")
+
+
+if __name__ == "__main__":
+    main()
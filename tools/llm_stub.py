@@ -0,0 +1,132 @@
+"""Deterministic OpenAI-compatible LLM stub for offline runs and load tests.
+
+    python tools/llm_stub.py --port 8090 --latency 300
+
+Then start the bot with LLM_API_URL=http://127.0.0.1:8090/v1.
+The same wish always gets the same metaphor.
+
+For load tests the latency can follow a distribution around --latency
+(--latency-dist uniform|exp|lognormal) and a share of requests can fail
+(--error-rate 0.05 --error-status 503).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+from aiohttp import web
+
+METAPHORS = [
+    "Мечтаю нырнуть в две кроличьи норы, где вместо часов тикают секреты.",
+    "Хочу, чтобы маяк на краю карты зажёгся только для моего корабля.",
+    "Пусть ночной сад распустит для нас тот самый цветок папоротника.",
+    "Жду, когда северный ветер принесёт мне ключ от твоей башни.",
+    "Хочу поймать падающую звезду ладонями и не обжечься.",
+    "Мечтаю о чае на облаке, где сахар — это смех.",
+]
+
+
+def stub_reply(prompt: str) -> str:
+    """Pick a metaphor from the last line of the prompt (the wish itself)."""
+    wish = prompt.strip().rsplit("\n", 1)[-1]
+    digest = hashlib.sha256(wish.encode()).digest()
+    return METAPHORS[digest[0] % len(METAPHORS)]
+
+
+LATENCY_DISTS = {
+    "fixed": lambda mean: mean,
+    "uniform": lambda mean: random.uniform(0, 2 * mean),
+    "exp": lambda mean: random.expovariate(1 / mean) if mean else 0.0,
+    # median = mean, long right tail like real LLM latencies
+    "lognormal": lambda mean: mean * random.lognormvariate(0, 0.6),
+}
+
+
+async def handle_chat_completions(request):
+    data = await request.json()
+    messages = data.get("messages") or []
+    prompt = messages[-1]["content"] if messages else ""
+    reply = stub_reply(prompt)
+    completion_id = "stub-" + hashlib.sha1(prompt.encode()).hexdigest()[:12]
+    app = request.app
+    await asyncio.sleep(LATENCY_DISTS[app["latency_dist"]](app["latency"]))
+    if app["error_rate"] and random.random() < app["error_rate"]:
+        return web.json_response(
+            {"error": {"message": "stub failure", "type": "server_error"}},
+            status=app["error_status"],
+        )
+    if data.get("stream"):
+        return await stream_reply(request, completion_id, data.get("model", "stub"), reply)
+    return web.json_response({
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": data.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": reply},
+            "finish_reason": "stop",
+        }],
+    })
+
+
+async def stream_reply(request, completion_id: str, model: str, reply: str):
+    """Send the reply word by word as chat.completion.chunk events."""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    words = reply.split(" ")
+    for i, word in enumerate(words):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": {"content": word if i == 0 else " " + word},
+                "finish_reason": None,
+            }],
+        }
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await asyncio.sleep(request.app["token_latency"])
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def create_app(latency: float = 0.0, token_latency: float = 0.0,
+               latency_dist: str = "fixed", error_rate: float = 0.0,
+               error_status: int = 500) -> web.Application:
+    app = web.Application()
+    app["latency"] = latency
+    app["token_latency"] = token_latency
+    app["latency_dist"] = latency_dist
+    app["error_rate"] = error_rate
+    app["error_status"] = error_status
+    app.router.add_post("/v1/chat/completions", handle_chat_completions)
+    app.router.add_post("/chat/completions", handle_chat_completions)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay before the response (first token), ms")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="delay between streamed tokens, ms")
+    parser.add_argument("--latency-dist", choices=sorted(LATENCY_DISTS), default="fixed",
+                        help="how --latency varies per request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests that fail, 0..1")
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+    app = create_app(args.latency / 1000, args.token_latency / 1000,
+                     args.latency_dist, args.error_rate, args.error_status)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
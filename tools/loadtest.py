@@ -0,0 +1,296 @@
+"""Offline load test: bot.py against a fake Telegram Bot API and a fake LLM.
+
+    python tools/loadtest.py --rate 50 --duration 60 --llm-latency 800 \\
+        --llm-latency-dist lognormal --llm-error-rate 0.02 --json report.json
+
+Starts tools/fake_telegram.py and tools/llm_stub.py in this process, runs
+bot.py as a subprocess against them (temporary DATA_DIR, rate limits off),
+registers --users users with /start and then replays requests with Poisson
+arrivals at --rate per second, split by --mix between:
+
+    wish     POST /api/wish
+    oracles  GET /api/oracles
+    update   a /start, /help or /oracle message through getUpdates,
+             timed until the bot's reply reaches the fake server
+
+Prints throughput and p50/p95/p99 latency per endpoint; --json writes the
+same report for comparing runs. Extra bot settings can be passed as
+environment variables (e.g. API_WORKERS=2 python tools/loadtest.py ...).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+import llm_stub
+from fake_telegram import FakeTelegram, create_app as create_telegram_app, make_message_update
+
+BOT_PY = Path(__file__).resolve().parent.parent / "bot.py"
+BOT_TOKEN = "123456:LOADTEST-fake-token"
+ADMIN_ID = 1
+FIRST_UID = 100_000
+UPDATE_TEXTS = ("/start", "/help", "/oracle")
+# Every limited route, turned off so the test measures the bot, not the limiter
+RATE_LIMITS_OFF = {
+    path: {} for path in (
+        "/api/wish", "/api/wish/stream", "/api/wish/{job_id}",
+        "/api/bootstrap", "/api/oracles", "/api/oracle/select",
+    )
+}
+WISHES = [
+    "Хочу в Париж на выходные",
+    "Мечтаю научиться играть на гитаре",
+    "Хочу завтрак в постель",
+    "Пусть у нас будет собака",
+    "Хочу увидеть северное сияние",
+]
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Results:
+    def __init__(self):
+        self.samples: dict[str, list[tuple[float, bool]]] = {}
+        self.statuses: dict[str, dict[str, int]] = {}
+
+    def add(self, endpoint: str, seconds: float, status: str):
+        ok = status == "200"
+        self.samples.setdefault(endpoint, []).append((seconds, ok))
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    def report(self, duration: float) -> dict:
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            ok = [s for s, good in samples if good]
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "ok": len(ok),
+                "throughput": round(len(ok) / duration, 2),
+                "p50_ms": _ms(percentile(ok, 0.50)),
+                "p95_ms": _ms(percentile(ok, 0.95)),
+                "p99_ms": _ms(percentile(ok, 0.99)),
+                "statuses": self.statuses[endpoint],
+            }
+        return endpoints
+
+
+def _ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+async def start_site(app: web.Application, port: int) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def wait_for_api(session: aiohttp.ClientSession, api: str, proc: subprocess.Popen,
+                       timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"bot.py exited with code {proc.returncode}")
+        try:
+            async with session.get(f"{api}/api/oracles", params={"uid": ADMIN_ID}) as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    sys.exit("bot.py API did not come up")
+
+
+async def wait_for_replies(fake: FakeTelegram, expected: int, timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while len(fake.reply_latencies) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    return len(fake.reply_latencies)
+
+
+async def timed_http(session, results: Results, endpoint: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            await resp.read()
+            status = str(resp.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = type(e).__name__
+    results.add(endpoint, time.perf_counter() - start, status)
+
+
+async def run_load(args, session, api: str, fake: FakeTelegram, results: Results):
+    kinds, weights = zip(*args.mix.items())
+    uids = range(FIRST_UID, FIRST_UID + args.users)
+    tasks = []
+    updates_sent = 0
+    start = time.perf_counter()
+    next_at = start
+    while next_at - start < args.duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        uid = random.choice(uids)
+        kind = random.choices(kinds, weights)[0]
+        if kind == "wish":
+            tasks.append(asyncio.create_task(timed_http(
+                session, results, "POST /api/wish", "POST", f"{api}/api/wish",
+                json={"text": random.choice(WISHES), "uid": uid},
+            )))
+        elif kind == "oracles":
+            tasks.append(asyncio.create_task(timed_http(
+                session, results, "GET /api/oracles", "GET", f"{api}/api/oracles",
+                params={"uid": uid},
+            )))
+        else:
+            fake.push_update(make_message_update(uid, random.choice(UPDATE_TEXTS)))
+            updates_sent += 1
+        next_at += random.expovariate(args.rate)
+    offered = time.perf_counter() - start
+
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.drain)
+    replied = await wait_for_replies(fake, updates_sent, args.drain)
+    elapsed = time.perf_counter() - start
+    for seconds in fake.reply_latencies:
+        results.add("update", seconds, "200")
+    if updates_sent > replied:
+        results.statuses.setdefault("update", {})["no reply"] = updates_sent - replied
+        results.samples.setdefault("update", []).extend(
+            [(args.drain, False)] * (updates_sent - replied)
+        )
+    return offered, elapsed
+
+
+def print_report(report: dict):
+    print(f"\noffered {report['offered_rate']}/s for {report['duration']}s "
+          f"(finished after {report['elapsed']}s)")
+    header = f"{'endpoint':<18} {'requests':>8} {'ok':>7} {'ok/s':>8} " \
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in report["endpoints"].items():
+        cells = [
+            "-" if row[k] is None else f"{row[k]:.1f}" for k in ("p50_ms", "p95_ms", "p99_ms")
+        ]
+        statuses = " ".join(f"{k}:{v}" for k, v in sorted(row["statuses"].items()))
+        print(f"{endpoint:<18} {row['requests']:>8} {row['ok']:>7} {row['throughput']:>8.2f} "
+              f"{cells[0]:>8} {cells[1]:>8} {cells[2]:>8}  {statuses}")
+    print(f"\nBot API calls: {report['telegram_calls']}")
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("wish", "oracles", "update"):
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+async def main_async(args):
+    fake = FakeTelegram(args.tg_latency / 1000, args.tg_flood_rate)
+    tg_runner, tg_port = await start_site(create_telegram_app(fake), 0)
+    llm_app = llm_stub.create_app(
+        args.llm_latency / 1000, 0.0, args.llm_latency_dist,
+        args.llm_error_rate, args.llm_error_status,
+    )
+    llm_runner, llm_port = await start_site(llm_app, 0)
+
+    data_dir = tempfile.mkdtemp(prefix="loadtest-")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "DATA_DIR": data_dir,
+        "API_PORT": str(args.api_port),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "LLM_API_URL": f"http://127.0.0.1:{llm_port}/v1",
+        "LLM_BACKEND": "openai",
+        "RATE_LIMITS": json.dumps(RATE_LIMITS_OFF),
+        "WEBHOOK_URL": "",
+    }
+    log = open(os.path.join(data_dir, "bot.log"), "w")
+    proc = subprocess.Popen([sys.executable, str(BOT_PY)], env=env, stdout=log,
+                            stderr=subprocess.STDOUT)
+    api = f"http://127.0.0.1:{args.api_port}"
+    print(f"bot.py pid {proc.pid}, data and log in {data_dir}")
+    try:
+        timeout = aiohttp.ClientTimeout(total=args.drain)
+        connector = aiohttp.TCPConnector(limit=args.connections)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await wait_for_api(session, api, proc)
+            for uid in range(FIRST_UID, FIRST_UID + args.users):
+                fake.push_update(make_message_update(uid, "/start"))
+            registered = await wait_for_replies(fake, args.users, 30 + args.users / 20)
+            print(f"registered {registered}/{args.users} users")
+            fake.reply_latencies.clear()
+            fake.calls.clear()
+
+            results = Results()
+            offered, elapsed = await run_load(args, session, api, fake, results)
+        report = {
+            "offered_rate": args.rate,
+            "duration": round(offered, 2),
+            "elapsed": round(elapsed, 2),
+            "mix": args.mix,
+            "endpoints": results.report(offered),
+            "telegram_calls": dict(fake.calls),
+        }
+        print_report(report)
+        if args.json:
+            Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        await tg_runner.cleanup()
+        await llm_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20, help="arrivals per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("wish=1,oracles=3,update=2"),
+                        help="relative weights, e.g. wish=1,oracles=3,update=2")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--api-port", type=int, default=18069)
+    parser.add_argument("--connections", type=int, default=256)
+    parser.add_argument("--drain", type=float, default=60,
+                        help="seconds to wait for outstanding requests after the load")
+    parser.add_argument("--llm-latency", type=float, default=500, help="ms")
+    parser.add_argument("--llm-latency-dist", choices=sorted(llm_stub.LATENCY_DISTS),
+                        default="lognormal")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-status", type=int, default=503)
+    parser.add_argument("--tg-latency", type=float, default=30, help="Bot API latency, ms")
+    parser.add_argument("--tg-flood-rate", type=float, default=0.0,
+                        help="share of Bot API calls answered with 429")
+    parser.add_argument("--json", help="write the report to this file")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()